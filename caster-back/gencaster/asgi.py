@@ -3,11 +3,11 @@ ASGI config for gencaster project.
 """
 import os
 
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 from django.urls import re_path
 
-from .distributor import GraphQLWSConsumerInjector
+from .distributor import GenCasterChannel, GraphQLWSConsumerInjector
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "gencaster.settings.dev")
 
@@ -21,6 +21,8 @@ print(f"### STARTING SERVER WITH {os.environ['DJANGO_SETTINGS_MODULE']} ###")
 django_asgi_app = get_asgi_application()
 
 
+from story_graph.worker import EngineWorker
+
 from .schema import schema
 
 websocket_urlpatterns = [
@@ -36,5 +38,11 @@ application = ProtocolTypeRouter(
     {
         "http": URLRouter([re_path("^", django_asgi_app)]),  # type: ignore
         "websocket": URLRouter(websocket_urlpatterns),
+        # run via ``python manage.py runworker engine-worker``
+        "channel": ChannelNameRouter(
+            {
+                GenCasterChannel.ENGINE_WORKER_CHANNEL: EngineWorker.as_asgi(),
+            }
+        ),
     }
 )
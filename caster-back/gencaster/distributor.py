@@ -6,10 +6,23 @@ A collection of async messaging tools which is used by our GraphQL schema.
 
 """
 
+import asyncio
 import logging
 import uuid
+from contextlib import suppress
 from dataclasses import asdict, dataclass, field
-from typing import AsyncGenerator, Awaitable, Callable, List, Optional, Union
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+)
 
 from channels.layers import get_channel_layer
 from channels_redis.core import RedisChannelLayer
@@ -17,6 +30,8 @@ from strawberry.channels import GraphQLWSConsumer
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 def uuid_to_group(u: Union[uuid.UUID, str]) -> str:
     """Channel group names are not allow
@@ -25,10 +40,78 @@ def uuid_to_group(u: Union[uuid.UUID, str]) -> str:
     return str(u).replace("-", "_")
 
 
+def engine_events_group(session: Union[uuid.UUID, str]) -> str:
+    return f"engine_events_{uuid_to_group(session)}"
+
+
+def engine_control_group(session: Union[uuid.UUID, str]) -> str:
+    return f"engine_control_{uuid_to_group(session)}"
+
+
+def stream_owner_group(stream_uuid: Union[uuid.UUID, str]) -> str:
+    return f"stream_owner_{uuid_to_group(stream_uuid)}"
+
+
 class MissingChannelLayer(Exception):
     pass
 
 
+class ChannelSubscription:
+    """Listens on a group of the channel layer without the need of a
+    websocket consumer, e.g. from within the :class:`~story_graph.engine.Engine`.
+
+    The group is joined upon entering the context, so any message which gets
+    send after entering the context will be received.
+
+    .. code-block:: python
+
+        async with ChannelSubscription(group_name, message_type) as subscription:
+            async for message in subscription:
+                ...
+    """
+
+    def __init__(self, group_name: str, message_type: Union[str, List[str]]) -> None:
+        self.group_name = group_name
+        self.message_types = (
+            [message_type] if isinstance(message_type, str) else message_type
+        )
+        self._layer: Optional[RedisChannelLayer] = None
+        self._channel_name: Optional[str] = None
+
+    async def __aenter__(self) -> "ChannelSubscription":
+        self._layer = GenCasterChannel._get_layer()
+        self._channel_name = await self._layer.new_channel()
+        await self._layer.group_add(self.group_name, self._channel_name)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        if self._layer and self._channel_name:
+            await self._layer.group_discard(self.group_name, self._channel_name)
+
+    async def receive(self) -> Dict[str, Any]:
+        """Returns the next message of the subscribed type,
+        which can be cancelled without closing the subscription.
+        """
+        if not (self._layer and self._channel_name):
+            raise MissingChannelLayer()
+        while True:
+            message = await self._layer.receive(self._channel_name)
+            if message.get("type") in self.message_types:
+                return message  # type: ignore
+
+    async def rejoin(self) -> None:
+        """Joins the group again, as the channel layer drops the
+        members of a group after ``group_expiry`` seconds.
+        """
+        if not (self._layer and self._channel_name):
+            raise MissingChannelLayer()
+        await self._layer.group_add(self.group_name, self._channel_name)
+
+    async def __aiter__(self) -> AsyncGenerator[Dict[str, Any], None]:
+        while True:
+            yield await self.receive()
+
+
 class GraphQLWSConsumerInjector(GraphQLWSConsumer):
     """Allows us to inject callbacks on e.g. a disconnect.
 
@@ -66,6 +149,20 @@ class GenCasterChannel:
     NODE_UPDATE_TYPE = "node.update"
     STREAM_LOG_UPDATE_TYPE = "stream_log.update"
     STREAMS_UPDATE_TYPE = "streams.update"
+    STREAM_INSTRUCTION_UPDATE_TYPE = "stream_instruction.update"
+    STREAM_VARIABLE_UPDATE_TYPE = "stream_variable.update"
+    ENGINE_START_TYPE = "engine.start"
+    ENGINE_STOP_TYPE = "engine.stop"
+    ENGINE_EVENT_TYPE = "engine.event"
+    STREAM_CLAIM_TYPE = "stream.claim"
+
+    # named channel on which the engine workers listen, see
+    # :class:`~story_graph.worker.EngineWorker`
+    ENGINE_WORKER_CHANNEL = "engine-worker"
+
+    # receives the updates of all graphs and nodes, see
+    # :class:`~story_graph.snapshot.GraphSnapshotCache`
+    GRAPH_UPDATES_GROUP = "graph_updates"
 
     def __init__(self) -> None:
         pass
@@ -74,20 +171,36 @@ class GenCasterChannel:
     def _get_layer() -> RedisChannelLayer:
         if layer := get_channel_layer():
             return layer
-        raise Exception("Could not obtain redis channel layer")
+        raise MissingChannelLayer("Could not obtain redis channel layer")
 
     @staticmethod
     async def send_graph_update(graph_uuid: uuid.UUID):
         return await GenCasterChannel.send_message(
             layer=GenCasterChannel._get_layer(),
-            message=GraphUpdateMessage(uuid=str(graph_uuid)),
+            message=GraphUpdateMessage(
+                uuid=str(graph_uuid),
+                additional_channels=[GenCasterChannel.GRAPH_UPDATES_GROUP],
+            ),
         )
 
     @staticmethod
     async def send_node_update(node_uuid: uuid.UUID):
         return await GenCasterChannel.send_message(
             layer=GenCasterChannel._get_layer(),
-            message=NodeUpdateMessage(uuid=str(node_uuid)),
+            message=NodeUpdateMessage(
+                uuid=str(node_uuid),
+                additional_channels=[GenCasterChannel.GRAPH_UPDATES_GROUP],
+            ),
+        )
+
+    @staticmethod
+    async def send_node_snapshot_update(node_uuid: uuid.UUID):
+        """Only notifies the :class:`~story_graph.snapshot.GraphSnapshotCache`
+        of all processes about the update of a node, but not the editors.
+        """
+        return await GenCasterChannel._get_layer().group_send(
+            GenCasterChannel.GRAPH_UPDATES_GROUP,
+            asdict(NodeUpdateMessage(uuid=str(node_uuid))),
         )
 
     @staticmethod
@@ -103,6 +216,82 @@ class GenCasterChannel:
             message=StreamsUpdateMessage(uuid=str(stream_uuid)),
         )
 
+    @staticmethod
+    async def send_stream_instruction_update(instruction_uuid: uuid.UUID, state: str):
+        return await GenCasterChannel.send_message(
+            layer=GenCasterChannel._get_layer(),
+            message=StreamInstructionUpdateMessage(
+                uuid=str(instruction_uuid),
+                state=str(state),
+            ),
+        )
+
+    @staticmethod
+    async def send_stream_variable_update(stream_uuid: uuid.UUID, key: str, value: str):
+        return await GenCasterChannel.send_message(
+            layer=GenCasterChannel._get_layer(),
+            message=StreamVariableUpdateMessage(
+                uuid=str(stream_uuid),
+                key=key,
+                value=value,
+            ),
+        )
+
+    @staticmethod
+    async def send_engine_start(
+        graph_uuid: uuid.UUID,
+        stream_uuid: uuid.UUID,
+        session: uuid.UUID,
+        resume: bool = False,
+        expires: Optional[float] = None,
+        run_cleanup_procedure: Optional[bool] = None,
+    ):
+        """Asks any of the engine workers to run the graph on the stream.
+        As this is send to a named channel, only one worker will receive it.
+
+        The ``session`` identifies the engine, so a listener who reconnects to
+        the same stream does not receive or stop the engine of its old connection.
+        """
+        layer = GenCasterChannel._get_layer()
+        return await layer.send(
+            GenCasterChannel.ENGINE_WORKER_CHANNEL,
+            asdict(
+                EngineStartMessage(
+                    uuid=str(stream_uuid),
+                    graph_uuid=str(graph_uuid),
+                    session=str(session),
+                    resume=resume,
+                    expires=expires,
+                    run_cleanup_procedure=run_cleanup_procedure,
+                )
+            ),
+        )
+
+    @staticmethod
+    async def send_engine_stop(session: uuid.UUID):
+        return await GenCasterChannel.send_message(
+            layer=GenCasterChannel._get_layer(),
+            message=EngineStopMessage(uuid=str(session)),
+        )
+
+    @staticmethod
+    async def send_stream_claim(
+        stream_uuid: uuid.UUID, owner: uuid.UUID, released: bool = False
+    ):
+        return await GenCasterChannel.send_message(
+            layer=GenCasterChannel._get_layer(),
+            message=StreamClaimMessage(
+                uuid=str(stream_uuid), owner=str(owner), released=released
+            ),
+        )
+
+    @staticmethod
+    async def send_engine_event(engine_event_message: "EngineEventMessage"):
+        return await GenCasterChannel.send_message(
+            layer=GenCasterChannel._get_layer(),
+            message=engine_event_message,
+        )
+
     @staticmethod
     async def send_message(
         layer: RedisChannelLayer,
@@ -111,6 +300,11 @@ class GenCasterChannel:
             "NodeUpdateMessage",
             "StreamLogUpdateMessage",
             "StreamsUpdateMessage",
+            "StreamInstructionUpdateMessage",
+            "StreamVariableUpdateMessage",
+            "EngineStopMessage",
+            "EngineEventMessage",
+            "StreamClaimMessage",
         ],
     ):
         for channel in message.channels:
@@ -172,6 +366,62 @@ class GenCasterChannel:
         ):
             yield StreamsUpdateMessage(**message)
 
+    @staticmethod
+    def subscribe_stream_instruction_updates(
+        instruction_uuid: uuid.UUID,
+    ) -> ChannelSubscription:
+        """Subscribes to the state changes of a single
+        :class:`~stream.models.StreamInstruction`, which allows to
+        wait for an acknowledgement without querying the database.
+        """
+        return ChannelSubscription(
+            group_name=uuid_to_group(instruction_uuid),
+            message_type=GenCasterChannel.STREAM_INSTRUCTION_UPDATE_TYPE,
+        )
+
+    @staticmethod
+    def subscribe_stream_variable_updates(
+        stream_uuid: uuid.UUID,
+    ) -> ChannelSubscription:
+        """Subscribes to all changes of any :class:`~stream.models.StreamVariable`
+        within a :class:`~stream.models.Stream`.
+        """
+        return ChannelSubscription(
+            group_name=uuid_to_group(stream_uuid),
+            message_type=GenCasterChannel.STREAM_VARIABLE_UPDATE_TYPE,
+        )
+
+    @staticmethod
+    def subscribe_graph_updates() -> ChannelSubscription:
+        """Subscribes to the updates of any graph or node, see
+        :class:`~GraphUpdateMessage` and :class:`~NodeUpdateMessage`.
+        """
+        return ChannelSubscription(
+            group_name=GenCasterChannel.GRAPH_UPDATES_GROUP,
+            message_type=[
+                GenCasterChannel.GRAPH_UPDATE_TYPE,
+                GenCasterChannel.NODE_UPDATE_TYPE,
+            ],
+        )
+
+    @staticmethod
+    def subscribe_engine_events(session: uuid.UUID) -> ChannelSubscription:
+        """Subscribes to the events of an engine session which runs on a
+        :class:`~story_graph.worker.EngineWorker`.
+        """
+        return ChannelSubscription(
+            group_name=engine_events_group(session),
+            message_type=GenCasterChannel.ENGINE_EVENT_TYPE,
+        )
+
+    @staticmethod
+    def subscribe_stream_claims(stream_uuid: uuid.UUID) -> ChannelSubscription:
+        """Subscribes to the claims of a stream, see :class:`~StreamClaim`."""
+        return ChannelSubscription(
+            group_name=stream_owner_group(stream_uuid),
+            message_type=GenCasterChannel.STREAM_CLAIM_TYPE,
+        )
+
 
 @dataclass
 class GraphUpdateMessage:
@@ -223,3 +473,260 @@ class StreamsUpdateMessage:
     @property
     def channels(self) -> List[str]:
         return [GenCasterChannel.STREAMS_UPDATE_TYPE] + self.additional_channels
+
+
+@dataclass
+class StreamInstructionUpdateMessage:
+    uuid: str
+    state: str
+
+    type: str = GenCasterChannel.STREAM_INSTRUCTION_UPDATE_TYPE
+
+    additional_channels: List[str] = field(default_factory=list)
+
+    @property
+    def channels(self) -> List[str]:
+        return [uuid_to_group(self.uuid)] + self.additional_channels
+
+
+@dataclass
+class StreamVariableUpdateMessage:
+    # uuid of the stream
+    uuid: str
+    key: str
+    value: str
+
+    type: str = GenCasterChannel.STREAM_VARIABLE_UPDATE_TYPE
+
+    additional_channels: List[str] = field(default_factory=list)
+
+    @property
+    def channels(self) -> List[str]:
+        return [uuid_to_group(self.uuid)] + self.additional_channels
+
+
+@dataclass
+class EngineStartMessage:
+    # uuid of the stream
+    uuid: str
+    graph_uuid: str
+    session: str
+    # continue from the checkpoint of the stream
+    resume: bool = False
+    # unix timestamp after which the request is outdated, as the
+    # subscription has already fallen back to a local engine
+    expires: Optional[float] = None
+    # as the worker fetches the stream after the listener got counted,
+    # the subscription decides if SuperCollider needs to be reset
+    run_cleanup_procedure: Optional[bool] = None
+
+    type: str = GenCasterChannel.ENGINE_START_TYPE
+
+
+@dataclass
+class EngineStopMessage:
+    # uuid of the engine session
+    uuid: str
+
+    type: str = GenCasterChannel.ENGINE_STOP_TYPE
+
+    additional_channels: List[str] = field(default_factory=list)
+
+    @property
+    def channels(self) -> List[str]:
+        return [engine_control_group(self.uuid)] + self.additional_channels
+
+
+@dataclass
+class EngineEventMessage:
+    """An event of an engine which runs on a worker.
+
+    ``event`` is one of ``started``, ``instruction`` (with ``instruction_uuid``),
+    ``dialog`` (with a serialized ``dialog``), ``parked`` (with ``node_uuid``),
+    ``dead_end`` or ``failure``.
+    """
+
+    # uuid of the engine session
+    uuid: str
+    event: str
+    instruction_uuid: Optional[str] = None
+    dialog: Optional[Dict[str, Any]] = None
+    node_uuid: Optional[str] = None
+    expires: Optional[float] = None
+
+    type: str = GenCasterChannel.ENGINE_EVENT_TYPE
+
+    additional_channels: List[str] = field(default_factory=list)
+
+    @property
+    def channels(self) -> List[str]:
+        return [engine_events_group(self.uuid)] + self.additional_channels
+
+
+@dataclass
+class StreamClaimMessage:
+    # uuid of the stream
+    uuid: str
+    # uuid of the claiming subscription
+    owner: str
+    # send by the previous owner once it has stopped its engine
+    released: bool = False
+
+    type: str = GenCasterChannel.STREAM_CLAIM_TYPE
+
+    additional_channels: List[str] = field(default_factory=list)
+
+    @property
+    def channels(self) -> List[str]:
+        return [stream_owner_group(self.uuid)] + self.additional_channels
+
+
+class StreamClaim:
+    """Makes a subscription the single owner of a stream across all processes.
+
+    A listener whose websocket is still half-open can reconnect to its stream
+    before the old subscription has noticed the disconnect.
+    Upon entering the context the new subscription announces itself as owner
+    of the stream, which lets the old subscription stop its engine
+    via :func:`~StreamClaim.guard` and :func:`~StreamClaim.run` and
+    confirm this with a ``released`` message.
+
+    .. code-block:: python
+
+        async with StreamClaim(stream.uuid) as claim:
+            await claim.wait_for_release()
+            async for instruction in claim.guard(engine.start()):
+                ...
+
+    :param exclusive: If ``False`` the stream is shared among listeners, so
+        nothing gets claimed and the subscription never loses the stream.
+    """
+
+    # seconds to wait for the previous owner to stop its engine
+    release_timeout: float = 2.0
+
+    def __init__(self, stream_uuid: uuid.UUID, exclusive: bool = True) -> None:
+        self.stream_uuid = stream_uuid
+        self.owner = uuid.uuid4()
+        self.exclusive = exclusive
+        self._subscription = GenCasterChannel.subscribe_stream_claims(stream_uuid)
+        self._lost: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._released = asyncio.Event()
+        self._watcher: Optional[asyncio.Task] = None
+
+    @property
+    def lost(self) -> bool:
+        """If another subscription has claimed the stream."""
+        return self._lost.done()
+
+    async def __aenter__(self) -> "StreamClaim":
+        if self.exclusive:
+            await self._subscription.__aenter__()
+            self._watcher = asyncio.create_task(self._watch())
+            await GenCasterChannel.send_stream_claim(self.stream_uuid, self.owner)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        if self._watcher is None:
+            return
+        self._watcher.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._watcher
+        if self.lost:
+            await GenCasterChannel.send_stream_claim(
+                self.stream_uuid, self.owner, released=True
+            )
+        await self._subscription.__aexit__(*args)
+
+    async def _watch(self) -> None:
+        while True:
+            message = StreamClaimMessage(**await self._subscription.receive())
+            if message.owner == str(self.owner):
+                continue
+            if message.released:
+                self._released.set()
+            elif not self.lost:
+                log.info(f"Stream {self.stream_uuid} got claimed by {message.owner}")
+                self._lost.set_result(None)
+
+    async def wait_for_release(self) -> bool:
+        """Waits until the previous owner has stopped its engine.
+        Returns ``False`` if no release arrived within ``release_timeout``.
+        """
+        try:
+            await asyncio.wait_for(self._released.wait(), self.release_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def run(self, awaitable: Awaitable[T]) -> Optional[T]:
+        """Awaits ``awaitable`` unless the stream gets claimed by
+        another subscription, in which case it gets cancelled and
+        ``None`` is returned.
+        """
+        task = asyncio.ensure_future(awaitable)
+        try:
+            await asyncio.wait([task, self._lost], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not task.done():
+                task.cancel()
+                # let the awaitable clean up before it gets closed
+                await asyncio.wait([task])
+        if task.cancelled():
+            return None
+        return task.result()
+
+    async def guard(self, iterable: AsyncIterable[T]) -> AsyncGenerator[T, None]:
+        """Yields from ``iterable`` until the stream gets claimed by another
+        subscription, which closes the iterable, e.g. an engine.
+
+        The iterable is driven by a single task, so any
+        :class:`~contextvars.ContextVar` which is set within it, e.g. by
+        the :mod:`~story_graph.profiler`, persists across its steps.
+        """
+        # each request lets the driver advance the iterable by one step
+        requests: asyncio.Queue = asyncio.Queue()
+        results: asyncio.Queue = asyncio.Queue()
+
+        async def drive() -> None:
+            iterator = iterable.__aiter__()
+            try:
+                while await requests.get():
+                    try:
+                        item = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        results.put_nowait((False, None))
+                        return
+                    except Exception as e:
+                        results.put_nowait((False, e))
+                        return
+                    results.put_nowait((True, item))
+            finally:
+                if aclose := getattr(iterator, "aclose", None):
+                    await aclose()
+
+        driver = asyncio.create_task(drive())
+        try:
+            while not self.lost:
+                requests.put_nowait(True)
+                result = asyncio.ensure_future(results.get())
+                try:
+                    await asyncio.wait(
+                        [result, self._lost], return_when=asyncio.FIRST_COMPLETED
+                    )
+                finally:
+                    if not result.done():
+                        result.cancel()
+                if self.lost or result.cancelled():
+                    return
+                has_item, value = result.result()
+                if not has_item:
+                    if value is not None:
+                        raise value
+                    return
+                yield value
+        finally:
+            if not driver.done():
+                # lets the iterable clean up within its own task
+                driver.cancel()
+            await asyncio.wait([driver])
@@ -20,11 +20,12 @@ import json
 import logging
 import os
 import uuid
-from typing import Any, AsyncGenerator, Dict, List, Optional
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Optional
 
 import strawberry
 import strawberry.django
 from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import AbstractBaseUser
 from django.contrib.auth.models import User as UserModel
@@ -37,14 +38,22 @@ from strawberry_django.fields.field import StrawberryDjangoField
 
 import story_graph.models as story_graph_models
 import stream.models as stream_models
+from story_graph.broadcast import SharedEngine
 from story_graph.engine import Engine
+from story_graph.graph_variables import GraphVariables
+from story_graph.parking import ParkedStreams
+from story_graph.profiler import HISTOGRAM_BUCKETS, GraphProfile
+from story_graph.snapshot import GraphSnapshotCache
 from story_graph.types import (
     AddGraphInput,
     AudioCellInput,
     Edge,
     EdgeInput,
+    EngineProfileStats,
     Graph,
     GraphFilter,
+    GraphVariable,
+    GraphVariableInput,
     InvalidPythonCode,
     Node,
     NodeCreate,
@@ -59,6 +68,7 @@ from story_graph.types import (
     UpdateGraphInput,
     create_python_highlight_string,
 )
+from story_graph.worker import relay_engine
 from stream.exceptions import NoStreamAvailableException
 from stream.frontend_types import Dialog
 from stream.types import (
@@ -79,7 +89,7 @@ from stream.types import (
 )
 
 from . import db_logging
-from .distributor import GenCasterChannel, GraphQLWSConsumerInjector
+from .distributor import GenCasterChannel, GraphQLWSConsumerInjector, StreamClaim
 
 log = logging.getLogger(__name__)
 
@@ -116,6 +126,24 @@ async def graphql_check_authenticated(info: Info):
         raise PermissionDenied()
 
 
+async def get_listener_graph(
+    info: Info, graph_uuid: uuid.UUID
+) -> story_graph_models.Graph:
+    """Returns a graph which is accessible to an anonymous listener, which
+    is any public visible graph, whereas a logged in user can access all graphs.
+
+    Raises :class:`~django.core.exceptions.PermissionDenied` otherwise, also if
+    the graph does not exist, so it is not possible to probe for graphs.
+    """
+    graphs = story_graph_models.Graph.objects.all()
+    if not await sync_to_async(lambda: info.context.request.user.is_authenticated)():  # type: ignore
+        graphs = graphs.filter(public_visible=True)
+    try:
+        return await graphs.aget(uuid=graph_uuid)
+    except story_graph_models.Graph.DoesNotExist:
+        raise PermissionDenied()
+
+
 async def update_or_create_audio_cell(
     audio_cell_input: Optional[AudioCellInput],
 ) -> Optional[story_graph_models.AudioCell]:
@@ -172,6 +200,53 @@ class Query:
             return info.context.request.user  # type: ignore
         return None
 
+    @strawberry.field
+    async def engine_profile(
+        self, info, graph_uuid: uuid.UUID
+    ) -> List[EngineProfileStats]:
+        """Execution times of the cells and node doors of a graph which
+        have been recorded by the engines of this server,
+        see :mod:`~story_graph.profiler`.
+
+        Not available if ``ENGINE_WORKERS`` is enabled, as the engines then
+        record their profiles within the worker processes.
+        """
+        await graphql_check_authenticated(info)
+        if settings.ENGINE_WORKERS:
+            raise Exception(
+                "Engine profiles are kept within the engine workers and are not "
+                "available via GraphQL - use simulate_graph --profile instead"
+            )
+        return [
+            EngineProfileStats(
+                node_uuid=node_uuid,
+                category=category,
+                count=stats.count,
+                wall_time=stats.wall_time,
+                mean_wall_time=stats.mean_wall_time,
+                max_wall_time=stats.max_wall_time,
+                wait_time=stats.wait_time,
+                queries=stats.queries,
+                histogram=stats.histogram,
+                histogram_buckets=list(HISTOGRAM_BUCKETS[:-1]),
+            )
+            for (node_uuid, category), stats in GraphProfile.get(
+                graph_uuid
+            ).stats.items()
+        ]
+
+    @strawberry.field
+    async def graph_variables(self, info, graph_uuid: uuid.UUID) -> List[GraphVariable]:
+        """The variables which are shared by all streams of a graph,
+        see :mod:`~story_graph.graph_variables`.
+
+        Anonymous listeners can only access the variables of public visible
+        graphs, see :func:`~get_listener_graph`.
+        """
+        await get_listener_graph(info, graph_uuid)
+        variables = await GraphVariables(graph_uuid).get_all()
+        return [GraphVariable(key=key, value=value) for key, value in variables.items()]
+
 
 @strawberry.type
 class LoginError:
@@ -283,6 +358,7 @@ class Mutation:
         edge = await story_graph_models.Edge.objects.acreate(
             in_node_door=in_node_door,
             out_node_door=out_node_door,
+            weight=new_edge.weight,
         )
         return edge  # type: ignore
 
@@ -345,6 +421,7 @@ class Mutation:
                 cell_order=script_cell_input.cell_order,
                 cell_type=script_cell_input.cell_type,
                 cell_code=script_cell_input.cell_code,
+                concurrent_group=script_cell_input.concurrent_group,
                 node=node,
                 audio_cell=audio_cell,
             )
@@ -376,6 +453,8 @@ class Mutation:
             updates: Dict[str, Any] = {}
             if (order := script_cell_input.cell_order) != UNSET:
                 updates["cell_order"] = order
+            if (group := script_cell_input.concurrent_group) != UNSET:
+                updates["concurrent_group"] = group
             if audio_cell:
                 updates["audio_cell"] = audio_cell
             if cell_code := script_cell_input.cell_code:
@@ -388,6 +467,9 @@ class Mutation:
             await story_graph_models.ScriptCell.objects.filter(
                 uuid=script_cell_input.uuid
             ).aupdate(**updates)
+            # a queryset update does not trigger any signals
+            GraphSnapshotCache.invalidate(node_uuid=script_cell.node_id)  # type: ignore
+            await GenCasterChannel.send_node_snapshot_update(script_cell.node_id)  # type: ignore
             script_cells.append(script_cell)
 
         return script_cells  # type: ignore
@@ -485,6 +567,47 @@ class Mutation:
 
         return stream_vars  # type: ignore
 
+    @strawberry.mutation
+    async def set_graph_variables(
+        self, info, graph_variables: List[GraphVariableInput]
+    ) -> List[GraphVariable]:
+        """Overwrites the graph variables which are shared by all listeners,
+        see :mod:`~story_graph.graph_variables`.
+        """
+        await graphql_check_authenticated(info)
+        for graph_variable in graph_variables:
+            await GraphVariables(graph_variable.graph_uuid).set(
+                graph_variable.key, graph_variable.value
+            )
+        return [
+            GraphVariable(key=graph_variable.key, value=graph_variable.value)
+            for graph_variable in graph_variables
+        ]
+
+    @strawberry.mutation
+    async def increment_graph_variable(
+        self, info, graph_uuid: uuid.UUID, key: str, amount: int = 1
+    ) -> GraphVariable:
+        """Atomically increments a graph variable, e.g. to count votes.
+
+        As any listener can call this without being logged in, it is limited to
+        public visible graphs (see :func:`~get_listener_graph`) and to the keys
+        which the graph declares within
+        :attr:`~story_graph.models.Graph.incrementable_graph_variables`,
+        so a listener can neither create arbitrary variables nor tamper with
+        variables the graph relies on otherwise.
+        An anonymous listener can only change a variable by one per call, yet
+        nothing keeps a listener from calling this repeatedly, so the value
+        should be considered as an estimate and not as a trusted count.
+        """
+        graph = await get_listener_graph(info, graph_uuid)
+        if key not in graph.incrementable_graph_variable_keys:
+            raise PermissionDenied()
+        if abs(amount) > 1:
+            await graphql_check_authenticated(info)
+        value = await GraphVariables(graph_uuid).increment(key, amount)
+        return GraphVariable(key=key, value=str(value))
+
     @strawberry.mutation
     async def create_node_door(
         self,
@@ -583,6 +706,7 @@ class Subscription:
         self,
         info: Info,
         graph_uuid: uuid.UUID,
+        reconnect_token: Optional[uuid.UUID] = None,
     ) -> AsyncGenerator[StreamInfoResponse, None]:  # type: ignore
         """Used within the frontend to attach a user to a stream.
         :class:`~story_graph.engine.Engine` contains the specifics of how the iteration over a
@@ -592,20 +716,48 @@ class Subscription:
         :class:~stream.models.Stream` will be incremented which indicates
         if a given stream is free or used.
         Upon connection stop this will be decremented again.
+
+        A listener who lost the connection can pass the ``reconnectToken`` of
+        the last ``StreamInfo`` in order to re-attach to the same stream,
+        which resumes from the node where the connection got lost.
         """
         consumer: GraphQLWSConsumerInjector = info.context["ws"]
 
         graph = await story_graph_models.Graph.objects.aget(uuid=graph_uuid)
 
-        try:
-            stream = await stream_models.Stream.objects.aget_free_stream(graph)
-            log.info(f"Attached to stream {stream.uuid}")
-        except NoStreamAvailableException:
-            log.error(f"No stream is available for graph {graph.name}")
-            yield NoStreamAvailable()
-            return
+        shared_stream = (
+            graph.stream_assignment_policy
+            == story_graph_models.Graph.StreamAssignmentPolicy.ONE_GRAPH_ONE_STREAM
+        )
+
+        stream: Optional[stream_models.Stream] = None
+        if reconnect_token:
+            try:
+                stream = await stream_models.Stream.objects.aget_reconnect_stream(
+                    graph, reconnect_token
+                )
+                log.info(f"Reconnected to stream {stream.uuid}")
+            except stream_models.Stream.DoesNotExist as e:
+                log.info(f"Could not reconnect to stream: {e}")
+        resume = stream is not None
+
+        if stream is None:
+            try:
+                stream = await stream_models.Stream.objects.aget_free_stream(graph)
+                log.info(f"Attached to stream {stream.uuid}")
+            except NoStreamAvailableException:
+                log.error(f"No stream is available for graph {graph.name}")
+                yield NoStreamAvailable()
+                return
+
+        counted = False
 
         async def cleanup():
+            nonlocal counted
+            # a stop signal, a disconnect and a lost claim only count once
+            if not counted:
+                return
+            counted = False
             await stream.decrement_num_listeners()
 
         async def cleanup_on_stop(**kwargs: Dict[str, str]):
@@ -619,33 +771,76 @@ class Subscription:
                     log.info("Stop a stream due to a stop signal")
                     await cleanup()
 
-        with db_logging.LogContext(db_logging.LogKeyEnum.STREAM, stream):
-            engine = Engine(
-                graph=graph,
-                stream=stream,
-            )
-
-            await stream.increment_num_listeners()
-
-            consumer.disconnect_callback = cleanup
-            consumer.receive_callback = cleanup_on_stop
-
-            # send a first stream info response so the front-end has
-            # received information that streaming has/can be started,
-            # see https://github.com/Gencaster/gencaster/issues/483
-            # otherwise this can result in a dead end if we await
-            # a stream variable which is set from the frontend
-            yield StreamInfo(stream=stream, stream_instruction=None)  # type: ignore
-
-            async for instruction in engine.start(max_steps=int(10e10)):
-                if type(instruction) == Dialog:
-                    yield instruction
-                else:
-                    yield StreamInfo(
+        # a listener may reconnect while the subscription of its old
+        # connection has not noticed the disconnect yet, so only one
+        # subscription is allowed to run an engine on a stream
+        async with StreamClaim(stream.uuid, exclusive=not shared_stream) as claim:
+            with db_logging.LogContext(db_logging.LogKeyEnum.STREAM, stream):
+                # needs to be decided before the listener gets counted,
+                # see :class:`~story_graph.engine.Engine`
+                run_cleanup_procedure = stream.num_listeners == 0
+                await stream.increment_num_listeners()
+                counted = True
+
+                consumer.disconnect_callback = cleanup
+                consumer.receive_callback = cleanup_on_stop
+
+                # send a first stream info response so the front-end has
+                # received information that streaming has/can be started,
+                # see https://github.com/Gencaster/gencaster/issues/483
+                # otherwise this can result in a dead end if we await
+                # a stream variable which is set from the frontend
+                yield StreamInfo(stream=stream, stream_instruction=None)  # type: ignore
+
+                if resume and not run_cleanup_procedure:
+                    # the engine of the old connection writes its checkpoint
+                    # once it has been stopped
+                    await claim.wait_for_release()
+                    await stream.arefresh_from_db(fields=["checkpoint_node"])
+
+                def start_engine() -> AsyncIterator[Any]:
+                    if settings.ENGINE_WORKERS:
+                        # the engine runs on a worker, see story_graph.worker
+                        return relay_engine(
+                            graph,
+                            stream,  # type: ignore
+                            resume=resume,
+                            run_cleanup_procedure=run_cleanup_procedure,
+                        )
+                    # do not keep a reference on the engine, so it gets
+                    # released if the stream gets parked
+                    return Engine(
+                        graph=graph,
                         stream=stream,  # type: ignore
-                        stream_instruction=instruction,  # type: ignore
-                    )
-            yield GraphDeadEnd()
+                        resume=resume,
+                        run_cleanup_procedure=run_cleanup_procedure,
+                    ).start(max_steps=int(10e10))
+
+                instructions: AsyncIterator[Any]
+                if shared_stream:
+                    # all listeners receive the events of a single engine,
+                    # see story_graph.broadcast
+                    instructions = SharedEngine.subscribe(stream.uuid, start_engine)
+                else:
+                    instructions = start_engine()
+
+                async for instruction in claim.guard(instructions):
+                    if type(instruction) == Dialog:
+                        yield instruction
+                    else:
+                        yield StreamInfo(
+                            stream=stream,  # type: ignore
+                            stream_instruction=instruction,  # type: ignore
+                        )
+                # halts on a blocking node until the listener disconnects,
+                # only an explicit release of the parking ends the stream
+                await claim.run(ParkedStreams.wait(stream.uuid))
+                if claim.lost:
+                    log.info(f"Stop stream {stream.uuid} as it got claimed again")
+                    # the listener has moved to the new subscription
+                    await cleanup()
+                    return
+                yield GraphDeadEnd()
 
     @strawberry.subscription
     async def stream_logs(self, info: Info, stream_uuid: Optional[uuid.UUID] = None, stream_point_uuid: Optional[uuid.UUID] = None) -> AsyncGenerator[StreamLog, None]:  # type: ignore
@@ -174,7 +174,54 @@ CHANNEL_LAYERS = {
     },
 }
 
+# see story_graph.graph_variables
+GRAPH_VARIABLES = {
+    "BACKEND": "story_graph.graph_variables.RedisGraphVariableBackend",
+    "CONFIG": {
+        "url": os.environ.get("GRAPH_VARIABLES_REDIS_URL", "redis://redis:6379/1"),
+    },
+}
+
 STREAM_MAX_BEACON_SEC = 60
+# seconds in which a listener can resume a stream after losing the connection
+STREAM_RECONNECT_SEC = int(os.environ.get("STREAM_RECONNECT_SEC", 300))
+
+# see story_graph.profiler
+ENGINE_PROFILING = os.environ.get("ENGINE_PROFILING", "0") == "1"
+ENGINE_SLOW_CELL_SEC = float(os.environ.get("ENGINE_SLOW_CELL_SEC", 5.0))
+
+# see story_graph.pacing
+ENGINE_MAX_STEP_DELAY_SEC = float(os.environ.get("ENGINE_MAX_STEP_DELAY_SEC", 5.0))
+
+# see story_graph.worker
+ENGINE_WORKERS = os.environ.get("ENGINE_WORKERS", "0") == "1"
+ENGINE_WORKER_START_TIMEOUT = float(os.environ.get("ENGINE_WORKER_START_TIMEOUT", 5.0))
+
+# see story_graph.sandbox
+ENGINE_SANDBOX = os.environ.get("ENGINE_SANDBOX", "0") == "1"
+ENGINE_SANDBOX_PROCESSES = int(os.environ.get("ENGINE_SANDBOX_PROCESSES", 2))
+ENGINE_SANDBOX_CPU_SEC = float(os.environ.get("ENGINE_SANDBOX_CPU_SEC", 5.0))
+ENGINE_SANDBOX_TIMEOUT_SEC = float(os.environ.get("ENGINE_SANDBOX_TIMEOUT_SEC", 30.0))
+ENGINE_SANDBOX_MEMORY_MB = int(os.environ.get("ENGINE_SANDBOX_MEMORY_MB", 512))
+
+# see story_graph.http_client
+ENGINE_HTTP_TIMEOUT_SEC = float(os.environ.get("ENGINE_HTTP_TIMEOUT_SEC", 10.0))
+ENGINE_HTTP_MAX_CONNECTIONS = int(os.environ.get("ENGINE_HTTP_MAX_CONNECTIONS", 20))
+ENGINE_HTTP_MAX_CONNECTIONS_PER_HOST = int(
+    os.environ.get("ENGINE_HTTP_MAX_CONNECTIONS_PER_HOST", 4)
+)
+ENGINE_HTTP_CACHE_TTL_SEC = float(os.environ.get("ENGINE_HTTP_CACHE_TTL_SEC", 60.0))
+
+# see stream.tts
+TEXT_TO_SPEECH = {
+    "BACKEND": "stream.tts.GoogleTextToSpeechBackend",
+    "MAX_WORKERS": int(os.environ.get("TEXT_TO_SPEECH_MAX_WORKERS", 8)),
+    "CACHE_SIZE": int(os.environ.get("TEXT_TO_SPEECH_CACHE_SIZE", 1024)),
+}
+
+# see stream.ssml
+TTS_CHUNK_CHARS = int(os.environ.get("TTS_CHUNK_CHARS", 400))
+TTS_CHUNK_CONCURRENCY = int(os.environ.get("TTS_CHUNK_CONCURRENCY", 4))
 
 STRAWBERRY_DJANGO = {
     "FIELD_DESCRIPTION_FROM_HELP_TEXT": True,
@@ -15,3 +15,7 @@ DATABASES = {
 }
 
 CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+GRAPH_VARIABLES = {
+    "BACKEND": "story_graph.graph_variables.InMemoryGraphVariableBackend",
+}
@@ -23,6 +23,12 @@ DATABASES = {
 
 CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
 
+GRAPH_VARIABLES = {
+    "BACKEND": "story_graph.graph_variables.InMemoryGraphVariableBackend",
+}
+
+TEXT_TO_SPEECH = {"BACKEND": "stream.tts.FakeTextToSpeechBackend"}
+
 INSTALLED_APPS += [
     "debug_toolbar",
     "django_extensions",  # used for generating model image graphs
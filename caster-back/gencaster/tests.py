@@ -1,11 +1,17 @@
+import asyncio
+import contextvars
 import logging
 import uuid
+from typing import Optional
 from unittest import mock
 
 from asgiref.sync import async_to_sync, sync_to_async
 from django.test import TransactionTestCase
 
+from story_graph.graph_variables import GraphVariables
 from story_graph.models import AudioCell, CellType, Edge, Graph, Node, ScriptCell
+from story_graph.parking import ParkedStreams
+from story_graph.profiler import GraphProfile, ProfileSample
 from story_graph.tests import (
     AudioCellTestCase,
     EdgeTestCase,
@@ -13,10 +19,11 @@ from story_graph.tests import (
     NodeTestCase,
     ScriptCellTestCase,
 )
-from stream.models import AudioFile
-from stream.tests import AudioFileTestCase
+from stream.models import AudioFile, Stream
+from stream.tests import AudioFileTestCase, StreamPointTestCase
 
 from . import db_logging
+from .distributor import StreamClaim
 from .schema import schema
 
 log = logging.getLogger(__name__)
@@ -121,6 +128,7 @@ class SchemaTestCase(TransactionTestCase):
             mutation TestMutation($nodeDoorInUuid:UUID!, $nodeDoorOutUuid:UUID!) {
                 addEdge(newEdge: {nodeDoorInUuid: $nodeDoorInUuid, nodeDoorOutUuid: $nodeDoorOutUuid}) {
                     uuid
+                    weight
                 }
             }
         """
@@ -135,6 +143,7 @@ class SchemaTestCase(TransactionTestCase):
         )
 
         self.assertIsNone(resp.errors)
+        self.assertEqual(resp.data["addEdge"]["weight"], 1.0)  # type: ignore
 
         self.assertEqual(await Edge.objects.all().acount(), 1)
 
@@ -168,6 +177,259 @@ class SchemaTestCase(TransactionTestCase):
         self.assertIsNone(resp.errors)
         self.assertDictEqual(resp.data, {"graphs": []})  # type: ignore
 
+    ENGINE_PROFILE_QUERY = """
+        query TestQuery($graphUuid: UUID!) {
+            engineProfile(graphUuid: $graphUuid) {
+                category
+                count
+                histogram
+            }
+        }
+    """
+
+    @async_to_sync
+    async def test_engine_profile(self):
+        graph_uuid = uuid.uuid4()
+        GraphProfile.get(graph_uuid).add(
+            ProfileSample(node_uuid=uuid.uuid4(), category="python", wall_time=0.02)
+        )
+        resp = await schema.execute(
+            self.ENGINE_PROFILE_QUERY,
+            variable_values={"graphUuid": str(graph_uuid)},
+            context_value=self.get_login_context(),
+        )
+        self.assertIsNone(resp.errors)
+        self.assertEqual(
+            resp.data["engineProfile"],  # type: ignore
+            [{"category": "python", "count": 1, "histogram": [0, 0, 1] + [0] * 7}],
+        )
+
+        resp = await schema.execute(
+            self.ENGINE_PROFILE_QUERY,
+            variable_values={"graphUuid": str(graph_uuid)},
+            context_value=self.get_login_context(is_authenticated=False),
+        )
+        self.assertGreaterEqual(len(resp.errors), 1)  # type: ignore
+
+        # the profiles of the engine workers are not accessible
+        with self.settings(ENGINE_WORKERS=True):
+            resp = await schema.execute(
+                self.ENGINE_PROFILE_QUERY,
+                variable_values={"graphUuid": str(graph_uuid)},
+                context_value=self.get_login_context(),
+            )
+        self.assertIn("simulate_graph", resp.errors[0].message)  # type: ignore
+
+    GRAPH_VARIABLES_QUERY = """
+        query TestQuery($graphUuid: UUID!) {
+            graphVariables(graphUuid: $graphUuid) {
+                key
+                value
+            }
+        }
+    """
+
+    SET_GRAPH_VARIABLES_MUTATION = """
+        mutation TestMutation($graphVariables: [GraphVariableInput!]!) {
+            setGraphVariables(graphVariables: $graphVariables) {
+                key
+                value
+            }
+        }
+    """
+
+    INCREMENT_GRAPH_VARIABLE_MUTATION = """
+        mutation TestMutation($graphUuid: UUID!, $key: String!, $amount: Int!) {
+            incrementGraphVariable(graphUuid: $graphUuid, key: $key, amount: $amount) {
+                key
+                value
+            }
+        }
+    """
+
+    @async_to_sync
+    async def test_graph_variables(self):
+        graph = await sync_to_async(GraphTestCase.get_graph)(
+            public_visible=True, incrementable_graph_variables="votes, likes"
+        )
+        graph_uuid = str(graph.uuid)
+        resp = await schema.execute(
+            self.SET_GRAPH_VARIABLES_MUTATION,
+            variable_values={
+                "graphVariables": [
+                    {"graphUuid": graph_uuid, "key": "votes", "value": "1"}
+                ]
+            },
+            context_value=self.get_login_context(),
+        )
+        self.assertIsNone(resp.errors)
+
+        resp = await schema.execute(
+            self.INCREMENT_GRAPH_VARIABLE_MUTATION,
+            variable_values={"graphUuid": graph_uuid, "key": "votes", "amount": 2},
+            context_value=self.get_login_context(),
+        )
+        self.assertIsNone(resp.errors)
+        self.assertEqual(
+            resp.data["incrementGraphVariable"],  # type: ignore
+            {"key": "votes", "value": "3"},
+        )
+
+        # a listener may only count by one
+        resp = await schema.execute(
+            self.INCREMENT_GRAPH_VARIABLE_MUTATION,
+            variable_values={"graphUuid": graph_uuid, "key": "votes", "amount": 2},
+            context_value=self.get_login_context(is_authenticated=False),
+        )
+        self.assertGreaterEqual(len(resp.errors), 1)  # type: ignore
+
+        resp = await schema.execute(
+            self.GRAPH_VARIABLES_QUERY,
+            variable_values={"graphUuid": graph_uuid},
+            context_value=self.get_login_context(is_authenticated=False),
+        )
+        self.assertIsNone(resp.errors)
+        self.assertEqual(
+            resp.data["graphVariables"],  # type: ignore
+            [{"key": "votes", "value": "3"}],
+        )
+
+    @async_to_sync
+    async def test_graph_variables_of_listeners(self):
+        graph = await sync_to_async(GraphTestCase.get_graph)(
+            public_visible=True, incrementable_graph_variables="votes"
+        )
+        hidden_graph = await sync_to_async(GraphTestCase.get_graph)(
+            public_visible=False, incrementable_graph_variables="votes"
+        )
+        await GraphVariables(graph.uuid).set("score", "10")
+
+        for graph_uuid, key, allowed in [
+            (graph.uuid, "votes", True),
+            # not declared as incrementable
+            (graph.uuid, "score", False),
+            (hidden_graph.uuid, "votes", False),
+            (uuid.uuid4(), "votes", False),
+        ]:
+            resp = await schema.execute(
+                self.INCREMENT_GRAPH_VARIABLE_MUTATION,
+                variable_values={"graphUuid": str(graph_uuid), "key": key, "amount": 1},
+                context_value=self.get_login_context(is_authenticated=False),
+            )
+            self.assertEqual(resp.errors is None, allowed, (graph_uuid, key))
+        self.assertEqual(await GraphVariables(graph.uuid).get("score"), "10")
+
+        resp = await schema.execute(
+            self.GRAPH_VARIABLES_QUERY,
+            variable_values={"graphUuid": str(hidden_graph.uuid)},
+            context_value=self.get_login_context(is_authenticated=False),
+        )
+        self.assertGreaterEqual(len(resp.errors), 1)  # type: ignore
+        resp = await schema.execute(
+            self.GRAPH_VARIABLES_QUERY,
+            variable_values={"graphUuid": str(hidden_graph.uuid)},
+            context_value=self.get_login_context(),
+        )
+        self.assertIsNone(resp.errors)
+
+    STREAM_INFO_SUBSCRIPTION = """
+        subscription TestSubscription($graphUuid: UUID!) {
+            streamInfo(graphUuid: $graphUuid) {
+                __typename
+            }
+        }
+    """
+
+    @async_to_sync
+    async def test_stream_info_cleanup_procedure(self):
+        graph = await sync_to_async(GraphTestCase.get_graph)()
+        await graph.acreate_entry_node()
+        await sync_to_async(StreamPointTestCase.get_stream_point)()
+
+        with mock.patch(
+            "story_graph.engine.Engine.cleanup_sc_procedure"
+        ) as cleanup_sc_procedure:
+            subscription = await schema.subscribe(
+                self.STREAM_INFO_SUBSCRIPTION,
+                variable_values={"graphUuid": str(graph.uuid)},
+                context_value={"ws": mock.MagicMock()},
+            )
+            results = [result async for result in subscription]  # type: ignore
+        self.assertTrue(all(result.errors is None for result in results))
+        # the first listener of a stream resets SuperCollider
+        cleanup_sc_procedure.assert_called_once()
+
+    STREAM_INFO_RECONNECT_SUBSCRIPTION = """
+        subscription TestSubscription($graphUuid: UUID!, $reconnectToken: UUID) {
+            streamInfo(graphUuid: $graphUuid, reconnectToken: $reconnectToken) {
+                __typename
+            }
+        }
+    """
+
+    @async_to_sync
+    async def test_stream_info_reconnect_stops_old_engine(self):
+        graph = await sync_to_async(GraphTestCase.get_graph)()
+        entry_node = await graph.acreate_entry_node()
+        entry_node.is_blocking_node = True
+        await sync_to_async(entry_node.save)()
+        await sync_to_async(StreamPointTestCase.get_stream_point)()
+
+        old_ws = mock.MagicMock()
+        with mock.patch("story_graph.engine.Engine.cleanup_sc_procedure"):
+            old_subscription = await schema.subscribe(
+                self.STREAM_INFO_RECONNECT_SUBSCRIPTION,
+                variable_values={"graphUuid": str(graph.uuid)},
+                context_value={"ws": old_ws},
+            )
+            await old_subscription.__anext__()  # type: ignore
+            stream = await Stream.objects.aget(num_listeners=1)
+            # the old subscription halts on the blocking node
+            old_next = asyncio.ensure_future(old_subscription.__anext__())  # type: ignore
+            while ParkedStreams.get(stream.uuid) is None:
+                await asyncio.sleep(0.01)
+
+            new_subscription = await schema.subscribe(
+                self.STREAM_INFO_RECONNECT_SUBSCRIPTION,
+                variable_values={
+                    "graphUuid": str(graph.uuid),
+                    "reconnectToken": str(stream.reconnect_token),
+                },
+                context_value={"ws": mock.MagicMock()},
+            )
+            result = await new_subscription.__anext__()  # type: ignore
+            self.assertEqual(result.data["streamInfo"]["__typename"], "StreamInfo")  # type: ignore
+
+            # the old subscription stops without a dead end
+            with self.assertRaises(StopAsyncIteration):
+                await asyncio.wait_for(old_next, 5.0)
+            await sync_to_async(stream.refresh_from_db)()
+            self.assertEqual(stream.num_listeners, 1)
+
+            # the late disconnect of the old websocket is not counted again
+            # and does not overwrite the checkpoint
+            await old_ws.disconnect_callback()
+            await sync_to_async(stream.refresh_from_db)()
+            self.assertEqual(stream.num_listeners, 1)
+            self.assertEqual(stream.checkpoint_node_id, entry_node.uuid)  # type: ignore
+            await new_subscription.aclose()  # type: ignore
+        ParkedStreams.clear()
+
+    @async_to_sync
+    async def test_set_graph_variables_no_auth(self):
+        graph_uuid = uuid.uuid4()
+        resp = await schema.execute(
+            self.SET_GRAPH_VARIABLES_MUTATION,
+            variable_values={
+                "graphVariables": [
+                    {"graphUuid": str(graph_uuid), "key": "votes", "value": "1"}
+                ]
+            },
+            context_value=self.get_login_context(is_authenticated=False),
+        )
+        self.assertGreaterEqual(len(resp.errors), 1)  # type: ignore
+        self.assertIsNone(await GraphVariables(graph_uuid).get("votes"))
+
     EDGE_DELETE_MUTATION = """
         mutation TestMutation($edgeUuid: UUID!) {
             deleteEdge(edgeUuid: $edgeUuid)
@@ -323,6 +585,26 @@ class SchemaTestCase(TransactionTestCase):
 
         self.assertEqual("Hello vinzenz!", script_cell.cell_code)
 
+    @async_to_sync
+    async def test_update_script_cell_concurrent_group(self):
+        script_cell: ScriptCell = await sync_to_async(
+            ScriptCellTestCase.get_script_cell
+        )(concurrent_group=1)
+
+        for group in [2, None]:
+            resp = await schema.execute(
+                self.UPDATE_SCRIPT_CELL,
+                variable_values={
+                    "scriptCellInputs": [
+                        {"uuid": str(script_cell.uuid), "concurrentGroup": group}
+                    ],
+                },
+                context_value=self.get_login_context(),
+            )
+            self.assertIsNone(resp.errors)
+            await sync_to_async(script_cell.refresh_from_db)()
+            self.assertEqual(script_cell.concurrent_group, group)
+
     @async_to_sync
     async def test_update_script_cell_no_auth(self):
         script_cell: ScriptCell = await sync_to_async(
@@ -524,3 +806,42 @@ class DatabaseLoggingTestCase(TransactionTestCase):
         self.assertEqual(stream_point, lm.records[0].stream_point)  # type: ignore
         with self.assertRaises(AttributeError):
             lm.records[1].stream_point  # type: ignore
+
+
+class StreamClaimTestCase(TransactionTestCase):
+    async def test_guard_keeps_context(self):
+        sample: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+            "sample", default=None
+        )
+
+        async def steps():
+            sample.set("sample")
+            for _ in range(3):
+                yield sample.get()
+
+        async with StreamClaim(uuid.uuid4()) as claim:
+            values = [value async for value in claim.guard(steps())]
+        self.assertEqual(values, ["sample"] * 3)
+
+    async def test_guard_stops_on_claim(self):
+        stream_uuid = uuid.uuid4()
+        closed = asyncio.Event()
+
+        async def steps():
+            try:
+                while True:
+                    yield 1
+                    await asyncio.sleep(0.01)
+            finally:
+                closed.set()
+
+        async with StreamClaim(stream_uuid) as claim:
+            values = []
+            async for value in claim.guard(steps()):
+                values.append(value)
+                if len(values) == 2:
+                    async with StreamClaim(stream_uuid):
+                        while not claim.lost:
+                            await asyncio.sleep(0.01)
+        self.assertEqual(values, [1, 1])
+        self.assertTrue(closed.is_set())
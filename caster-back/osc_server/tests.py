@@ -1,5 +1,6 @@
 import uuid
 from typing import Any, Dict, List, Optional, Tuple
+from unittest import mock
 
 from django.test import TestCase
 from pydantic import ValidationError
@@ -80,6 +81,20 @@ class OscServerTestCase(TestCase):
         instruction.refresh_from_db()
         self.assertEqual(instruction.state, StreamInstruction.InstructionState.FINISHED)
 
+    @mock.patch("gencaster.distributor.GenCasterChannel.send_stream_instruction_update")
+    def test_acknowledge_publishes_state(self, send_update: mock.AsyncMock):
+        instruction = StreamInstructionTestCase.get_stream_instruction()
+        osc_message = self.get_message(
+            {
+                "uuid": str(instruction.uuid),
+                "status": "FINISHED",
+            }
+        )
+        self.server.acknowledge_handler(self.get_address(), "/ack", *osc_message)
+        send_update.assert_called_once_with(
+            instruction.uuid, StreamInstruction.InstructionState.FINISHED
+        )
+
     def get_beacon_message(self) -> Dict[str, Any]:
         return {
             "synth_port": 5000,
@@ -22,4 +22,43 @@ Graph
 
 .. automodule:: story_graph.models
     :members:
+
+.. automodule:: story_graph.snapshot
+    :members:
+
+.. automodule:: story_graph.code_cache
+    :members:
+
+.. automodule:: story_graph.variable_store
+    :members:
+
+.. automodule:: story_graph.simulator
+    :members:
+
+.. automodule:: story_graph.profiler
+    :members:
+
+.. automodule:: story_graph.worker
+    :members:
+
+.. automodule:: story_graph.parking
+    :members:
+
+.. automodule:: story_graph.broadcast
+    :members:
+
+.. automodule:: story_graph.sandbox
+    :members:
+
+.. automodule:: story_graph.http_client
+    :members:
+
+.. automodule:: story_graph.pacing
+    :members:
+
+.. automodule:: story_graph.graph_variables
+    :members:
+
+.. automodule:: story_graph.prewarm
+    :members:
 """
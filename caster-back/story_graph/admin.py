@@ -1,6 +1,7 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
 from .models import AudioCell, Edge, Graph, Node, NodeDoor, ScriptCell
+from .prewarm import prewarm_graphs_in_background
 
 
 class NodeInline(admin.TabularInline):
@@ -70,6 +71,20 @@ class GraphAdmin(admin.ModelAdmin):
 
     list_filter = ["public_visible"]
 
+    actions = ["prewarm_text_to_speech"]
+
+    @admin.action(description="Synthesize the static markdown of the graphs ahead")
+    def prewarm_text_to_speech(self, request, queryset):
+        graphs = list(queryset)
+        prewarm_graphs_in_background(graphs)
+        self.message_user(
+            request,
+            f"Queued the synthesis of {', '.join(graph.name for graph in graphs)}. "
+            "The reports get logged, use the management command prewarm_graph "
+            "to wait for a report.",
+            level=messages.INFO,
+        )
+
 
 @admin.register(Node)
 class NodeAdmin(admin.ModelAdmin):
@@ -79,12 +94,14 @@ class NodeAdmin(admin.ModelAdmin):
         "graph",
         "is_entry_node",
         "is_blocking_node",
+        "is_reactive_node",
     ]
 
     list_filter = [
         "graph",
         "is_entry_node",
         "is_blocking_node",
+        "is_reactive_node",
     ]
 
     search_fields = [
@@ -103,6 +120,7 @@ class EdgeAdmin(admin.ModelAdmin):
         "uuid",
         "in_node_door",
         "out_node_door",
+        "weight",
     ]
 
     search_fields = [
@@ -126,6 +144,7 @@ class ScriptCellAdmin(admin.ModelAdmin):
         "node",
         "cell_order",
         "cell_type",
+        "concurrent_group",
     ]
 
     list_filter = [
@@ -0,0 +1,139 @@
+"""
+Broadcast
+=========
+
+Graphs with the stream assignment policy
+:attr:`~story_graph.models.Graph.StreamAssignmentPolicy.ONE_GRAPH_ONE_STREAM`
+share a single :class:`~stream.models.Stream` among all listeners.
+
+Instead of running an :class:`~story_graph.engine.Engine` per listener
+on the same stream, :class:`~SharedEngine` runs one engine per stream and
+broadcasts its events to all subscriptions, so the execution cost does not
+depend on the number of listeners.
+Once the shared engine halts on a blocking node all listeners wait on the
+same parked stream, see :mod:`~story_graph.parking`.
+"""
+
+import asyncio
+import logging
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, Optional, Set, Union
+from uuid import UUID
+
+from stream.frontend_types import Dialog
+from stream.models import StreamInstruction
+
+from .engine import FINISHED_INSTRUCTION_STATES
+from .parking import ParkedStreams
+
+log = logging.getLogger(__name__)
+
+Event = Union[StreamInstruction, Dialog]
+
+# marks the end of the engine within the queue of a subscriber
+_END = object()
+
+
+class SharedEngine:
+    """Iterates over the instructions of a single engine and puts each event
+    into the queue of every subscriber.
+
+    A listener who joins later receives the latest instruction first if it
+    has not finished yet, so it knows the current state of the stream.
+    A :class:`~stream.frontend_types.Dialog` is not replayed, as it has been
+    meant for the listeners at that time and may have been answered already.
+    The engine gets stopped once the last subscriber has left.
+    """
+
+    _engines: Dict[UUID, "SharedEngine"] = {}
+
+    def __init__(self, stream_uuid: UUID, instructions: AsyncIterator[Event]) -> None:
+        self.stream_uuid = stream_uuid
+        self._instructions = instructions
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._latest: Optional[Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.done: bool = False
+
+    @classmethod
+    def get(cls, stream_uuid: UUID) -> Optional["SharedEngine"]:
+        return cls._engines.get(stream_uuid)
+
+    @classmethod
+    async def subscribe(
+        cls,
+        stream_uuid: UUID,
+        start: Callable[[], AsyncIterator[Event]],
+    ) -> AsyncGenerator[Event, None]:
+        """Yields the events of the shared engine of the stream.
+
+        :param start: Creates the instructions of a new engine, only called
+            if no engine is running on the stream yet, e.g.
+            :func:`~story_graph.engine.Engine.start`
+        """
+        shared = cls._engines.get(stream_uuid)
+        if shared is None or shared.done:
+            if ParkedStreams.get(stream_uuid):
+                # the engine halts on a blocking node, so there is nothing to run
+                return
+            shared = cls._engines[stream_uuid] = cls(stream_uuid, start())
+        else:
+            log.debug(f"Join shared engine of stream {stream_uuid}")
+        latest = shared._latest
+        queue = shared._add_subscriber()
+        try:
+            if latest is not None and await cls._is_current(latest):
+                yield latest
+            while (event := await queue.get()) is not _END:
+                yield event
+        finally:
+            shared._remove_subscriber(queue)
+
+    @staticmethod
+    async def _is_current(event: Event) -> bool:
+        if not isinstance(event, StreamInstruction):
+            return True
+        try:
+            await event.arefresh_from_db(fields=["state"])
+        except StreamInstruction.DoesNotExist:
+            return False
+        return event.state not in FINISHED_INSTRUCTION_STATES
+
+    @property
+    def num_subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def _add_subscriber(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def _remove_subscriber(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+        if self._subscribers or self.done:
+            return
+        log.debug(f"Stop shared engine of stream {self.stream_uuid}")
+        self._close()
+        if self._task:
+            self._task.cancel()
+
+    def _close(self) -> None:
+        self.done = True
+        if self._engines.get(self.stream_uuid) is self:
+            del self._engines[self.stream_uuid]
+
+    async def _run(self) -> None:
+        try:
+            async for event in self._instructions:
+                self._latest = None if isinstance(event, Dialog) else event
+                for queue in self._subscribers:
+                    queue.put_nowait(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(f"Shared engine of stream {self.stream_uuid} failed: {e}")
+        finally:
+            self._close()
+            for queue in self._subscribers:
+                queue.put_nowait(_END)
@@ -0,0 +1,84 @@
+"""
+Code cache
+==========
+
+The Python code of a :class:`~story_graph.models.ScriptCell` gets executed on
+every visit of its :class:`~story_graph.models.Node`.
+As a graph can loop over the same nodes for hours, the compiled code objects
+are stored in a bounded LRU cache which is keyed by a hash of the code,
+so the code only needs to be parsed and compiled on its first visit.
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import CodeType
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class CodeCacheInfo:
+    hits: int
+    misses: int
+    size: int
+    max_size: int
+
+
+class CodeCache:
+    """A thread safe LRU cache of compiled code objects.
+
+    :param max_size: Number of code objects which are kept, the least recently
+        used code object will be evicted once this limit is exceeded.
+    """
+
+    def __init__(self, max_size: int = 1024) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._code: "OrderedDict[str, CodeType]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(source: str, mode: str) -> str:
+        return f"{mode}:{hashlib.sha256(source.encode()).hexdigest()}"
+
+    def compile(self, source: str, mode: str = "exec") -> CodeType:
+        """Returns the compiled code of ``source``, see :func:`compile` for
+        ``mode``.
+        Raises a :class:`SyntaxError` on invalid code, which will not be cached.
+        """
+        key = self._get_key(source, mode)
+        with self._lock:
+            if (code := self._code.get(key)) is not None:
+                self._code.move_to_end(key)
+                self.hits += 1
+                return code
+        code = compile(source, "<string>", mode)
+        with self._lock:
+            self.misses += 1
+            self._code[key] = code
+            self._code.move_to_end(key)
+            while len(self._code) > self.max_size:
+                self._code.popitem(last=False)
+        return code
+
+    def info(self) -> CodeCacheInfo:
+        with self._lock:
+            return CodeCacheInfo(
+                hits=self.hits,
+                misses=self.misses,
+                size=len(self._code),
+                max_size=self.max_size,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._code.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+code_cache = CodeCache()
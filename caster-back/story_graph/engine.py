@@ -5,24 +5,82 @@ Engine
 """
 
 import asyncio
+import itertools
 import logging
 import random
 import time
-from copy import deepcopy
+from contextlib import nullcontext
 from datetime import datetime, timedelta
-from typing import Any, AsyncGenerator, Dict, Optional, Union
+from functools import partial
+from types import CodeType
+from typing import (
+    Any,
+    AsyncGenerator,
+    ContextManager,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Union,
+)
+from uuid import UUID
 
-import requests
 from asgiref.sync import sync_to_async
-
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from gencaster.distributor import (
+    ChannelSubscription,
+    GenCasterChannel,
+    MissingChannelLayer,
+)
 from stream.frontend_types import Button, Checkbox, Dialog, Input, Text
-from stream.models import Stream, StreamInstruction, StreamVariable
-
-from .markdown_parser import md_to_ssml
-from .models import AudioCell, CellType, Graph, Node, NodeDoor, ScriptCell
+from stream.models import AudioFile, Stream, StreamInstruction, TextToSpeech
+from stream.ssml import split_ssml
+
+from .code_cache import code_cache
+from .graph_variables import GraphVariables
+from .http_client import deprecated_requests, http_client
+from .markdown_parser import is_static_markdown, md_to_ssml
+from .models import AudioCell, CellType, Graph, Node
+from .pacing import HotLoopPacer
+from .parking import ParkedStreams
+from .profiler import DOOR_EVALUATION, EngineProfiler, profile_wait
+from .sandbox import SandboxTimeout, ScriptCellSandbox, can_run_in_sandbox
+from .snapshot import (
+    GraphSnapshot,
+    GraphSnapshotCache,
+    NodeDoorSnapshot,
+    NodeSnapshot,
+    ScriptCellSnapshot,
+)
+from .variable_store import StreamVariableStore
 
 log = logging.getLogger(__name__)
 
+FINISHED_INSTRUCTION_STATES = [
+    StreamInstruction.InstructionState.FINISHED,
+    StreamInstruction.InstructionState.FAILURE,
+]
+
+
+# number of text to speech requests which run ahead at the same time per engine
+MAX_LOOKAHEAD_SYNTHESIS = 4
+
+
+def _synthesize(ssml_text: str, chunk_chars: int = 0) -> None:
+    """Runs outside of the thread of the engine so the current cell
+    does not need to wait for the lookahead.
+    """
+    try:
+        for chunk in split_ssml(ssml_text, chunk_chars):
+            TextToSpeech.create_from_text(chunk)
+    except Exception as e:
+        log.error(f"Could not synthesize text ahead: {e}")
+    finally:
+        close_old_connections()
+
 
 class ScriptCellTimeout(Exception):
     pass
@@ -56,6 +114,18 @@ class Engine:
         creating a clean environment.
         The default is ``None`` which will derive the necessary action based
         if there are already users on the stream (in which case no reset will be executed).
+    :param profile: Records the execution times of the cells and node doors,
+        see :mod:`~story_graph.profiler`.
+        Defaults to the ``ENGINE_PROFILING`` setting.
+    :param lookahead_synthesis: If ``True`` the static markdown of the nodes which follow
+        the current node will be converted to speech in the background,
+        see :func:`~story_graph.engine.Engine.synthesize_successors`.
+    :param resume: If ``True`` the execution continues on the checkpoint node of the stream,
+        which is stored upon entering a node, e.g. if a listener reconnects to the stream.
+        The cleanup procedure is skipped in this case.
+        Starts on the entry node if the stream has no checkpoint.
+    :param seed: Seed of the random generator which picks the edge to follow,
+        which makes the path through a graph reproducible.
     """
 
     def __init__(
@@ -64,12 +134,50 @@ class Engine:
         stream: Stream,
         raise_exceptions: bool = False,
         run_cleanup_procedure: Optional[bool] = None,
+        profile: Optional[bool] = None,
+        lookahead_synthesis: bool = True,
+        resume: bool = False,
+        seed: Optional[int] = None,
+        sandbox: Optional[bool] = None,
     ) -> None:
         self.graph: Graph = graph
         self.stream = stream
-        self._current_node: Node
+        self._current_node: Union[Node, NodeSnapshot]
+        # seconds to wait for a change of a stream variable, a blocking node
+        # only halts the stream if it is positive
         self.blocking_time: int = 60 * 60 * 3
+        # seconds to wait between jumping nodes
+        self.step_delay: float = 0.1
+        # upper bound of the delay on a cycle without progress
+        self.max_step_delay: float = settings.ENGINE_MAX_STEP_DELAY_SEC
+        # seconds between two writes of the checkpoint of the stream
+        self.checkpoint_interval: float = 5.0
+        self._stored_checkpoint: Optional[UUID] = getattr(
+            stream, "checkpoint_node_id", None
+        )
+        self._checkpoint_time: float = float("-inf")
         self.raise_exceptions = raise_exceptions
+        self.variable_store = StreamVariableStore(self.stream)
+        self.graph_variables = GraphVariables(self.graph.uuid)
+        self.lookahead_synthesis = lookahead_synthesis
+        self.resume = resume
+        self.random = random.Random(seed)
+        self.sandbox: Optional[ScriptCellSandbox] = None
+        if sandbox if sandbox is not None else settings.ENGINE_SANDBOX:
+            self.sandbox = ScriptCellSandbox.get(
+                processes=settings.ENGINE_SANDBOX_PROCESSES,
+                cpu_time=settings.ENGINE_SANDBOX_CPU_SEC,
+                timeout=settings.ENGINE_SANDBOX_TIMEOUT_SEC,
+                memory=settings.ENGINE_SANDBOX_MEMORY_MB,
+            )
+        self.profiler: Optional[EngineProfiler] = None
+        if profile if profile is not None else settings.ENGINE_PROFILING:
+            self.profiler = EngineProfiler(self.graph.uuid, self.stream)
+        # pending text to speech requests by their SSML text
+        self._synthesis_tasks: Dict[str, asyncio.Task] = {}
+        self._synthesis_semaphore = asyncio.Semaphore(MAX_LOOKAHEAD_SYNTHESIS)
+        self.chunk_chars: int = settings.TTS_CHUNK_CHARS
+        self._chunk_semaphore = asyncio.Semaphore(settings.TTS_CHUNK_CONCURRENCY)
         self.run_cleanup_procedure: bool
         if run_cleanup_procedure is not None:
             self.run_cleanup_procedure = run_cleanup_procedure
@@ -82,17 +190,17 @@ class Engine:
         Returns the associated :class:`~stream.models.StreamVariable` within
         this :class:`~stream.models.Stream` session.
 
+        The variables are served from :class:`~story_graph.variable_store.StreamVariableStore`,
+        so only the first call needs to query the database.
+
         .. todo::
 
             Could be a @property but this can be difficult in async contexts
             so we use explicit async via a getter method.
         """
-        v = {}
-        stream_variable: StreamVariable
-        async for stream_variable in self.stream.variables.all():
-            v[stream_variable.key] = stream_variable.value
-        return v
+        return await self.variable_store.aget_all()
 
+    @profile_wait
     async def wait_for_stream_variable(
         self, name: str, timeout: float = 100.0, update_speed: float = 0.5
     ):
@@ -101,6 +209,12 @@ class Engine:
         ``timeout`` this function will raise the exception
         :class:`ScriptCellTimeout`.
 
+        Any write of a :class:`~stream.models.StreamVariable` gets published via
+        :class:`~gencaster.distributor.GenCasterChannel`, so we only wake up
+        once the variable ``name`` has been set.
+        Only if no channel layer is available the variables are polled from
+        the database every ``update_speed`` seconds.
+
         .. danger::
 
             Within a script cell it is necessary to await this async function
@@ -111,26 +225,141 @@ class Engine:
 
         """
         log.debug(f"Wait for stream variable {name}")
+        try:
+            async with GenCasterChannel.subscribe_stream_variable_updates(
+                self.stream.uuid
+            ) as subscription:
+                # the variable could have been set before we subscribed
+                if await self.stream.variables.filter(key=name).aexists():
+                    return
+                try:
+                    await asyncio.wait_for(
+                        self._receive_stream_variable(subscription, name), timeout
+                    )
+                except asyncio.TimeoutError:
+                    raise ScriptCellTimeout()
+                return
+        except MissingChannelLayer:
+            log.warning(f"No channel layer available - poll for stream variable {name}")
+
         start_time = datetime.now()
         while True:
-            if (datetime.now() - start_time).seconds > timeout:
+            if (datetime.now() - start_time).total_seconds() > timeout:
                 raise ScriptCellTimeout()
             if name in (await self.get_stream_variables()).keys():
                 break
             await asyncio.sleep(update_speed)
 
+    @staticmethod
+    async def _receive_stream_variable(
+        subscription: ChannelSubscription, name: str
+    ) -> str:
+        async for message in subscription:
+            if message["key"] == name:
+                return str(message["value"])
+        raise MissingChannelLayer()
+
     async def execute_markdown_code(self, cell_code: str):
         """Runs the code of a markdown cell by parsing its content with the
         :class:`~story_graph.markdown_parser.GencasterRenderer`.
         """
         log.debug(f"Execute markdown code '{cell_code}'")
-        ssml_text = md_to_ssml(cell_code, await self.get_stream_variables())
-        instruction = await sync_to_async(self.stream.stream_point.speak_on_stream)(
-            ssml_text
+        ssml_text = md_to_ssml(
+            cell_code,
+            await self.get_stream_variables(),
+            # avoid the access of the shared store if not necessary
+            await self.graph_variables.get_all()
+            if "{graph_var}" in cell_code
+            else None,
         )
+        if synthesis_task := self._synthesis_tasks.get(ssml_text):
+            # avoid requesting the same text twice
+            await synthesis_task
+        chunks = split_ssml(ssml_text, self.chunk_chars)
+        if len(chunks) > 1:
+            async for instruction in self.speak_chunks(chunks):
+                yield instruction
+            return
+        instruction = await self.stream.stream_point.aspeak_on_stream(ssml_text)
         yield instruction
         await self.wait_for_finished_instruction(instruction)
 
+    async def _synthesize_chunk(self, ssml_text: str) -> AudioFile:
+        async with self._chunk_semaphore:
+            return (await TextToSpeech.acreate_from_text(ssml_text)).audio_file
+
+    async def speak_chunks(
+        self, chunks: List[str]
+    ) -> AsyncGenerator[StreamInstruction, None]:
+        """Speaks the chunks of a long text, see :mod:`~stream.ssml`.
+        All chunks get synthesized concurrently, limited by
+        ``TTS_CHUNK_CONCURRENCY``, and the playback starts as soon as the
+        first chunk is available.
+        Each chunk gets queued on SuperCollider while its predecessor is still
+        playing, so the chunks are played without a gap.
+        """
+        tasks = [asyncio.create_task(self._synthesize_chunk(chunk)) for chunk in chunks]
+        playing: Optional[StreamInstruction] = None
+        try:
+            for task in tasks:
+                audio_file = await task
+                instruction = await sync_to_async(
+                    self.stream.stream_point.play_audio_file
+                )(
+                    audio_file,
+                    playback_type=AudioCell.PlaybackChoices.SYNC_PLAYBACK,
+                    queue=True,
+                )
+                yield instruction
+                if playing is not None:
+                    await self.wait_for_finished_instruction(playing)
+                playing = instruction
+            if playing is not None:
+                await self.wait_for_finished_instruction(playing)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _measure(
+        self, category: str, node_uuid: UUID, cell_uuid: Optional[UUID] = None
+    ) -> ContextManager:
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.measure(category, node_uuid, cell_uuid)
+
+    async def _synthesize_ahead(self, ssml_text: str) -> None:
+        async with self._synthesis_semaphore:
+            await sync_to_async(_synthesize, thread_sensitive=False)(
+                ssml_text, self.chunk_chars
+            )
+
+    def synthesize_successors(self, snapshot: GraphSnapshot, node_uuid: UUID) -> None:
+        """Starts the text to speech conversion of the markdown cells of all
+        nodes which can be reached from the given node, so the
+        :class:`~stream.models.TextToSpeech` already exists once the
+        engine arrives there.
+
+        Only markdown which does not depend on the state of the stream
+        is considered, see :func:`~story_graph.markdown_parser.is_static_markdown`.
+        """
+        for node_door in snapshot.nodes[node_uuid].out_doors:
+            for next_node_uuid in node_door.next_nodes:
+                for script_cell in snapshot.nodes[next_node_uuid].script_cells:
+                    if script_cell.cell_type != CellType.MARKDOWN:
+                        continue
+                    if not is_static_markdown(script_cell.cell_code):
+                        continue
+                    ssml_text = md_to_ssml(script_cell.cell_code)
+                    if ssml_text in self._synthesis_tasks:
+                        continue
+                    log.debug(f"Synthesize ahead '{ssml_text[0:100]}'")
+                    task = asyncio.create_task(self._synthesize_ahead(ssml_text))
+                    self._synthesis_tasks[ssml_text] = task
+                    # the finished task gets passed as default value of pop
+                    task.add_done_callback(
+                        partial(self._synthesis_tasks.pop, ssml_text)
+                    )
+
     async def execute_sc_code(
         self, cell_code: str
     ) -> AsyncGenerator[StreamInstruction, None]:
@@ -193,8 +422,8 @@ class Engine:
                   - the current asyncio loop - can be used to execute
                     additional async code
                 * - ``vars``
-                  - a dictionary of all stream variables
-                  - See :func:`~story_graph.engine.Engine.get_stream_variables`
+                  - a dictionary like store of all stream variables
+                  - See :class:`~story_graph.variable_store.StreamVariableStore`
                 * - ``self``
                   - Current :class:`~story_graph.engine.Engine` instance
                   -
@@ -204,6 +433,9 @@ class Engine:
                 * - ``wait_for_stream_variable``
                   - Callable
                   - See :func:`~story_graph.engine.Engine.wait_for_stream_variable`
+                * - ``graph_vars``
+                  - the variables which are shared by all streams of the graph
+                  - See :class:`~story_graph.graph_variables.GraphVariables`
 
         """
         runtime_values = runtime_values if runtime_values else {}
@@ -223,6 +455,8 @@ class Engine:
                 "Input": Input,
                 "list": list,
                 "random": random,
+                # prefer this over the blocking requests
+                "http": http_client,
                 **runtime_values,
             }
         }
@@ -239,17 +473,28 @@ class Engine:
         In order to secure at least a little bit the execution within such a script
         cell everything that is a available for execution needs to be stated
         explicitly here.
+
+        If the sandbox is enabled, a cell which does not await, yield or
+        access the engine is executed within a separate process,
+        see :mod:`~story_graph.sandbox`.
         """
         log.debug(f"Run python code '{cell_code}'")
-        stream_variables = await self.get_stream_variables()
-        old_stream_variables = deepcopy(stream_variables)
+        await self.variable_store.aload()
+        if self.sandbox is not None and can_run_in_sandbox(cell_code):
+            await self.execute_sandboxed_python_cell(cell_code)
+            return
         loop = asyncio.get_running_loop()
         try:
             loc: Dict[str, Any] = {}
             exec(
-                # wrap the script cell in an async function
-                f"async def __ex(): "
-                + "".join(f"\n {l}" for l in (cell_code.split("\n") + ["yield None"])),
+                # wrap the script cell in an async function which is only
+                # compiled on the first visit of the cell
+                code_cache.compile(
+                    f"async def __ex(): "
+                    + "".join(
+                        f"\n {l}" for l in (cell_code.split("\n") + ["yield None"])
+                    )
+                ),
                 # global variables which are module scoped - they can not be
                 # overwritten, avoiding any kind of messing with the
                 # internal engine
@@ -260,11 +505,16 @@ class Engine:
                         # as this will generate the necessary JSON for
                         # the autocomplete within the editor
                         "loop": loop,
-                        "vars": stream_variables,
+                        "vars": self.variable_store,
                         "self": self,
                         "get_stream_variables": self.get_stream_variables,
                         "wait_for_stream_variable": self.wait_for_stream_variable,
-                        "requests": requests,
+                        # deprecated in favour of http
+                        "requests": deprecated_requests,
+                        "graph_vars": self.graph_variables,
+                        # the generator of the engine, so a seeded
+                        # simulation does not touch the global generator
+                        "random": self.random,
                     }
                 ),
                 # locals which mirror the current namespace and allow for modification
@@ -279,90 +529,249 @@ class Engine:
                 if x:
                     yield x
         except Exception as e:
-            log.error(f"Occured an exception during graph engine execution: {e}")
-            if self.raise_exceptions:
-                raise e
-
-        # @todo
-        # * skip functions / only use scalars
-        for k, v in stream_variables.items():
-            # unset value is a hack b/c none maybe a desired state
-            # @todo switch to async bulk create
-            if old_stream_variables.get(k, "__unset_value__") != v:
-                log.debug(f"New stream variable: {k} -> {v}")
-                await StreamVariable.objects.aupdate_or_create(
-                    stream=self.stream,
-                    key=k,
-                    defaults={"value": v},
+            self.handle_cell_exception(e)
+
+        # only the variables which were changed by the cell get written
+        await self.variable_store.aflush()
+
+    def handle_cell_exception(self, e: Exception) -> None:
+        """Handles an exception within a python :class:`~story_graph.models.ScriptCell`,
+        which gets re-raised if ``raise_exceptions`` is set.
+        """
+        log.error(f"Occured an exception during graph engine execution: {e}")
+        if self.raise_exceptions:
+            raise e
+
+    async def execute_sandboxed_python_cell(self, cell_code: str) -> None:
+        """Executes a synchronous python :class:`~story_graph.models.ScriptCell`
+        within :class:`~story_graph.sandbox.ScriptCellSandbox`.
+        The stream variables are copied into the sandbox and the changed
+        variables are copied back.
+
+        Raises a :class:`ScriptCellTimeout` if the cell exceeds its CPU or wall time.
+        """
+        assert self.sandbox is not None
+        try:
+            try:
+                changes = await self.sandbox.run(
+                    cell_code, await self.variable_store.aget_all()
                 )
-        stream_variables.get("return", None)
+            except SandboxTimeout as e:
+                raise ScriptCellTimeout(str(e)) from e
+            self.variable_store.update(changes)
+        except Exception as e:
+            self.handle_cell_exception(e)
+
+        await self.variable_store.aflush()
 
+    @profile_wait
     async def wait_for_finished_instruction(
         self,
         instruction: StreamInstruction,
         timeout: float = 300.0,
         interval: float = 0.2,
     ) -> None:
+        """Waits until an instruction has been finished (or failed) on SuperCollider.
+
+        Any state change of a :class:`~stream.models.StreamInstruction`, e.g. by
+        :func:`~osc_server.server.OSCServer.acknowledge_handler`, gets published via
+        :class:`~gencaster.distributor.GenCasterChannel`, so we await this message
+        instead of querying the database.
+        Only if no channel layer is available we fall back to polling
+        the database every ``interval`` seconds.
+
+        Raises a :class:`asyncio.TimeoutError` if the instruction has not
+        been finished within ``timeout`` seconds.
+        """
         log.debug(f"Wait for finished instruction {instruction.uuid}")
+        try:
+            async with GenCasterChannel.subscribe_stream_instruction_updates(
+                instruction.uuid
+            ) as subscription:
+                # the instruction could have been finished before we subscribed
+                await sync_to_async(instruction.refresh_from_db)()
+                if instruction.state in FINISHED_INSTRUCTION_STATES:
+                    return
+                try:
+                    instruction.state = await asyncio.wait_for(
+                        self._receive_finished_state(subscription), timeout
+                    )
+                except asyncio.TimeoutError as e:
+                    log.info(
+                        f"Timed out on waiting for stream instruction {instruction.uuid}"
+                    )
+                    raise e
+                return
+        except MissingChannelLayer:
+            log.warning(
+                f"No channel layer available - poll for stream instruction {instruction.uuid}"
+            )
+
         for _ in range(int(timeout / interval)):
             await sync_to_async(instruction.refresh_from_db)()
-            if instruction.state == StreamInstruction.InstructionState.FINISHED:
+            if instruction.state in FINISHED_INSTRUCTION_STATES:
                 return
             await asyncio.sleep(interval)
         log.info(f"Timed out on waiting for stream instruction {instruction.uuid}")
         raise asyncio.TimeoutError()
 
+    @staticmethod
+    async def _receive_finished_state(subscription: ChannelSubscription) -> str:
+        async for message in subscription:
+            if message["state"] in FINISHED_INSTRUCTION_STATES:
+                return str(message["state"])
+        raise MissingChannelLayer()
+
+    def get_cell_execution(
+        self, script_cell: ScriptCellSnapshot
+    ) -> Optional[AsyncGenerator[Union[StreamInstruction, Dialog], None]]:
+        """Returns the execution of a :class:`~story_graph.models.ScriptCell`
+        according to its type or ``None`` if there is nothing to execute.
+        """
+        cell_type = script_cell.cell_type
+        if cell_type == CellType.COMMENT:
+            return None
+        elif cell_type == CellType.PYTHON:
+            if script_cell.cell_code:
+                return self.execute_python_cell(script_cell.cell_code)
+        elif cell_type == CellType.SUPERCOLLIDER:
+            return self.execute_sc_code(script_cell.cell_code)
+        elif cell_type == CellType.MARKDOWN:
+            return self.execute_markdown_code(script_cell.cell_code)  # type: ignore
+        elif cell_type == CellType.AUDIO:
+            if script_cell.audio_cell:
+                return self.execute_audio_cell(script_cell.audio_cell)
+        else:
+            log.error(f"Occured invalid/unknown CellType {cell_type}")
+        return None
+
+    async def execute_script_cell(
+        self, node_uuid: UUID, script_cell: ScriptCellSnapshot
+    ) -> AsyncGenerator[Union[StreamInstruction, Dialog], None]:
+        cell_execution = self.get_cell_execution(script_cell)
+        if cell_execution is None:
+            return
+        with self._measure(script_cell.cell_type, node_uuid, script_cell.uuid):
+            async for instruction in cell_execution:
+                yield instruction
+
+    async def execute_concurrent_script_cells(
+        self, node_uuid: UUID, script_cells: List[ScriptCellSnapshot]
+    ) -> AsyncGenerator[Union[StreamInstruction, Dialog], None]:
+        """Starts all script cells of a concurrent group at the same time and
+        yields their instructions in the order they occur.
+        Returns once all cells have finished, so the group takes as long as its
+        longest cell.
+
+        An exception of a cell gets raised after all cells have finished.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        finished = object()
+
+        async def run(script_cell: ScriptCellSnapshot) -> None:
+            try:
+                async for instruction in self.execute_script_cell(
+                    node_uuid, script_cell
+                ):
+                    await queue.put(instruction)
+            finally:
+                queue.put_nowait(finished)
+
+        tasks = [asyncio.create_task(run(script_cell)) for script_cell in script_cells]
+        try:
+            running = len(tasks)
+            while running > 0:
+                instruction = await queue.get()
+                if instruction is finished:
+                    running -= 1
+                    continue
+                yield instruction
+            for task in tasks:
+                # re-raises an exception of the cell
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def group_script_cells(
+        script_cells: Iterable[ScriptCellSnapshot],
+    ) -> List[List[ScriptCellSnapshot]]:
+        """Groups consecutive script cells which share the same ``concurrent_group``,
+        any other cell forms a group on its own.
+        """
+        return [
+            list(group)
+            for _, group in itertools.groupby(
+                script_cells,
+                key=lambda c: c.uuid
+                if c.concurrent_group is None
+                else c.concurrent_group,
+            )
+        ]
+
     async def execute_node(
-        self, node: Node, blocking_sleep_time: int = 10000
+        self, node: Union[Node, NodeSnapshot], blocking_sleep_time: int = 10000
     ) -> AsyncGenerator[Union[StreamInstruction, Dialog], None]:
         """Executes all :class:`~story_graph.models.ScriptCell` of
-        a given :class:`~story_graph.models.Node`."""
+        a given :class:`~story_graph.models.Node`.
+
+        The script cells are taken from the
+        :class:`~story_graph.snapshot.GraphSnapshot` of the graph.
+        Consecutive cells of the same ``concurrent_group`` are executed
+        at the same time, see :func:`~Engine.execute_concurrent_script_cells`.
+        """
         log.debug(f"Executing node {node.uuid}")
-        script_cell: ScriptCell
         instruction: Union[StreamInstruction, Dialog]
-        async for script_cell in node.script_cells.select_related("audio_cell", "audio_cell__audio_file").all():  # type: ignore
-            cell_type = script_cell.cell_type
-            if cell_type == CellType.COMMENT:
-                continue
-            elif cell_type == CellType.PYTHON:
-                if script_cell.cell_code:
-                    async for instruction in self.execute_python_cell(
-                        script_cell.cell_code
-                    ):
-                        yield instruction
-
-            elif cell_type == CellType.SUPERCOLLIDER:
-                async for instruction in self.execute_sc_code(script_cell.cell_code):
-                    yield instruction
-            elif cell_type == CellType.MARKDOWN:
-                async for instruction in self.execute_markdown_code(
-                    script_cell.cell_code
-                ):
-                    yield instruction
-            elif cell_type == CellType.AUDIO:
-                if script_cell.audio_cell:
-                    async for instruction in self.execute_audio_cell(
-                        script_cell.audio_cell
-                    ):
-                        yield instruction
+        snapshot = await GraphSnapshotCache.aget(self.graph)
+        if self.lookahead_synthesis:
+            self.synthesize_successors(snapshot, node.uuid)  # type: ignore
+        script_cells = snapshot.nodes[node.uuid].script_cells  # type: ignore
+        for group in self.group_script_cells(script_cells):
+            if len(group) == 1:
+                cell_execution = self.execute_script_cell(node.uuid, group[0])  # type: ignore
             else:
-                log.error(f"Occured invalid/unknown CellType {cell_type}")
+                cell_execution = self.execute_concurrent_script_cells(node.uuid, group)  # type: ignore
+            async for instruction in cell_execution:
+                yield instruction
+
+    async def _get_door_global_vars(
+        self, node: Optional[NodeSnapshot] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        graph_vars: Dict[str, str] = {}
+        if node is None or any("graph_vars" in door.code for door in node.out_doors):
+            # avoid the access of the shared store if not necessary
+            graph_vars = await self.graph_variables.get_all()
+        return self.get_engine_global_vars(
+            {
+                "loop": asyncio.get_event_loop(),
+                "vars": await self.get_stream_variables(),
+                "graph_vars": graph_vars,
+                "self": self,
+                "get_stream_variables": self.get_stream_variables,
+                "wait_for_stream_variable": self.wait_for_stream_variable,
+            }
+        )
 
-    async def _evaluate_python_code(self, code: str) -> bool:
-        stream_variables = await self.get_stream_variables()
+    async def _evaluate_python_code(
+        self,
+        code: Union[str, CodeType],
+        engine_globals: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> bool:
+        """Evaluates the condition of a :class:`~story_graph.models.NodeDoor`.
+
+        :param code: The code of the condition - either as source or already compiled
+            in ``eval`` mode.
+        :param engine_globals: Allows to evaluate multiple conditions against the same
+            stream variables.
+            If not given, the variables will be fetched.
+        """
+        if engine_globals is None:
+            engine_globals = await self._get_door_global_vars()
         try:
-            r = eval(
-                code,
-                self.get_engine_global_vars(
-                    {
-                        "loop": asyncio.get_event_loop(),
-                        "vars": stream_variables,
-                        "self": self,
-                        "get_stream_variables": self.get_stream_variables,
-                        "wait_for_stream_variable": self.wait_for_stream_variable,
-                    }
-                ),
-            )
+            if isinstance(code, str):
+                code = code_cache.compile(code, mode="eval")
+            r = eval(code, engine_globals)
         except Exception:
             raise InvalidPythonCode()
         if not isinstance(r, bool):
@@ -370,7 +779,57 @@ class Engine:
             raise InvalidPythonCode()
         return r
 
-    async def get_next_node(self) -> Node:
+    async def evaluate_out_doors(
+        self, node: NodeSnapshot
+    ) -> Optional[NodeDoorSnapshot]:
+        """Returns the first non-default out door of the node whose condition
+        is true or ``None`` if there is none.
+        """
+        with self._measure(DOOR_EVALUATION, node.uuid):
+            # all doors are evaluated against the same stream variables
+            door_globals = await self._get_door_global_vars(node)
+            for node_door in node.out_doors:
+                if node_door.is_default:
+                    # the default door is the fallback anyway
+                    continue
+                try:
+                    active_exit = await self._evaluate_python_code(
+                        node_door.condition or node_door.code, door_globals
+                    )
+                # a broad exception because many things can go wrong here while evaluating
+                # python code (e.g. even raising a custom exception), therefore we catch all
+                # possible exceptions here
+                except Exception as e:
+                    log.debug(
+                        f"Exception raised on evaluating code of node door {node_door}: {e}"
+                    )
+                    continue
+                if active_exit:
+                    log.debug(f"Choose exit {node_door} on {node}")
+                    return node_door
+        return None
+
+    @profile_wait
+    async def wait_for_door_dependencies(
+        self, node: NodeSnapshot, since: Optional[int] = None
+    ) -> bool:
+        """Waits up to ``blocking_time`` seconds until a stream variable which
+        is used by the conditions of the out doors of a reactive node changes,
+        see :attr:`~story_graph.snapshot.NodeSnapshot.door_dependencies`.
+
+        Returns ``False`` if the conditions do not depend on any variable or if
+        nothing has changed.
+        """
+        dependencies = node.door_dependencies
+        if (dependencies is not None and not dependencies) or self.blocking_time <= 0:
+            return False
+        log.debug(f"Wait for a change of {dependencies or 'any variable'} on {node}")
+        await self.variable_store.aload()
+        return await self.variable_store.wait_for_change(
+            self.blocking_time, keys=dependencies, since=since
+        )
+
+    async def get_next_node(self) -> NodeSnapshot:
         """Iterates over each exit :class:`~NodeDoor`
         of the current node and evaluates its boolean value
         and decides.
@@ -378,57 +837,49 @@ class Engine:
         If the node door code consists of invalid code it will be skipped.
         If all boolean evaluations result in ``False`` or invalid code,
         the default exit will be used.
+        On a reactive node the doors get evaluated again upon a change of
+        the stream variables they depend on, see
+        :func:`~Engine.wait_for_door_dependencies`.
 
         If multiple out-going edges are connected to an active door,
-        a random edge will be picked to follow for the next node.
+        a random edge will be picked to follow for the next node,
+        proportionally to the ``weight`` of the edges.
 
         If the node does not have any out-going edges a :class:`~GraphDeadEnd`
         exception will be raised.
+
+        The traversal is done on the :class:`~story_graph.snapshot.GraphSnapshot`
+        of the graph and therefore does not query the database.
         """
-        exit_door: Optional[NodeDoor]
-        async for node_door in NodeDoor.objects.filter(
-            node=self._current_node,
-            door_type=NodeDoor.DoorType.OUTPUT,
-        ).prefetch_related("node"):
-            try:
-                active_exit = await self._evaluate_python_code(node_door.code)
-            # a broad exception because many things can go wrong here while evaluating
-            # python code (e.g. even raising a custom exception), therefore we catch all
-            # possible exceptions here
-            except Exception as e:
-                log.debug(
-                    f"Exception raised on evaluating code of node door {node_door}: {e}"
-                )
-                continue
-            if active_exit:
-                log.debug(f"Choose exit {node_door} on {self._current_node}")
-                exit_door = node_door
+        snapshot = await GraphSnapshotCache.aget(self.graph)
+        try:
+            current_node = snapshot.nodes[self._current_node.uuid]  # type: ignore
+        except KeyError:
+            log.info(f"Node {self._current_node} is not part of graph {self.graph}")
+            raise GraphDeadEnd()
+
+        version = self.variable_store.version
+        exit_door = await self.evaluate_out_doors(current_node)
+        while exit_door is None and current_node.is_reactive_node:
+            if not await self.wait_for_door_dependencies(current_node, version):
                 break
-        else:
-            log.debug(f"Fallback to default node door on {self._current_node}")
-            exit_door = await NodeDoor.objects.filter(
-                node=self._current_node,
-                door_type=NodeDoor.DoorType.OUTPUT,
-                is_default=True,
-            ).afirst()
-        # else return default out
+            version = self.variable_store.version
+            exit_door = await self.evaluate_out_doors(current_node)
+        if exit_door is None:
+            log.debug(f"Fallback to default node door on {current_node}")
+            exit_door = current_node.default_out_door
 
         while True:
             if exit_door is None:
                 raise GraphDeadEnd()
-            try:
-                return (await exit_door.out_edges.order_by("?").select_related("in_node_door__node").afirst()).in_node_door.node  # type: ignore
-            except AttributeError:
-                if exit_door.is_default:
-                    raise GraphDeadEnd()
+            if exit_door.next_nodes:
+                return snapshot.nodes[exit_door.pick_next_node(self.random)]
+            if exit_door.is_default:
+                raise GraphDeadEnd()
             log.info(
-                f"Ran into a dead end on non-default door {exit_door.name} on node {self._current_node.name} - fallback to default door"
+                f"Ran into a dead end on non-default door {exit_door.name} on node {current_node.name} - fallback to default door"
             )
-            exit_door = await NodeDoor.objects.filter(
-                node=self._current_node,
-                door_type=NodeDoor.DoorType.OUTPUT,
-                is_default=True,
-            ).afirst()
+            exit_door = current_node.default_out_door
 
     async def cleanup_sc_procedure(self) -> StreamInstruction:
         log.debug("Run cleanup procedure on graph")
@@ -442,6 +893,39 @@ class Engine:
         await asyncio.sleep(0.2)
         return instruction
 
+    async def checkpoint(
+        self, node: Optional[Union[Node, NodeSnapshot]], flush: bool = False
+    ) -> None:
+        """Stores the node which gets executed on the stream, so
+        a listener who reconnects can resume from it.
+
+        In order to avoid a query on each step the checkpoint is only
+        written if it has changed and at most every ``checkpoint_interval``
+        seconds - the remainder gets written via :func:`~Engine.flush_checkpoint`
+        once the engine parks or stops.
+        """
+        self.stream.checkpoint_node_id = node.uuid if node else None  # type: ignore
+        await self.flush_checkpoint(force=flush)
+
+    async def flush_checkpoint(self, force: bool = True) -> None:
+        """Writes the checkpoint of the stream to the database if it has changed.
+
+        :param force: If ``False`` the write is skipped within ``checkpoint_interval``
+            seconds of the previous write.
+        """
+        checkpoint_node_id: Optional[UUID] = self.stream.checkpoint_node_id  # type: ignore
+        if checkpoint_node_id == self._stored_checkpoint:
+            return
+        now = time.monotonic()
+        if not force and now - self._checkpoint_time < self.checkpoint_interval:
+            return
+        self._stored_checkpoint = checkpoint_node_id
+        self._checkpoint_time = now
+        await Stream.objects.filter(uuid=self.stream.uuid).aupdate(
+            checkpoint_node_id=checkpoint_node_id,
+            modified_date=timezone.now(),
+        )
+
     async def start(
         self, max_steps: int = 1000
     ) -> AsyncGenerator[Union[StreamInstruction, Dialog, GraphDeadEnd], None]:
@@ -453,26 +937,76 @@ class Engine:
         .. note::
 
             In order to avoid a clumping of the database a lay off period
-            of 0.1 seconds is added between jumping nodes.
+            of ``step_delay`` (0.1 seconds) is added between jumping nodes.
+            On a cycle of nodes which does not make any progress this period
+            grows up to ``max_step_delay``, see :mod:`~story_graph.pacing`.
+
+        Upon reaching a blocking node the stream gets parked and the generator
+        stops, so the caller has to wait via
+        :func:`~story_graph.parking.ParkedStreams.wait` until the listener
+        disconnects.
         """
-        self._current_node = await self.graph.aget_entry_node()
+        snapshot = await GraphSnapshotCache.aget(self.graph)
+        resume_node: Optional[NodeSnapshot] = None
+        if self.resume:
+            resume_node = snapshot.nodes.get(self.stream.checkpoint_node_id)  # type: ignore
+        if resume_node:
+            log.info(f"Resume stream {self.stream.uuid} on {resume_node}")
+            self._current_node = resume_node
+        else:
+            self._current_node = snapshot.entry_node
 
-        if self.run_cleanup_procedure:
+        if self.run_cleanup_procedure and not resume_node:
             await self.cleanup_sc_procedure()
 
-        for _ in range(max_steps):
-            async for instruction in self.execute_node(self._current_node):
-                yield instruction
-            if self._current_node.is_blocking_node:
-                log.info("Accessed a blocking node")
-                await asyncio.sleep(self.blocking_time)
+        pacer = HotLoopPacer(step_delay=self.step_delay, max_delay=self.max_step_delay)
+        try:
+            for _ in range(max_steps):
+                await self.checkpoint(self._current_node)
+                variables_version = self.variable_store.version
+                progress = False
+                async for instruction in self.execute_node(self._current_node):
+                    progress = True
+                    yield instruction
+                if self._current_node.is_blocking_node and self.blocking_time > 0:
+                    log.info("Accessed a blocking node - park the stream")
+                    await self.flush_checkpoint()
+                    # release the engine instead of waiting within it,
+                    # see :func:`~story_graph.parking.ParkedStreams.wait`
+                    ParkedStreams.park(
+                        stream_uuid=self.stream.uuid,
+                        graph_uuid=self.graph.uuid,
+                        node_uuid=self._current_node.uuid,
+                    )
+                    return
+
+                delay = pacer.step(
+                    self._current_node.uuid,  # type: ignore
+                    progress or self.variable_store.version != variables_version,
+                )
 
-            # search for next node
-            try:
-                self._current_node = await self.get_next_node()
-            except GraphDeadEnd:
-                log.info(f"Ran into a dead end on {self.graph} on {self._current_node}")
-                return
-            await asyncio.sleep(0.1)
-        else:
-            log.info(f"Reached maximum steps on graph {self.graph} - stop execution")
+                # search for next node
+                try:
+                    self._current_node = await self.get_next_node()
+                except GraphDeadEnd:
+                    log.info(
+                        f"Ran into a dead end on {self.graph} on {self._current_node}"
+                    )
+                    # a reconnect should not replay the end
+                    await self.checkpoint(None, flush=True)
+                    return
+                if pacer.is_backing_off:
+                    # a listener may change a variable the node doors depend on
+                    if await self.variable_store.wait_for_change(delay):
+                        pacer.reset()
+                else:
+                    await asyncio.sleep(delay)
+            else:
+                log.info(
+                    f"Reached maximum steps on graph {self.graph} - stop execution"
+                )
+        finally:
+            await self.flush_checkpoint()
+            await self.variable_store.aclose()
+            if self.profiler is not None:
+                self.profiler.close()
@@ -0,0 +1,278 @@
+"""
+Graph variables
+===============
+
+Contrary to a :class:`~stream.models.StreamVariable`, which belongs to a single
+:class:`~stream.models.Stream`, a graph variable is shared by all streams of a
+:class:`~story_graph.models.Graph`, e.g. to count the votes of all listeners.
+
+Graph variables are not stored within the database but within a fast shared
+store which is configured via the ``GRAPH_VARIABLES`` setting, similar to
+``CHANNEL_LAYERS``:
+
+* :class:`~RedisGraphVariableBackend` keeps the variables within a Redis hash
+  per graph, so all server processes share the same state.
+* :class:`~InMemoryGraphVariableBackend` keeps the variables within the
+  current process and is used for local development and tests.
+
+Like stream variables, all values are stored as strings.
+
+Within a :class:`~story_graph.models.ScriptCell` the variables of the graph
+are available via ``graph_vars``, see :class:`~GraphVariables`, e.g.
+
+.. code-block:: python
+
+    votes = await graph_vars.increment("votes")
+    if await graph_vars.compare_and_set("leader", None, vars["name"]):
+        print("first!")
+
+Within the condition of a :class:`~story_graph.models.NodeDoor` ``graph_vars``
+is a dictionary of all graph variables and within markdown a graph variable can
+be accessed via ``{graph_var}`votes```.
+
+Listeners can increment the keys which a graph declares within
+:attr:`~story_graph.models.Graph.incrementable_graph_variables` via the
+``incrementGraphVariable`` mutation, see
+:func:`~gencaster.schema.Mutation.increment_graph_variable`.
+"""
+
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Any, Dict, Optional, Union
+from uuid import UUID
+
+import redis.asyncio as redis
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+log = logging.getLogger(__name__)
+
+Number = Union[int, float]
+
+
+def _to_number(value: Optional[str]) -> Number:
+    if value is None or value == "":
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+class GraphVariableBackend:
+    """The interface of a store of graph variables.
+    All operations on a single variable are atomic.
+    """
+
+    async def get_all(self, graph_uuid: UUID) -> Dict[str, str]:
+        raise NotImplementedError()
+
+    async def get(self, graph_uuid: UUID, key: str) -> Optional[str]:
+        raise NotImplementedError()
+
+    async def set(self, graph_uuid: UUID, key: str, value: str) -> None:
+        raise NotImplementedError()
+
+    async def delete(self, graph_uuid: UUID, key: str) -> None:
+        raise NotImplementedError()
+
+    async def increment(self, graph_uuid: UUID, key: str, amount: Number = 1) -> Number:
+        """Adds ``amount`` to the variable and returns the new value.
+        A missing variable counts as ``0``.
+        """
+        raise NotImplementedError()
+
+    async def compare_and_set(
+        self, graph_uuid: UUID, key: str, expected: Optional[str], value: str
+    ) -> bool:
+        """Sets the variable to ``value`` if its current value is ``expected``,
+        where ``None`` means that the variable does not exist yet.
+        Returns ``True`` if the variable has been set.
+        """
+        raise NotImplementedError()
+
+    async def clear(self, graph_uuid: UUID) -> None:
+        raise NotImplementedError()
+
+
+class InMemoryGraphVariableBackend(GraphVariableBackend):
+    """Keeps the variables within the memory of the current process,
+    so they are not shared between multiple server processes.
+    """
+
+    def __init__(self) -> None:
+        self._variables: Dict[UUID, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    async def get_all(self, graph_uuid: UUID) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._variables.get(graph_uuid, {}))
+
+    async def get(self, graph_uuid: UUID, key: str) -> Optional[str]:
+        with self._lock:
+            return self._variables.get(graph_uuid, {}).get(key)
+
+    async def set(self, graph_uuid: UUID, key: str, value: str) -> None:
+        with self._lock:
+            self._variables.setdefault(graph_uuid, {})[key] = value
+
+    async def delete(self, graph_uuid: UUID, key: str) -> None:
+        with self._lock:
+            self._variables.get(graph_uuid, {}).pop(key, None)
+
+    async def increment(self, graph_uuid: UUID, key: str, amount: Number = 1) -> Number:
+        with self._lock:
+            variables = self._variables.setdefault(graph_uuid, {})
+            value = _to_number(variables.get(key)) + amount
+            variables[key] = str(value)
+            return value
+
+    async def compare_and_set(
+        self, graph_uuid: UUID, key: str, expected: Optional[str], value: str
+    ) -> bool:
+        with self._lock:
+            variables = self._variables.setdefault(graph_uuid, {})
+            if variables.get(key) != expected:
+                return False
+            variables[key] = value
+            return True
+
+    async def clear(self, graph_uuid: UUID) -> None:
+        with self._lock:
+            self._variables.pop(graph_uuid, None)
+
+
+# KEYS[1] hash, ARGV[1] key, ARGV[2] "1" if the key needs to exist,
+# ARGV[3] expected value, ARGV[4] new value
+COMPARE_AND_SET_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if (ARGV[2] == '0' and current == false) or (ARGV[2] == '1' and current == ARGV[3]) then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[4])
+    return 1
+end
+return 0
+"""
+
+
+class RedisGraphVariableBackend(GraphVariableBackend):
+    """Keeps the variables of each graph within a Redis hash.
+
+    :param url: URL of the Redis database, e.g. ``redis://redis:6379/1``
+    :param prefix: Prefix of the keys of the hashes
+    """
+
+    def __init__(self, url: str, prefix: str = "gencaster:graph_vars:") -> None:
+        self.url = url
+        self.prefix = prefix
+        # a connection is bound to the loop it has been created on
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, redis.Redis]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def _get_client(self) -> redis.Redis:
+        loop = asyncio.get_running_loop()
+        if (client := self._clients.get(loop)) is None:
+            client = self._clients[loop] = redis.Redis.from_url(
+                self.url, decode_responses=True
+            )
+        return client
+
+    def _key(self, graph_uuid: UUID) -> str:
+        return f"{self.prefix}{graph_uuid}"
+
+    async def get_all(self, graph_uuid: UUID) -> Dict[str, str]:
+        return await self._get_client().hgetall(self._key(graph_uuid))  # type: ignore
+
+    async def get(self, graph_uuid: UUID, key: str) -> Optional[str]:
+        return await self._get_client().hget(self._key(graph_uuid), key)  # type: ignore
+
+    async def set(self, graph_uuid: UUID, key: str, value: str) -> None:
+        await self._get_client().hset(self._key(graph_uuid), key, value)
+
+    async def delete(self, graph_uuid: UUID, key: str) -> None:
+        await self._get_client().hdel(self._key(graph_uuid), key)
+
+    async def increment(self, graph_uuid: UUID, key: str, amount: Number = 1) -> Number:
+        client = self._get_client()
+        if isinstance(amount, int):
+            return await client.hincrby(self._key(graph_uuid), key, amount)
+        return await client.hincrbyfloat(self._key(graph_uuid), key, amount)
+
+    async def compare_and_set(
+        self, graph_uuid: UUID, key: str, expected: Optional[str], value: str
+    ) -> bool:
+        result = await self._get_client().eval(
+            COMPARE_AND_SET_SCRIPT,
+            1,
+            self._key(graph_uuid),
+            key,
+            "0" if expected is None else "1",
+            expected or "",
+            value,
+        )
+        return bool(result)
+
+    async def clear(self, graph_uuid: UUID) -> None:
+        await self._get_client().delete(self._key(graph_uuid))
+
+
+_backend: Optional[GraphVariableBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_graph_variable_backend() -> GraphVariableBackend:
+    """Returns the backend which is configured via the ``GRAPH_VARIABLES`` setting."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            config: Dict[str, Any] = settings.GRAPH_VARIABLES
+            _backend = import_string(config["BACKEND"])(**config.get("CONFIG", {}))
+        return _backend
+
+
+class GraphVariables:
+    """The variables of a graph which are available as ``graph_vars``
+    within a script cell.
+
+    :param graph_uuid: The graph whose variables are accessed
+    """
+
+    def __init__(
+        self, graph_uuid: UUID, backend: Optional[GraphVariableBackend] = None
+    ) -> None:
+        self.graph_uuid = graph_uuid
+        self.backend = backend or get_graph_variable_backend()
+
+    async def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """Returns the value of a variable or ``default`` if it does not exist."""
+        value = await self.backend.get(self.graph_uuid, key)
+        return default if value is None else value
+
+    async def get_all(self) -> Dict[str, str]:
+        """Returns a copy of all variables of the graph."""
+        return await self.backend.get_all(self.graph_uuid)
+
+    async def set(self, key: str, value) -> None:
+        """Sets a variable, the value will be converted to a string."""
+        await self.backend.set(self.graph_uuid, key, str(value))
+
+    async def delete(self, key: str) -> None:
+        await self.backend.delete(self.graph_uuid, key)
+
+    async def increment(self, key: str, amount: Number = 1) -> Number:
+        """Atomically adds ``amount`` to a variable and returns the new value."""
+        return await self.backend.increment(self.graph_uuid, key, amount)
+
+    async def compare_and_set(self, key: str, expected, value) -> bool:
+        """Atomically sets a variable to ``value`` if it currently has the value
+        ``expected``, where ``None`` means that it does not exist yet.
+        Returns ``True`` if the variable has been set.
+        """
+        return await self.backend.compare_and_set(
+            self.graph_uuid,
+            key,
+            None if expected is None else str(expected),
+            str(value),
+        )
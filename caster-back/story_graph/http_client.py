@@ -0,0 +1,307 @@
+"""
+HTTP client
+===========
+
+An async HTTP client which is available as ``http`` within a
+:class:`~story_graph.models.ScriptCell`, e.g.
+
+.. code-block:: python
+
+    response = await http.get("https://example.com/weather", params={"city": "Berlin"})
+    vars["weather"] = response.json()["description"]
+
+Contrary to ``requests``, awaiting a request does not block the
+:class:`~story_graph.engine.Engine` of any other listener.
+Therefore ``requests`` is deprecated within a script cell and only available
+via :class:`~DeprecatedRequests`, which logs a warning on each use.
+
+The requests are executed via a pooled :class:`requests.Session` within a
+dedicated thread pool, so connections are re-used across all engines of this
+process.
+The number of concurrent requests per host is limited by
+``ENGINE_HTTP_MAX_CONNECTIONS_PER_HOST`` and each request has a timeout of
+``ENGINE_HTTP_TIMEOUT_SEC`` seconds.
+As the timeout of ``requests`` only applies to each socket operation, the
+response is read in chunks and the request gets aborted within its thread
+once the timeout has passed, so a slow host can not occupy a thread
+for longer.
+Successful ``GET`` requests are cached for ``ENGINE_HTTP_CACHE_TTL_SEC`` seconds,
+as a graph often visits the same node and therefore requests the same
+resource over and over again.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class HttpResponse:
+    """The response of a request of :class:`~AsyncHttpClient`."""
+
+    url: str
+    status_code: int
+    content: bytes
+    headers: Dict[str, str] = field(default_factory=dict)
+    encoding: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+    def raise_for_status(self) -> None:
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} error for url {self.url}")
+
+
+class AsyncHttpClient:
+    """Allows to await HTTP requests from within a script cell.
+
+    :param max_connections: Number of requests which run at the same time
+    :param max_connections_per_host: Number of requests which run at the
+        same time against a single host
+    :param timeout: Seconds until a request gets aborted
+    :param cache_ttl: Seconds a response of a ``GET`` request is cached,
+        ``0`` disables caching
+    :param cache_size: Number of responses which are kept in the cache
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_connections_per_host: int = 4,
+        timeout: float = 10.0,
+        cache_ttl: float = 60.0,
+        cache_size: int = 256,
+    ) -> None:
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # bytes which are read at most at once from the response
+        self.chunk_size: int = 8192
+        self.hits: int = 0
+        self.misses: int = 0
+        self._cache: "OrderedDict[Tuple, Tuple[float, HttpResponse]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # asyncio primitives are bound to the loop they are used on
+        self._host_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def _get_session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self.max_connections,
+                    pool_maxsize=self.max_connections_per_host,
+                )
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_connections,
+                    thread_name_prefix="http-client",
+                )
+            return self._session
+
+    def _get_host_semaphore(self, url: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        host = urlsplit(url).netloc
+        with self._lock:
+            semaphores = self._host_semaphores.setdefault(loop, {})
+            if (semaphore := semaphores.get(host)) is None:
+                semaphore = semaphores[host] = asyncio.Semaphore(
+                    self.max_connections_per_host
+                )
+            return semaphore
+
+    @staticmethod
+    def _cache_key(url: str, params: Optional[Dict], headers: Optional[Dict]) -> Tuple:
+        return (
+            url,
+            # also allows for lists as values, e.g. ``{"id": [1, 2]}``
+            urlencode(sorted((params or {}).items()), doseq=True),
+            tuple(sorted((headers or {}).items())),
+        )
+
+    def _get_cached(self, key: Tuple) -> Optional[HttpResponse]:
+        with self._lock:
+            if (entry := self._cache.get(key)) is None:
+                return None
+            expires, response = entry
+            if expires < time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return response
+
+    def _set_cached(self, key: Tuple, response: HttpResponse, ttl: float) -> None:
+        with self._lock:
+            self._cache[key] = (time.monotonic() + ttl, response)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def _request(self, method: str, url: str, timeout: float, **kwargs) -> HttpResponse:
+        deadline = time.monotonic() + timeout
+        response = self._get_session().request(
+            method, url, timeout=timeout, stream=True, **kwargs
+        )
+        try:
+            content = bytearray()
+            # returns whatever has arrived instead of waiting for a full chunk
+            while chunk := response.raw.read1(self.chunk_size, decode_content=True):
+                content.extend(chunk)
+                if time.monotonic() > deadline:
+                    raise requests.Timeout(
+                        f"Reading the response of {url} exceeded {timeout} seconds"
+                    )
+        finally:
+            response.close()
+        return HttpResponse(
+            url=response.url,
+            status_code=response.status_code,
+            content=bytes(content),
+            headers=dict(response.headers),
+            encoding=response.encoding,
+        )
+
+    @staticmethod
+    def _release_host(semaphore: asyncio.Semaphore, future: asyncio.Future) -> None:
+        semaphore.release()
+        # avoids a warning about an unretrieved exception of an abandoned request
+        if not future.cancelled():
+            future.exception()
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        params: Optional[Dict] = None,
+        headers: Optional[Dict] = None,
+        json: Any = None,
+        data: Any = None,
+        timeout: Optional[float] = None,
+        ttl: Optional[float] = None,
+    ) -> HttpResponse:
+        """Executes a HTTP request.
+
+        :param timeout: Seconds until the request gets aborted, defaults to
+            the timeout of the client
+        :param ttl: Seconds the response of a ``GET`` request is cached,
+            defaults to the TTL of the client
+        """
+        ttl = self.cache_ttl if ttl is None else ttl
+        timeout = self.timeout if timeout is None else timeout
+        cache_key = None
+        if method.upper() == "GET" and ttl > 0:
+            cache_key = self._cache_key(url, params, headers)
+            if (cached := self._get_cached(cache_key)) is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        self._get_session()
+        loop = asyncio.get_running_loop()
+        semaphore = self._get_host_semaphore(url)
+        await semaphore.acquire()
+        try:
+            future = loop.run_in_executor(
+                self._executor,
+                lambda: self._request(
+                    method,
+                    url,
+                    timeout=timeout,  # type: ignore
+                    params=params,
+                    headers=headers,
+                    json=json,
+                    data=data,
+                ),
+            )
+        except BaseException:
+            semaphore.release()
+            raise
+        # a thread can not be aborted, so the connection to the host is only
+        # freed once the request has been aborted by its own timeout,
+        # also if we stop waiting for it
+        future.add_done_callback(partial(self._release_host, semaphore))
+        log.debug(f"{method} {url}")
+        response = await asyncio.wait_for(
+            asyncio.shield(future),
+            # a single socket operation may exceed the deadline of the request
+            timeout + 1.0,
+        )
+
+        if cache_key is not None and response.ok:
+            self._set_cached(cache_key, response, ttl)
+        return response
+
+    async def get(self, url: str, **kwargs) -> HttpResponse:
+        """Executes a ``GET`` request, see :func:`~AsyncHttpClient.request`."""
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> HttpResponse:
+        """Executes a ``POST`` request, see :func:`~AsyncHttpClient.request`."""
+        return await self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+class DeprecatedRequests:
+    """Proxies the blocking ``requests`` module within a script cell
+    and logs a deprecation warning which points to ``http``.
+    """
+
+    def __getattr__(self, name: str) -> Any:
+        log.warning(
+            f"requests.{name} blocks the engine of all listeners and is deprecated "
+            "within script cells - use http instead, e.g. await http.get(url)"
+        )
+        return getattr(requests, name)
+
+
+deprecated_requests = DeprecatedRequests()
+
+http_client = AsyncHttpClient(
+    max_connections=settings.ENGINE_HTTP_MAX_CONNECTIONS,
+    max_connections_per_host=settings.ENGINE_HTTP_MAX_CONNECTIONS_PER_HOST,
+    timeout=settings.ENGINE_HTTP_TIMEOUT_SEC,
+    cache_ttl=settings.ENGINE_HTTP_CACHE_TTL_SEC,
+)
@@ -2,11 +2,27 @@ import dataclasses
 import enum
 import inspect
 import json
+import uuid
 from typing import Any, Dict, List, Optional
 
 from django.core.management.base import BaseCommand
 
 from story_graph.engine import Engine
+from story_graph.graph_variables import GraphVariables, InMemoryGraphVariableBackend
+from story_graph.http_client import AsyncHttpClient
+
+# objects whose methods are listed as well
+NAMESPACE_METHODS = {
+    AsyncHttpClient: ["get", "post", "request"],
+    GraphVariables: [
+        "get",
+        "get_all",
+        "set",
+        "delete",
+        "increment",
+        "compare_and_set",
+    ],
+}
 
 
 class CompletionType(str, enum.Enum):
@@ -61,6 +77,9 @@ class Command(BaseCommand):
             "self": Engine,
             "get_stream_variables": self.fake_get_stream_variables,
             "wait_for_stream_variable": self.fake_wait_for_stream_variable,
+            "graph_vars": GraphVariables(
+                uuid.uuid4(), backend=InMemoryGraphVariableBackend()
+            ),
         }
 
     def handle(self, *args, **options):
@@ -88,6 +107,25 @@ class Command(BaseCommand):
                             type=CompletionType.CLASS,
                         )
                     )
+            elif type(v) in NAMESPACE_METHODS:
+                j.append(
+                    Completion(
+                        label=k,
+                        detail="",
+                        type=CompletionType.NAMESPACE,
+                        info=inspect.getdoc(v),
+                    )
+                )
+                for name in NAMESPACE_METHODS[type(v)]:
+                    method = getattr(v, name)
+                    j.append(
+                        Completion(
+                            label=f"{k}.{name}",
+                            detail=str(inspect.signature(method)),
+                            type=CompletionType.METHOD,
+                            info=inspect.getdoc(method),
+                        )
+                    )
             elif inspect.ismodule(v):
                 j.append(Completion(label=k, detail="", type=CompletionType.NAMESPACE))
             elif inspect.isclass(v):
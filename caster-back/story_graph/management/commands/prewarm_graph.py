@@ -0,0 +1,53 @@
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from story_graph.models import Graph
+from story_graph.prewarm import prewarm_graph
+
+
+class Command(BaseCommand):
+    help = "Synthesizes all markdown cells of a graph which do not depend on the state of a stream"
+
+    def add_arguments(self, parser):
+        parser.add_argument("graph_uuid", type=str)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Number of texts which get synthesized at the same time",
+        )
+        parser.add_argument(
+            "--retries",
+            type=int,
+            default=3,
+            help="Number of retries of a failed synthesis",
+        )
+        parser.add_argument(
+            "--retry-delay",
+            type=float,
+            default=1.0,
+            help="Seconds before the first retry, doubled on each retry",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Output the report as JSON"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            graph = Graph.objects.get(uuid=options["graph_uuid"])
+        except (Graph.DoesNotExist, ValidationError):
+            raise CommandError(f"Graph {options['graph_uuid']} does not exist")
+
+        report = prewarm_graph(
+            graph,
+            concurrency=options["concurrency"],
+            retries=options["retries"],
+            retry_delay=options["retry_delay"],
+        )
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report.to_dict(), indent=2))
+        else:
+            self.stdout.write(report.summary())
@@ -0,0 +1,76 @@
+import json
+import logging
+from typing import Dict, List
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from story_graph.models import Graph
+from story_graph.simulator import simulate
+
+
+class Command(BaseCommand):
+    help = "Simulates random walks on a graph and reports the coverage and throughput of the walks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("graph_uuid", type=str)
+        parser.add_argument("--walks", type=int, default=1000)
+        parser.add_argument("--max-steps", type=int, default=100)
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=None,
+            help="Number of processes, defaults to the number of CPUs",
+        )
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument(
+            "--var",
+            action="append",
+            default=[],
+            help="Possible values of a stream variable, e.g. --var name=Alice,Bob",
+        )
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help="Profile the execution time of the cells and node doors",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Output the report as JSON"
+        )
+
+    @staticmethod
+    def parse_variables(values: List[str]) -> Dict[str, List[str]]:
+        variables: Dict[str, List[str]] = {}
+        for value in values:
+            if "=" not in value:
+                raise CommandError(f"Variable '{value}' needs to be in form key=value")
+            key, choices = value.split("=", 1)
+            variables.setdefault(key, []).extend(choices.split(","))
+        return variables
+
+    def handle(self, *args, **options):
+        if options["verbosity"] < 2:
+            # each walk would log its end
+            logging.getLogger("story_graph.engine").setLevel(logging.WARNING)
+
+        try:
+            graph = Graph.objects.get(uuid=options["graph_uuid"])
+        except (Graph.DoesNotExist, ValidationError):
+            raise CommandError(f"Graph {options['graph_uuid']} does not exist")
+
+        report = simulate(
+            graph,
+            walks=options["walks"],
+            max_steps=options["max_steps"],
+            variables=self.parse_variables(options["var"]),
+            processes=options["processes"],
+            seed=options["seed"],
+            profile=options["profile"],
+        )
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report.to_dict(), indent=2))
+        else:
+            self.stdout.write(report.summary())
+            if report.profile is not None:
+                self.stdout.write(report.profile.summary(report.nodes))
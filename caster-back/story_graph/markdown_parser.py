@@ -14,12 +14,22 @@ by humans and treats written text as first class citizen.
 The dialect is described in :class:`~GencasterRenderer`.
 
 Use :func:`~md_to_ssml` to convert markdown text within a Python context.
+
+As a markdown cell gets rendered on every visit of its node, the markdown text
+is only parsed once into a :class:`~MarkdownTemplate`, see
+:func:`~compile_markdown`, which consists of the already rendered static
+SSML fragments and the slots of the dynamic tokens in between.
+Rendering a cell is therefore only a matter of filling the slots, and a
+markdown text without any dynamic token does not need any rendering at all.
 """
 
+import functools
 import logging
 import re
+import threading
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Callable, Dict, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 from mistletoe import Document, block_token, span_token
 from mistletoe.base_renderer import BaseRenderer
@@ -27,19 +37,131 @@ from mistletoe.span_token import SpanToken
 
 from stream.models import TextToSpeech
 
+from .code_cache import code_cache
+
 log = logging.getLogger(__name__)
 
+# the tokens of a renderer get registered globally within mistletoe
+_renderer_lock = threading.RLock()
+
+# placeholder for a slot within the rendered SSML, taken from the private use area
+SLOT_MARKER = "\ue000"
 
-def md_to_ssml(text: str, stream_variables: Optional[Dict[str, str]] = None) -> str:
+
+def md_to_ssml(
+    text: str,
+    stream_variables: Optional[Dict[str, str]] = None,
+    graph_variables: Optional[Dict[str, str]] = None,
+) -> str:
     """Converts a md text into
     `SSML <https://en.wikipedia.org/wiki/Speech_Synthesis_Markup_Language>`_.
 
     :param text: Markdown text
+    :param stream_variables: Values for ``{var}``
+    :param graph_variables: Values for ``{graph_var}``
     """
-    with GencasterRenderer(stream_variables) as render:
-        document = Document(text)
-        ssml_text = render.render(document)
-    return ssml_text  # type: ignore
+    return compile_markdown(text).render(stream_variables, graph_variables)
+
+
+@dataclass(frozen=True)
+class TemplateSlot:
+    """A dynamic token within a :class:`~MarkdownTemplate`."""
+
+    target: str
+    content: str
+
+    @property
+    def key(self) -> str:
+        return self.content.split("|")[0]
+
+    @property
+    def fallback(self) -> str:
+        return self.content.split("|")[-1] if self.content.count("|") else ""
+
+
+@dataclass(frozen=True)
+class MarkdownTemplate:
+    """The SSML of a markdown text, split into static fragments and the
+    slots of the dynamic tokens, so ``fragments`` has one more entry than
+    ``slots``.
+    """
+
+    fragments: Tuple[str, ...]
+    slots: Tuple[TemplateSlot, ...]
+
+    @property
+    def is_static(self) -> bool:
+        return len(self.slots) == 0
+
+    @property
+    def executes_python(self) -> bool:
+        return any(slot.target in ("python", "python_exec") for slot in self.slots)
+
+    def render(
+        self,
+        stream_variables: Optional[Dict[str, str]] = None,
+        graph_variables: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Fills the slots and returns the SSML."""
+        if self.is_static:
+            return self.fragments[0]
+        stream_variables = stream_variables if stream_variables else {}
+        graph_variables = graph_variables if graph_variables else {}
+        if not self.executes_python:
+            return self._fill(stream_variables, graph_variables)
+        # inline python code has access to the renderer via ``self``
+        # and may change its variables, which the following slots need to see
+        with _renderer_lock, GencasterRenderer(
+            stream_variables, graph_variables
+        ) as renderer:
+            return self._fill(
+                renderer.stream_variables, renderer.graph_variables, renderer
+            )
+
+    def _fill(
+        self,
+        stream_variables: Dict[str, str],
+        graph_variables: Dict[str, str],
+        renderer: Optional["GencasterRenderer"] = None,
+    ) -> str:
+        parts: List[str] = [self.fragments[0]]
+        for slot, fragment in zip(self.slots, self.fragments[1:]):
+            if slot.target == "var":
+                parts.append(stream_variables.get(slot.key, slot.fallback))
+            elif slot.target == "graph_var":
+                parts.append(graph_variables.get(slot.key, slot.fallback))
+            else:
+                parts.append(
+                    renderer.gencaster_token_resolver[slot.target](slot.content)  # type: ignore
+                )
+            parts.append(fragment)
+        return "".join(parts)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_markdown(text: str) -> MarkdownTemplate:
+    """Parses a markdown text into a :class:`~MarkdownTemplate`.
+    The templates are kept in a bounded LRU cache which is keyed by the text,
+    so a markdown text only gets parsed on its first rendering.
+    The inline Python code of the text gets compiled ahead as well.
+
+    :param text: Markdown text
+    """
+    with _renderer_lock, TemplateRenderer() as renderer:
+        ssml_text: str = renderer.render(Document(text.replace(SLOT_MARKER, "")))
+    for slot in renderer.slots:
+        try:
+            if slot.target == "python":
+                code_cache.compile(slot.content, "eval")
+            elif slot.target == "python_exec":
+                code_cache.compile(slot.content)
+        except SyntaxError:
+            # will be logged on rendering
+            pass
+    return MarkdownTemplate(
+        fragments=tuple(ssml_text.split(SLOT_MARKER)),
+        slots=tuple(renderer.slots),
+    )
 
 
 class GencasterToken(SpanToken):
@@ -51,12 +173,32 @@ class GencasterToken(SpanToken):
         self.content = match_obj.group(2)
 
 
+def is_static_markdown(text: str) -> bool:
+    """Checks if the SSML of a markdown text can be rendered ahead of time,
+    which is the case if it does not access any
+    :class:`~stream.models.StreamVariable` or executes any Python code.
+
+    :param text: Markdown text
+    """
+    for match in GencasterToken.pattern.finditer(text):
+        if match.group("type") in GencasterRenderer.DYNAMIC_TOKEN_TYPES:
+            return False
+    return True
+
+
 class GencasterRenderer(BaseRenderer):
     """
     Acts as a python parser for the Gencaster markdown dialect.
     """
 
-    def __init__(self, stream_variables: Optional[Dict[str, str]] = None) -> None:
+    # tokens which depend on the state of the stream during rendering
+    DYNAMIC_TOKEN_TYPES = {"python", "python_exec", "var", "graph_var"}
+
+    def __init__(
+        self,
+        stream_variables: Optional[Dict[str, str]] = None,
+        graph_variables: Optional[Dict[str, str]] = None,
+    ) -> None:
         super().__init__(GencasterToken)
 
         self.d = (
@@ -66,6 +208,9 @@ class GencasterRenderer(BaseRenderer):
         self.stream_variables: Dict[str, str] = (
             stream_variables if stream_variables else {}
         )
+        self.graph_variables: Dict[str, str] = (
+            graph_variables if graph_variables else {}
+        )
 
         self.gencaster_token_resolver: Dict[str, Callable[[str], str]] = {
             "python": self.eval_python,
@@ -76,6 +221,7 @@ class GencasterRenderer(BaseRenderer):
             "male": self.male,
             "female": self.female,
             "var": self.var,
+            "graph_var": self.graph_var,
             "raw_ssml": self.raw_ssml,
         }
 
@@ -168,7 +314,7 @@ class GencasterRenderer(BaseRenderer):
 
         """
         try:
-            r = eval(text)
+            r = eval(code_cache.compile(text, "eval"))
             return str(r) if r is not None else ""
         except SyntaxError as e:
             log.error(f"Could not evaluate python code: {e}")
@@ -191,7 +337,7 @@ class GencasterRenderer(BaseRenderer):
            Use :func:`~GencasterRenderer.var` to access stream variables.
         """
         try:
-            exec(text)
+            exec(code_cache.compile(text))
         except Exception as e:
             log.error(f"Could not execute python code: {e}")
         return ""
@@ -222,6 +368,20 @@ class GencasterRenderer(BaseRenderer):
         fallback_value = text.split("|")[-1] if text.count("|") else ""
         return self.stream_variables.get(text.split("|")[0], fallback_value)
 
+    def graph_var(self, text: str) -> str:
+        """
+        Refers to the value of a variable which is shared by all streams of
+        the graph, see :mod:`~story_graph.graph_variables`.
+
+        .. code-block:: markdown
+
+            {graph_var}`votes|0` listeners have voted
+
+        Like :func:`~GencasterRenderer.var` a fallback value can be provided via ``|``.
+        """
+        fallback_value = text.split("|")[-1] if text.count("|") else ""
+        return self.graph_variables.get(text.split("|")[0], fallback_value)
+
     def raw_ssml(self, text: str) -> str:
         """
         Allows to use raw ssml statements to extend functionality that may not be covered by this parser.
@@ -254,3 +414,20 @@ class GencasterRenderer(BaseRenderer):
     def render_document(self, token: block_token.Document) -> str:
         text = super().render_document(token)
         return f"<speak>{text}</speak>"
+
+
+class TemplateRenderer(GencasterRenderer):
+    """Renders the static tokens of the Gencaster markdown dialect and
+    leaves a :data:`~SLOT_MARKER` for each dynamic token,
+    see :func:`~compile_markdown`.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.slots: List[TemplateSlot] = []
+
+    def render_gencaster_token(self, token: GencasterToken) -> str:
+        if token.target in self.DYNAMIC_TOKEN_TYPES:
+            self.slots.append(TemplateSlot(target=token.target, content=token.content))
+            return SLOT_MARKER
+        return super().render_gencaster_token(token)
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.4 on 2026-10-18 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "story_graph",
+            "0016_nodedoor_remove_edge_unique_edge_remove_edge_in_node_and_more",
+        ),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="edge",
+            name="weight",
+            field=models.FloatField(
+                default=1.0,
+                help_text="If multiple edges are connected to the same door, the next node is picked proportionally to the weights of the edges. An edge with a weight of 0 will only be followed if all other edges have a weight of 0 as well.",
+                verbose_name="Weight",
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.4 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("story_graph", "0017_edge_weight"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scriptcell",
+            name="concurrent_group",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                help_text="Consecutive cells of the same group are started at the same time and the node continues once all of them have finished.",
+                null=True,
+                verbose_name="Concurrent group",
+            ),
+        ),
+    ]
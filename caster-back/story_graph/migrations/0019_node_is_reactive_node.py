@@ -0,0 +1,21 @@
+# Generated by Django 4.2.4 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("story_graph", "0018_scriptcell_concurrent_group"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="node",
+            name="is_reactive_node",
+            field=models.BooleanField(
+                default=False,
+                help_text="If none of the conditions of the out doors is true, wait until a stream variable which is used within the conditions changes and evaluate them again instead of using the default door.",
+                verbose_name="Is reactive node?",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("story_graph", "0019_node_is_reactive_node"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="graph",
+            name="incrementable_graph_variables",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="Comma separated keys of the graph variables which any listener may increment, e.g. votes",
+                max_length=1024,
+                verbose_name="Incrementable graph variables",
+            ),
+        ),
+    ]
@@ -6,6 +6,7 @@ Models
 import ast
 import logging
 import uuid
+from typing import List
 
 from asgiref.sync import async_to_sync, sync_to_async
 from django.core.exceptions import ValidationError
@@ -153,6 +154,26 @@ class Graph(models.Model):
         null=False,
     )
 
+    incrementable_graph_variables = models.CharField(
+        max_length=1024,
+        verbose_name=_("Incrementable graph variables"),
+        help_text=_(
+            "Comma separated keys of the graph variables which any listener may increment, e.g. votes"
+        ),
+        default="",
+        blank=True,
+        null=False,
+    )
+
+    @property
+    def incrementable_graph_variable_keys(self) -> List[str]:
+        """See :attr:`~Graph.incrementable_graph_variables`."""
+        return [
+            key.strip()
+            for key in self.incrementable_graph_variables.split(",")
+            if key.strip()
+        ]
+
     async def aget_entry_node(self) -> "Node":
         """
         See :func:`Graph.create_entry_node`.
@@ -185,12 +206,17 @@ class Graph(models.Model):
 
 
 def update_graph_db_to_ws(graph_uuid: uuid.UUID):
+    # avoid circular import
+    from .snapshot import GraphSnapshotCache
+
+    def on_commit():
+        GraphSnapshotCache.invalidate(graph_uuid=graph_uuid)
+        async_to_sync(GenCasterChannel.send_graph_update)(graph_uuid)
+
     # sorry for this atrocity - there seems to be race conditions with signals
     # which makes updates out-dated, see
     # https://docs.djangoproject.com/en/dev/topics/db/transactions/#performing-actions-after-commit
-    transaction.on_commit(
-        lambda: async_to_sync(GenCasterChannel.send_graph_update)(graph_uuid)
-    )
+    transaction.on_commit(on_commit)
 
 
 @receiver(signals.post_save, sender=Graph, dispatch_uid="update_graph_ws")
@@ -258,6 +284,14 @@ class Node(models.Model):
         default=False,
     )
 
+    is_reactive_node = models.BooleanField(
+        verbose_name="Is reactive node?",
+        help_text=_(
+            "If none of the conditions of the out doors is true, wait until a stream variable which is used within the conditions changes and evaluate them again instead of using the default door."
+        ),
+        default=False,
+    )
+
     async def aget_default_out_door(self) -> "NodeDoor":
         return await sync_to_async(self.get_default_out_door)()
 
@@ -312,12 +346,17 @@ class Node(models.Model):
 
 
 def update_node_db_to_ws(node_uuid: uuid.UUID):
+    # avoid circular import
+    from .snapshot import GraphSnapshotCache
+
+    def on_commit():
+        GraphSnapshotCache.invalidate(node_uuid=node_uuid)
+        async_to_sync(GenCasterChannel.send_node_update)(node_uuid)
+
     # sorry for this atrocity - there seems to be race conditions with signals
     # which makes updates out-dated, see
     # https://docs.djangoproject.com/en/dev/topics/db/transactions/#performing-actions-after-commit
-    transaction.on_commit(
-        lambda: async_to_sync(GenCasterChannel.send_node_update)(node_uuid)
-    )
+    transaction.on_commit(on_commit)
 
 
 @receiver(signals.post_delete, sender=Node, dispatch_uid="delete_node_ws")
@@ -553,6 +592,16 @@ class Edge(models.Model):
         null=True,
     )
 
+    weight = models.FloatField(
+        default=1.0,
+        verbose_name=_("Weight"),
+        help_text=_(
+            "If multiple edges are connected to the same door, the next node "
+            "is picked proportionally to the weights of the edges. "
+            "An edge with a weight of 0 will only be followed if all other edges have a weight of 0 as well."
+        ),
+    )
+
     def save(self, *args, **kwargs):
         """Checks if ``in_node_door`` and ``out_node_door`` have their
         respective types in order to avoid any *wrong* directions within
@@ -738,6 +787,15 @@ class ScriptCell(models.Model):
         default=0,
     )
 
+    concurrent_group = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Concurrent group"),
+        help_text=_(
+            "Consecutive cells of the same group are started at the same time and the node continues once all of them have finished."
+        ),
+    )
+
     audio_cell = models.OneToOneField(
         AudioCell,
         on_delete=models.CASCADE,
@@ -0,0 +1,78 @@
+"""
+Pacing
+======
+
+A graph can contain a cycle of nodes which neither play anything nor change
+any :class:`~stream.models.StreamVariable`, e.g. a loop which polls a node door
+until a listener has entered something.
+Without any pacing such a cycle would hop from node to node every
+``step_delay`` seconds, each hop costing some database queries.
+
+:class:`~HotLoopPacer` detects such cycles and backs off exponentially up to
+``ENGINE_MAX_STEP_DELAY_SEC`` seconds.
+The :class:`~story_graph.engine.Engine` waits for this time or until a
+stream variable changes, whatever happens first, so a graph which waits for
+an input of a listener still reacts immediately.
+
+A hop counts as progress if the node yielded an instruction or a dialog or if
+any stream variable has been changed, in which case the pacing gets reset, so
+busy graphs are not slowed down.
+"""
+
+import logging
+from dataclasses import dataclass, field
+from typing import Set
+from uuid import UUID
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class HotLoopPacer:
+    """Calculates the delay between two hops of an engine.
+
+    :param step_delay: Seconds between two hops which make progress
+    :param max_delay: Upper bound of the backoff in seconds, a value below
+        ``step_delay`` disables the backoff
+    :param min_backoff: Seconds of the first backoff
+    :param factor: Growth of the backoff per hop without progress
+    """
+
+    step_delay: float = 0.1
+    max_delay: float = 5.0
+    min_backoff: float = 0.2
+    factor: float = 2.0
+    # nodes which have been visited since the last progress
+    idle_nodes: Set[UUID] = field(default_factory=set)
+    idle_hops: int = 0
+
+    def reset(self) -> None:
+        self.idle_nodes.clear()
+        self.idle_hops = 0
+
+    @property
+    def is_backing_off(self) -> bool:
+        return self.idle_hops > 0
+
+    def step(self, node_uuid: UUID, progress: bool) -> float:
+        """Returns the delay in seconds after visiting a node.
+
+        :param progress: If the visit of the node made any progress
+        """
+        if progress:
+            self.reset()
+            return self.step_delay
+        if node_uuid not in self.idle_nodes:
+            # no cycle (yet)
+            self.idle_nodes.add(node_uuid)
+            return self.step_delay
+        if self.max_delay <= self.step_delay:
+            return self.step_delay
+        if self.idle_hops == 0:
+            log.debug(f"Detected a cycle without progress on node {node_uuid}")
+        # the exponent is bounded to avoid an overflow on long running cycles
+        delay = max(self.step_delay, self.min_backoff) * self.factor ** min(
+            self.idle_hops, 32
+        )
+        self.idle_hops += 1
+        return min(delay, self.max_delay)
@@ -0,0 +1,131 @@
+"""
+Parking
+=======
+
+A :class:`~story_graph.models.Node` which is marked as ``is_blocking_node``
+halts the execution of a graph on a stream.
+
+Instead of keeping the :class:`~story_graph.engine.Engine` and all of its
+resources alive while waiting, the engine registers the stream in
+:class:`~ParkedStreams` and returns.
+The subscription of the listener then only waits on the compact entry of the
+registry, so the stream stays alive until the listener disconnects, as if the
+engine would still halt on the node.
+The stream and its ``num_listeners`` are not touched by parking, so the
+stream stays assigned to the listener.
+An explicit :func:`~ParkedStreams.release` ends the parking, after which the
+subscription ends the stream.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from uuid import UUID
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class ParkedStream:
+    stream_uuid: UUID
+    graph_uuid: UUID
+    # the blocking node on which the stream halts
+    node_uuid: UUID
+    # unix timestamp
+    parked_at: float
+    _released: Optional[asyncio.Future] = field(default=None, repr=False)
+    # listeners of a shared stream wait on the same entry
+    _waiters: int = field(default=0, repr=False)
+
+    def release(self) -> None:
+        if self._released is not None and not self._released.done():
+            self._released.get_loop().call_soon_threadsafe(
+                self._released.set_result, None
+            )
+
+
+class ParkedStreams:
+    """Process wide registry of the streams which halt on a blocking node."""
+
+    _parked: Dict[UUID, ParkedStream] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def park(
+        cls,
+        stream_uuid: UUID,
+        graph_uuid: UUID,
+        node_uuid: UUID,
+    ) -> ParkedStream:
+        """Registers a stream as parked until it gets released or all of its
+        listeners have disconnected.
+        """
+        parked = ParkedStream(
+            stream_uuid=stream_uuid,
+            graph_uuid=graph_uuid,
+            node_uuid=node_uuid,
+            parked_at=time.time(),
+        )
+        with cls._lock:
+            if previous := cls._parked.get(stream_uuid):
+                previous.release()
+            cls._parked[stream_uuid] = parked
+        log.debug(f"Parked stream {stream_uuid} on node {node_uuid}")
+        return parked
+
+    @classmethod
+    def get(cls, stream_uuid: UUID) -> Optional[ParkedStream]:
+        return cls._parked.get(stream_uuid)
+
+    @classmethod
+    def pop(cls, stream_uuid: UUID) -> Optional[ParkedStream]:
+        with cls._lock:
+            return cls._parked.pop(stream_uuid, None)
+
+    @classmethod
+    def all(cls) -> List[ParkedStream]:
+        with cls._lock:
+            return list(cls._parked.values())
+
+    @classmethod
+    def release(cls, stream_uuid: UUID) -> bool:
+        """Ends the parking of a stream, so its waiting subscriptions end
+        the stream.
+        Returns ``False`` if the stream is not parked.
+        """
+        if parked := cls.pop(stream_uuid):
+            parked.release()
+            return True
+        return False
+
+    @classmethod
+    async def wait(cls, stream_uuid: UUID) -> None:
+        """Waits until a parked stream gets released, which does not happen
+        on its own.
+        Returns immediately if the stream is not parked.
+        The entry is removed once the last waiter has left, also if the
+        waiting task gets cancelled because the listener disconnected.
+        """
+        if (parked := cls.get(stream_uuid)) is None:
+            return
+        if parked._released is None:
+            parked._released = asyncio.get_running_loop().create_future()
+        parked._waiters += 1
+        try:
+            # shield the future as it is shared among all waiters
+            await asyncio.shield(parked._released)
+        finally:
+            parked._waiters -= 1
+            with cls._lock:
+                if not parked._waiters and cls._parked.get(stream_uuid) is parked:
+                    del cls._parked[stream_uuid]
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            for parked in cls._parked.values():
+                parked.release()
+            cls._parked.clear()
@@ -0,0 +1,229 @@
+"""
+Pre-warm
+========
+
+Synthesizes the markdown cells of a :class:`~story_graph.models.Graph` ahead
+of time, e.g. before opening an installation, so the first listeners do not
+need to wait for the text to speech conversion.
+
+Only markdown which does not depend on the state of the stream can be
+synthesized ahead, see :func:`~story_graph.markdown_parser.is_static_markdown`.
+Long texts are split into the same chunks as during playback,
+see :mod:`~stream.ssml`.
+Texts which already have a :class:`~stream.models.TextToSpeech` count as hits,
+all other texts get synthesized with a limited number of concurrent requests
+and are retried with an exponential backoff on failures.
+
+Use :func:`~prewarm_graph`, the management command ``prewarm_graph`` or the
+action of the graph admin, which runs in the background via
+:func:`~prewarm_graphs_in_background` and only logs the reports.
+
+.. code-block:: shell
+
+    python manage.py prewarm_graph <graph-uuid> --concurrency 4 --retries 3
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Counter, Dict, List
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from stream.models import TextToSpeech
+from stream.ssml import split_ssml
+
+from .markdown_parser import is_static_markdown, md_to_ssml
+from .models import CellType, Graph, ScriptCell
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class PrewarmReport:
+    """Statistics of a pre-warm of a graph.
+
+    ``hits`` counts the texts which were already synthesized, ``misses`` the
+    texts which needed to be synthesized, of which ``failures`` could not be
+    synthesized even after all retries.
+    """
+
+    graph_uuid: uuid.UUID
+    cells: int = 0
+    dynamic_cells: int = 0
+    texts: int = 0
+    hits: int = 0
+    misses: int = 0
+    failures: int = 0
+    retries: int = 0
+    duration: float = 0.0
+    synthesis_times: List[float] = field(default_factory=list)
+    errors: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def mean_synthesis_time(self) -> float:
+        if not self.synthesis_times:
+            return 0.0
+        return sum(self.synthesis_times) / len(self.synthesis_times)
+
+    @property
+    def max_synthesis_time(self) -> float:
+        return max(self.synthesis_times, default=0.0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns a JSON serializable representation of the report."""
+        return {
+            "graph_uuid": str(self.graph_uuid),
+            "cells": self.cells,
+            "dynamic_cells": self.dynamic_cells,
+            "texts": self.texts,
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "retries": self.retries,
+            "duration": self.duration,
+            "mean_synthesis_time": self.mean_synthesis_time,
+            "max_synthesis_time": self.max_synthesis_time,
+            "errors": dict(self.errors),
+        }
+
+    def summary(self) -> str:
+        lines = [
+            f"Markdown cells: {self.cells} ({self.dynamic_cells} depend on the stream and were skipped)",
+            f"Texts: {self.texts} ({self.hits} hits, {self.misses} misses)",
+            f"Synthesized: {self.misses - self.failures} in {self.duration:.2f}s "
+            f"(mean {self.mean_synthesis_time:.2f}s, max {self.max_synthesis_time:.2f}s, "
+            f"{self.retries} retries)",
+        ]
+        if self.failures:
+            lines.append(f"Failures: {self.failures}")
+            for error, count in self.errors.most_common(5):
+                lines.append(f"  {count}x {error}")
+        return "\n".join(lines)
+
+
+def get_static_texts(graph: Graph, report: PrewarmReport) -> List[str]:
+    """Returns the SSML chunks of all static markdown cells of a graph."""
+    texts: Dict[str, str] = {}
+    for cell_code in ScriptCell.objects.filter(
+        node__graph=graph,
+        cell_type=CellType.MARKDOWN,
+    ).values_list("cell_code", flat=True):
+        report.cells += 1
+        if not is_static_markdown(cell_code):
+            report.dynamic_cells += 1
+            continue
+        for chunk in split_ssml(md_to_ssml(cell_code), settings.TTS_CHUNK_CHARS):
+            texts.setdefault(TextToSpeech.get_text_hash(chunk), chunk)
+    return list(texts.values())
+
+
+async def _synthesize(
+    ssml_text: str,
+    report: PrewarmReport,
+    semaphore: asyncio.Semaphore,
+    retries: int,
+    retry_delay: float,
+) -> None:
+    async with semaphore:
+        for attempt in range(retries + 1):
+            start = time.monotonic()
+            try:
+                await TextToSpeech.acreate_from_text(ssml_text)
+                report.synthesis_times.append(time.monotonic() - start)
+                return
+            except Exception as e:
+                if attempt == retries:
+                    log.error(f"Could not synthesize '{ssml_text[0:100]}': {e}")
+                    report.failures += 1
+                    report.errors[f"{type(e).__name__}: {e}"] += 1
+                    return
+                report.retries += 1
+                await asyncio.sleep(retry_delay * 2**attempt)
+
+
+async def aprewarm_graph(
+    graph: Graph,
+    concurrency: int = 4,
+    retries: int = 3,
+    retry_delay: float = 1.0,
+) -> PrewarmReport:
+    """Async variant of :func:`~prewarm_graph`."""
+    start = time.monotonic()
+    report = PrewarmReport(graph.uuid)
+    texts = await sync_to_async(get_static_texts)(graph, report)
+    report.texts = len(texts)
+
+    existing_hashes = set(
+        [
+            text_hash
+            async for text_hash in TextToSpeech.objects.filter(
+                text_hash__in=[TextToSpeech.get_text_hash(t) for t in texts],
+                voice_name=TextToSpeech.VoiceNameChoices.DE_NEURAL2_C__FEMALE,
+            ).values_list("text_hash", flat=True)
+        ]
+    )
+    missing_texts = [
+        t for t in texts if TextToSpeech.get_text_hash(t) not in existing_hashes
+    ]
+    report.misses = len(missing_texts)
+    report.hits = report.texts - report.misses
+
+    semaphore = asyncio.Semaphore(concurrency)
+    await asyncio.gather(
+        *[
+            _synthesize(t, report, semaphore, retries, retry_delay)
+            for t in missing_texts
+        ]
+    )
+    report.duration = time.monotonic() - start
+    log.info(
+        f"Pre-warmed graph {graph.uuid}: {report.hits} hits, {report.misses} misses"
+    )
+    return report
+
+
+def prewarm_graph(
+    graph: Graph,
+    concurrency: int = 4,
+    retries: int = 3,
+    retry_delay: float = 1.0,
+) -> PrewarmReport:
+    """Synthesizes all static markdown cells of a graph which have not been
+    synthesized yet.
+
+    :param concurrency: Number of texts which get synthesized at the same time
+    :param retries: Number of retries of a failed synthesis
+    :param retry_delay: Seconds before the first retry, doubled on each retry
+    """
+    return async_to_sync(aprewarm_graph)(graph, concurrency, retries, retry_delay)
+
+
+def prewarm_graphs_in_background(graphs: List[Graph], **kwargs) -> threading.Thread:
+    """Runs :func:`~prewarm_graph` for each graph on a daemon thread,
+    so e.g. a request does not wait for the synthesis.
+    The reports are only logged.
+
+    :param kwargs: Passed to :func:`~prewarm_graph`
+    """
+
+    def prewarm() -> None:
+        try:
+            for graph in graphs:
+                try:
+                    report = prewarm_graph(graph, **kwargs)
+                except Exception as e:
+                    log.exception(f"Failed to prewarm {graph.name}: {e}")
+                    continue
+                log.info(f"Prewarmed {graph.name}: {report.summary()}")
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=prewarm, name="prewarm-graphs", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,360 @@
+"""
+Profiler
+========
+
+Allows to see where the :class:`~story_graph.engine.Engine` spends its time
+while executing a :class:`~story_graph.models.Graph`.
+
+If profiling is enabled via the ``ENGINE_PROFILING`` setting (or the
+``profile`` argument of the engine) the wall time, the time spent waiting on
+SuperCollider or stream variables and the number of database queries are
+recorded for each executed :class:`~story_graph.models.ScriptCell` and each
+evaluation of the :class:`~story_graph.models.NodeDoor` of a node.
+
+The measurements of all engines running a graph within this process are
+aggregated into histograms by :class:`~GraphProfile`, which can be accessed
+via GraphQL.
+As the profiles are not shared among processes, the GraphQL query is rejected
+if the engines run within separate processes via ``ENGINE_WORKERS``,
+see :mod:`~story_graph.worker`.
+The management command ``simulate_graph --profile`` allows to profile a graph
+via :mod:`~story_graph.simulator` without any listener.
+
+A cell which spent more than ``ENGINE_SLOW_CELL_SEC`` seconds without waiting
+gets logged as a warning into :class:`~stream.models.StreamLog`.
+"""
+
+import functools
+import logging
+import math
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from uuid import UUID
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from gencaster.db_logging import TO_DB_FLAG, LogKeyEnum
+from stream.models import Stream, StreamLog
+
+log = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets in seconds
+HISTOGRAM_BUCKETS: Tuple[float, ...] = (
+    0.001,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    60.0,
+    math.inf,
+)
+
+# category of the evaluation of the node doors, the other categories
+# are the values of :class:`~story_graph.models.CellType`
+DOOR_EVALUATION = "door_evaluation"
+
+
+@dataclass
+class ProfileSample:
+    node_uuid: UUID
+    category: str
+    cell_uuid: Optional[UUID] = None
+    wall_time: float = 0.0
+    wait_time: float = 0.0
+    queries: int = 0
+
+
+@dataclass
+class ProfileStats:
+    count: int = 0
+    wall_time: float = 0.0
+    wait_time: float = 0.0
+    queries: int = 0
+    max_wall_time: float = 0.0
+    # number of samples per bucket of :data:`HISTOGRAM_BUCKETS`
+    histogram: List[int] = field(default_factory=lambda: [0] * len(HISTOGRAM_BUCKETS))
+
+    @property
+    def mean_wall_time(self) -> float:
+        return self.wall_time / self.count if self.count else 0.0
+
+    def add(self, sample: ProfileSample) -> None:
+        self.count += 1
+        self.wall_time += sample.wall_time
+        self.wait_time += sample.wait_time
+        self.queries += sample.queries
+        self.max_wall_time = max(self.max_wall_time, sample.wall_time)
+        for i, bucket in enumerate(HISTOGRAM_BUCKETS):
+            if sample.wall_time <= bucket:
+                self.histogram[i] += 1
+                break
+
+    def merge(self, other: "ProfileStats") -> None:
+        self.count += other.count
+        self.wall_time += other.wall_time
+        self.wait_time += other.wait_time
+        self.queries += other.queries
+        self.max_wall_time = max(self.max_wall_time, other.max_wall_time)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+
+class GraphProfile:
+    """Aggregated :class:`~ProfileStats` of a graph per node and category.
+
+    All profiles are kept process wide, see :func:`~GraphProfile.get`.
+    """
+
+    _profiles: Dict[UUID, "GraphProfile"] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, graph_uuid: UUID) -> None:
+        self.graph_uuid = graph_uuid
+        self.stats: Dict[Tuple[UUID, str], ProfileStats] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, graph_uuid: UUID) -> "GraphProfile":
+        with cls._registry_lock:
+            if (profile := cls._profiles.get(graph_uuid)) is None:
+                profile = cls._profiles[graph_uuid] = cls(graph_uuid)
+            return profile
+
+    @classmethod
+    def clear(cls, graph_uuid: Optional[UUID] = None) -> None:
+        with cls._registry_lock:
+            if graph_uuid is None:
+                cls._profiles.clear()
+            else:
+                cls._profiles.pop(graph_uuid, None)
+
+    def __getstate__(self) -> Dict:
+        # allows to send a profile from a worker process of the simulator
+        with self._lock:
+            return {"graph_uuid": self.graph_uuid, "stats": self.stats}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__init__(state["graph_uuid"])  # type: ignore
+        self.stats = state["stats"]
+
+    def merge(self, other: "GraphProfile") -> None:
+        with self._lock:
+            for key, stats in other.stats.items():
+                self.stats.setdefault(key, ProfileStats()).merge(stats)
+
+    def add(self, sample: ProfileSample) -> None:
+        with self._lock:
+            key = (sample.node_uuid, sample.category)
+            if (stats := self.stats.get(key)) is None:
+                stats = self.stats[key] = ProfileStats()
+            stats.add(sample)
+
+    def _group_by(self, index: int) -> Dict:
+        grouped: Dict = {}
+        with self._lock:
+            for key, stats in self.stats.items():
+                grouped.setdefault(key[index], ProfileStats()).merge(stats)
+        return grouped
+
+    def by_node(self) -> Dict[UUID, ProfileStats]:
+        return self._group_by(0)
+
+    def by_category(self) -> Dict[str, ProfileStats]:
+        return self._group_by(1)
+
+    def summary(self, nodes: Optional[Dict[UUID, str]] = None) -> str:
+        """Lists the stats per category and per node.
+
+        :param nodes: Names of the nodes
+        """
+        nodes = nodes or {}
+        buckets = " ".join(f"<={b}s" for b in HISTOGRAM_BUCKETS[:-1])
+        lines = [f"Histogram buckets: {buckets} >{HISTOGRAM_BUCKETS[-2]}s"]
+        groups: List[Tuple[str, Dict]] = [
+            ("Category", self.by_category()),
+            ("Node", {nodes.get(k, k): v for k, v in self.by_node().items()}),
+        ]
+        for title, grouped in groups:
+            lines.append(f"{title}:")
+            for key, stats in sorted(
+                grouped.items(), key=lambda x: x[1].wall_time, reverse=True
+            ):
+                lines.append(
+                    f"  {key}: {stats.count}x mean {stats.mean_wall_time:.4f}s "
+                    f"max {stats.max_wall_time:.4f}s wait {stats.wait_time:.2f}s "
+                    f"queries {stats.queries} histogram {stats.histogram}"
+                )
+        return "\n".join(lines)
+
+
+# the sample which is measured within the current task
+_current_sample: ContextVar[Optional[ProfileSample]] = ContextVar(
+    "current_sample", default=None
+)
+
+
+def _count_queries(execute, sql, params, many, context):
+    # runs within the thread of sync_to_async, which copies the context
+    # of the calling task
+    if (sample := _current_sample.get()) is not None:
+        sample.queries += 1
+    return execute(sql, params, many, context)
+
+
+# all database connections of this process, as the connections of other
+# threads can not be accessed via ``connections``
+_connections: "weakref.WeakSet" = weakref.WeakSet()
+# number of profilers which need the queries to be counted
+_query_counter_users = 0
+_query_counter_lock = threading.Lock()
+
+
+def _install_query_counter(connection) -> None:
+    if _count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_queries)
+
+
+def _uninstall_query_counter(connection) -> None:
+    if _count_queries in connection.execute_wrappers:
+        connection.execute_wrappers.remove(_count_queries)
+
+
+def _track_connection(connection, **kwargs) -> None:
+    with _query_counter_lock:
+        _connections.add(connection)
+        if _query_counter_users > 0:
+            _install_query_counter(connection)
+
+
+def enable_query_counter() -> None:
+    """Counts the queries of all connections until every call has been
+    matched by :func:`~disable_query_counter`, so no query gets wrapped
+    while profiling is disabled.
+    """
+    global _query_counter_users
+    with _query_counter_lock:
+        _query_counter_users += 1
+        if _query_counter_users == 1:
+            for connection in list(_connections):
+                _install_query_counter(connection)
+
+
+def disable_query_counter() -> None:
+    global _query_counter_users
+    with _query_counter_lock:
+        _query_counter_users = max(_query_counter_users - 1, 0)
+        if _query_counter_users == 0:
+            for connection in list(_connections):
+                _uninstall_query_counter(connection)
+
+
+connection_created.connect(_track_connection, dispatch_uid="track_connections")
+# connections which have been created before, e.g. on the startup of the apps
+for _connection in connections.all():
+    _track_connection(_connection)
+
+
+def profile_wait(func: Callable) -> Callable:
+    """Accounts the time of an async method of the
+    :class:`~story_graph.engine.Engine` as waiting time if profiling is enabled.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return await func(self, *args, **kwargs)
+        with self.profiler.wait():
+            return await func(self, *args, **kwargs)
+
+    return wrapper
+
+
+class EngineProfiler:
+    """Measures the execution of a single engine and adds the results
+    to the :class:`~GraphProfile` of its graph.
+
+    :param stream: Stream to which slow cells will be logged
+    :param graph_profile: Profile which collects the measurements, defaults
+        to the process wide profile of the graph
+    :param slow_cell_threshold: Seconds a cell may spend without waiting
+        before it gets logged, defaults to ``ENGINE_SLOW_CELL_SEC``
+
+    The queries are counted until the profiler gets closed or
+    garbage collected, see :func:`~EngineProfiler.close`.
+    """
+
+    def __init__(
+        self,
+        graph_uuid: UUID,
+        stream: Optional[Stream] = None,
+        slow_cell_threshold: Optional[float] = None,
+        graph_profile: Optional[GraphProfile] = None,
+    ) -> None:
+        self.profile = graph_profile or GraphProfile.get(graph_uuid)
+        self.stream = stream
+        self.slow_cell_threshold: float = (
+            slow_cell_threshold
+            if slow_cell_threshold is not None
+            else settings.ENGINE_SLOW_CELL_SEC
+        )
+        enable_query_counter()
+        self._finalizer = weakref.finalize(self, disable_query_counter)
+
+    def close(self) -> None:
+        """Stops counting the queries if no other profiler needs them."""
+        self._finalizer()
+
+    @contextmanager
+    def measure(
+        self, category: str, node_uuid: UUID, cell_uuid: Optional[UUID] = None
+    ) -> Iterator[ProfileSample]:
+        sample = ProfileSample(
+            node_uuid=node_uuid, category=category, cell_uuid=cell_uuid
+        )
+        token = _current_sample.set(sample)
+        start = time.monotonic()
+        try:
+            yield sample
+        finally:
+            sample.wall_time = time.monotonic() - start
+            try:
+                _current_sample.reset(token)
+            except ValueError:
+                # a generator which gets closed from within another context
+                pass
+            self.profile.add(sample)
+            if cell_uuid is not None:
+                self._check_slow_cell(sample)
+
+    @contextmanager
+    def wait(self) -> Iterator[None]:
+        """Accounts the time as waiting time of the current sample."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            if (sample := _current_sample.get()) is not None:
+                sample.wait_time += time.monotonic() - start
+
+    def _check_slow_cell(self, sample: ProfileSample) -> None:
+        busy_time = sample.wall_time - sample.wait_time
+        if busy_time <= self.slow_cell_threshold:
+            return
+        log.warning(
+            f"Slow {sample.category} cell {sample.cell_uuid} on node {sample.node_uuid}: "
+            f"{busy_time:.2f}s without waiting ({sample.queries} queries)",
+            extra={
+                TO_DB_FLAG: self.stream is not None,
+                LogKeyEnum.STREAM.value: self.stream,
+                "origin": StreamLog.Origin.GRAPH_ENGINE,
+            },
+        )
@@ -0,0 +1,379 @@
+"""
+Sandbox
+=======
+
+Runs the synchronous Python code of a :class:`~story_graph.models.ScriptCell`
+within a pool of separate processes, so a tight loop or a blocking call
+within a cell does not block the asyncio loop of the
+:class:`~story_graph.engine.Engine` and therefore all other listeners.
+
+The sandbox is enabled via the ``ENGINE_SANDBOX`` setting.
+Only cells which can run without the engine are executed within the sandbox,
+see :func:`~can_run_in_sandbox` - any cell which awaits, yields or accesses
+the engine is still executed within the asyncio loop.
+
+The stream variables are copied into the sandbox and only the variables which
+were changed by the cell are copied back.
+Each cell has a budget of ``ENGINE_SANDBOX_CPU_SEC`` seconds of CPU time and
+``ENGINE_SANDBOX_TIMEOUT_SEC`` seconds of wall time, and each process of the pool
+is limited to ``ENGINE_SANDBOX_MEMORY_MB`` megabytes of memory.
+A cell which exceeds its time budget raises a :class:`~SandboxTimeout`.
+The wall time of a cell only starts once a process begins to execute it,
+so a cell which waits for a free process is not penalized.
+If a cell does not react to its time budget, only the process which executes
+it gets killed and replaced, so the cells of other listeners are not affected.
+
+.. note::
+
+    This module must not depend on Django as it gets imported within the
+    processes of the pool.
+"""
+
+import ast
+import asyncio
+import functools
+import itertools
+import logging
+import math
+import multiprocessing
+import multiprocessing.pool
+import os
+import random
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from .code_cache import code_cache
+
+log = logging.getLogger(__name__)
+
+# names within the namespace of a script cell which are only available
+# within the engine, see :func:`~story_graph.engine.Engine.get_engine_global_vars`
+ENGINE_ONLY_NAMES = frozenset(
+    [
+        "self",
+        "loop",
+        "asyncio",
+        "http",
+        "get_stream_variables",
+        "wait_for_stream_variable",
+        "graph_vars",
+        "Text",
+        "Dialog",
+        "Button",
+        "Checkbox",
+        "Input",
+    ]
+)
+
+
+class SandboxTimeout(Exception):
+    """The cell has exceeded its CPU or wall time budget."""
+
+    pass
+
+
+class SandboxError(Exception):
+    """The process which executed the cell has died or the sandbox
+    has been shut down.
+    """
+
+    pass
+
+
+@functools.lru_cache(maxsize=1024)
+def can_run_in_sandbox(cell_code: str) -> bool:
+    """Returns ``True`` if the cell code is synchronous and does not
+    access the engine, so it can be executed in a separate process.
+    """
+    try:
+        tree = compile(
+            cell_code,
+            "<script cell>",
+            "exec",
+            ast.PyCF_ONLY_AST | ast.PyCF_ALLOW_TOP_LEVEL_AWAIT,
+        )
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(
+            node, (ast.Await, ast.Yield, ast.YieldFrom, ast.AsyncFor, ast.AsyncWith)
+        ):
+            return False
+        if isinstance(node, ast.Name) and node.id in ENGINE_ONLY_NAMES:
+            return False
+    return True
+
+
+def _raise_timeout(signum, frame) -> None:
+    raise SandboxTimeout(f"Script cell exceeded its time budget (signal {signum})")
+
+
+# notifies the sandbox which process started to execute which cell
+_started_queue: Optional[Any] = None
+
+
+def _init_process(memory_limit: Optional[int], started_queue: Any) -> None:
+    import resource
+
+    # avoid importing it within the time budget of the first cell
+    import requests  # noqa: F401
+
+    global _started_queue
+    _started_queue = started_queue
+    signal.signal(signal.SIGXCPU, _raise_timeout)
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _get_sandbox_global_vars(variables: Dict[str, Any]) -> Dict[str, Any]:
+    import requests
+
+    return {
+        "__builtins__": {
+            "int": int,
+            "float": float,
+            "print": print,
+            "time": time,
+            "datetime": datetime,
+            "timedelta": timedelta,
+            "list": list,
+            "random": random,
+            "requests": requests,
+            "vars": variables,
+        }
+    }
+
+
+def _execute(
+    task_id: int,
+    cell_code: str,
+    variables: Dict[str, Any],
+    cpu_time: float,
+    timeout: float,
+) -> Dict[str, Any]:
+    """Runs within a process of the pool and returns the changed variables."""
+    import resource
+
+    if _started_queue is not None:
+        _started_queue.put((task_id, os.getpid()))
+    before = dict(variables)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_limit = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(
+        resource.RLIMIT_CPU,
+        (math.ceil(usage.ru_utime + usage.ru_stime + cpu_time), cpu_limit[1]),
+    )
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        loc: Dict[str, Any] = {}
+        exec(
+            # same wrapping as within the engine, so e.g. a return is possible
+            code_cache.compile(
+                "def __ex(): " + "".join(f"\n {l}" for l in cell_code.split("\n"))
+            ),
+            _get_sandbox_global_vars(variables),
+            loc,
+        )
+        loc["__ex"]()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        resource.setrlimit(resource.RLIMIT_CPU, cpu_limit)
+    return {
+        key: value
+        for key, value in variables.items()
+        if key not in before or before[key] != value
+    }
+
+
+def _set_result(future: asyncio.Future, result: Any) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: BaseException) -> None:
+    if not future.done():
+        future.set_exception(exception)
+
+
+class ScriptCellSandbox:
+    """A process wide pool of processes which execute script cells.
+
+    :param processes: Number of processes which are started upfront
+    :param cpu_time: Seconds of CPU time a cell may use
+    :param timeout: Seconds of wall time a cell may take
+    :param memory: Megabytes of memory a process may use, ``0`` for no limit
+    """
+
+    _sandbox: Optional["ScriptCellSandbox"] = None
+    _lock = threading.Lock()
+    # seconds between the checks if the process of a cell is still alive
+    poll_interval: float = 0.5
+
+    def __init__(
+        self,
+        processes: int = 2,
+        cpu_time: float = 5.0,
+        timeout: float = 30.0,
+        memory: int = 512,
+    ) -> None:
+        self.processes = processes
+        self.cpu_time = cpu_time
+        self.timeout = timeout
+        self.memory = memory
+        self._pool: Optional[multiprocessing.pool.Pool] = None
+        self._started_queue: Optional[Any] = None
+        self._task_ids = itertools.count()
+        # loop and futures of the start and the result of the running cells
+        self._tasks: Dict[
+            int, Tuple[asyncio.AbstractEventLoop, asyncio.Future, asyncio.Future]
+        ] = {}
+        self._tasks_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, **kwargs) -> "ScriptCellSandbox":
+        """Returns the sandbox of this process, which gets created with
+        ``kwargs`` on the first call.
+        """
+        with cls._lock:
+            if cls._sandbox is None:
+                cls._sandbox = cls(**kwargs)
+            return cls._sandbox
+
+    @classmethod
+    def shutdown_all(cls) -> None:
+        with cls._lock:
+            if cls._sandbox is not None:
+                cls._sandbox.shutdown()
+                cls._sandbox = None
+
+    def _get_pool(self) -> multiprocessing.pool.Pool:
+        if self._pool is None:
+            # avoid forking the threads and connections of the web server
+            method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+            context = multiprocessing.get_context(method)
+            self._started_queue = context.SimpleQueue()
+            # contrary to a ProcessPoolExecutor, a pool replaces a process
+            # which got killed without breaking the other processes
+            self._pool = context.Pool(
+                processes=self.processes,
+                initializer=_init_process,
+                initargs=(self.memory * 1024 * 1024, self._started_queue),
+            )
+            threading.Thread(
+                target=self._receive_started,
+                args=(self._started_queue,),
+                name="sandbox-started",
+                daemon=True,
+            ).start()
+        return self._pool
+
+    def _receive_started(self, started_queue: Any) -> None:
+        while (message := started_queue.get()) is not None:
+            task_id, pid = message
+            with self._tasks_lock:
+                task = self._tasks.get(task_id)
+            if task is None:
+                continue
+            loop, started, _ = task
+            try:
+                loop.call_soon_threadsafe(_set_result, started, pid)
+            except RuntimeError:
+                # the loop of the cell has been closed
+                pass
+
+    def _is_alive(self, pid: int) -> bool:
+        for process in getattr(self._pool, "_pool", []):
+            if process.pid == pid:
+                return process.is_alive()  # type: ignore
+        return False
+
+    def _kill(self, pid: int) -> None:
+        """Kills a single process, which gets replaced by the pool."""
+        if not self._is_alive(pid):
+            return
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def shutdown(self) -> None:
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        pool.terminate()
+        if self._started_queue is not None:
+            self._started_queue.put(None)
+            self._started_queue = None
+        with self._tasks_lock:
+            tasks, self._tasks = self._tasks, {}
+        for loop, _, finished in tasks.values():
+            try:
+                loop.call_soon_threadsafe(
+                    _set_exception, finished, SandboxError("Sandbox has been shut down")
+                )
+            except RuntimeError:
+                pass
+
+    async def run(self, cell_code: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        """Executes the cell code within the pool and returns the variables
+        which were changed by the cell.
+
+        Raises :class:`~SandboxTimeout` if the cell exceeds its time budget,
+        :class:`~SandboxError` if its process died, e.g. because of its
+        hard limits, and re-raises any exception of the cell.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        task_id = next(self._task_ids)
+        started: asyncio.Future = loop.create_future()
+        finished: asyncio.Future = loop.create_future()
+        with self._tasks_lock:
+            self._tasks[task_id] = (loop, started, finished)
+
+        def on_result(result: Dict[str, Any]) -> None:
+            loop.call_soon_threadsafe(_set_result, finished, result)
+
+        def on_error(e: BaseException) -> None:
+            loop.call_soon_threadsafe(_set_exception, finished, e)
+
+        try:
+            pool.apply_async(
+                _execute,
+                (task_id, cell_code, variables, self.cpu_time, self.timeout),
+                callback=on_result,
+                error_callback=on_error,
+            )
+            # waiting for a free process does not count as wall time
+            await asyncio.wait([started, finished], return_when=asyncio.FIRST_COMPLETED)
+            if finished.done():
+                return finished.result()  # type: ignore
+            pid: int = started.result()
+            # the signals within the process should be faster
+            deadline = loop.time() + self.timeout + 1.0
+            while True:
+                try:
+                    return await asyncio.wait_for(
+                        asyncio.shield(finished),
+                        max(min(self.poll_interval, deadline - loop.time()), 0),
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                if not self._is_alive(pid):
+                    raise SandboxError("The process of the script cell died")
+                if loop.time() >= deadline:
+                    log.warning(
+                        f"Script cell did not react to its timeout - kill process {pid}"
+                    )
+                    self._kill(pid)
+                    raise SandboxTimeout(f"Script cell exceeded {self.timeout} seconds")
+        finally:
+            with self._tasks_lock:
+                self._tasks.pop(task_id, None)
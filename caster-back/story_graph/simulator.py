@@ -0,0 +1,446 @@
+"""
+Simulator
+=========
+
+Runs random walks over a :class:`~story_graph.models.Graph` with the
+:class:`~story_graph.engine.Engine` but without SuperCollider, text to speech
+or any connected listener in order to gather statistics about a graph,
+such as the throughput of steps, which nodes can be reached and where
+a walk runs into a dead end.
+
+Any instruction for the :class:`~stream.models.StreamPoint` is replaced by
+:class:`~SimulatedStreamPoint` which finishes immediately and the
+:class:`~stream.models.StreamVariable` of a walk are only kept in memory.
+The walks share a copy of the graph variables, see
+:mod:`~story_graph.graph_variables`, so a simulation does not change the
+state of the listeners.
+Variables which would be set by a listener can be scripted by stating
+possible values per variable, of which one gets picked at random
+at the start of each walk.
+
+The walks are spread across a pool of processes, see :func:`~simulate`,
+or use the management command ``simulate_graph``.
+
+.. code-block:: shell
+
+    python manage.py simulate_graph <graph-uuid> --walks 10000 --var name=Alice,Bob
+"""
+
+import logging
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncGenerator, Counter, Dict, List, Optional, Union
+
+import django
+from asgiref.sync import async_to_sync
+from django.db import connections
+
+from stream.frontend_types import Dialog
+from stream.models import StreamInstruction
+
+from .engine import Engine, GraphDeadEnd, ScriptCellTimeout
+from .graph_variables import GraphVariables, InMemoryGraphVariableBackend
+from .models import Graph, Node
+from .profiler import EngineProfiler, GraphProfile
+from .snapshot import GraphSnapshotCache, NodeSnapshot
+from .variable_store import StreamVariableStore
+
+log = logging.getLogger(__name__)
+
+
+class SimulatedStreamPoint:
+    """Replaces a :class:`~stream.models.StreamPoint` by accepting all
+    instructions without sending them anywhere.
+    The returned instructions are already finished and are not stored in
+    the database.
+    """
+
+    def __init__(self) -> None:
+        self.instructions: int = 0
+
+    def _instruction(self, instruction_text: str) -> StreamInstruction:
+        self.instructions += 1
+        return StreamInstruction(
+            instruction_text=instruction_text,
+            state=StreamInstruction.InstructionState.FINISHED,
+        )
+
+    def speak_on_stream(self, ssml_text: str) -> StreamInstruction:
+        return self._instruction(ssml_text)
+
+    async def aspeak_on_stream(self, ssml_text: str) -> StreamInstruction:
+        return self._instruction(ssml_text)
+
+    def send_raw_instruction(self, instruction_text: str) -> StreamInstruction:
+        return self._instruction(instruction_text)
+
+    def play_audio_file(
+        self, audio_file: Any, playback_type: Any = None, queue: bool = False
+    ):
+        return self._instruction(str(audio_file))
+
+
+class SimulatedStream:
+    """Replaces a :class:`~stream.models.Stream` which is not stored in the database."""
+
+    def __init__(self) -> None:
+        self.uuid = uuid.uuid4()
+        self.num_listeners = 0
+        self.stream_point = SimulatedStreamPoint()
+
+
+class SimulatedVariableStore(StreamVariableStore):
+    """Keeps the variables of a walk only in memory."""
+
+    async def aload(self) -> None:
+        pass
+
+    async def aflush(self) -> None:
+        for key in self._dirty:
+            self._values[key] = str(self._values[key])
+        self._dirty.clear()
+
+    async def aclose(self) -> None:
+        pass
+
+
+class SimulationEngine(Engine):
+    """An :class:`~story_graph.engine.Engine` which does not wait on any
+    instruction or listener and keeps track of the visited nodes.
+
+    :param variables: Initial stream variables of the walk
+    :param graph_profile: Profiles the walk if set, see :mod:`~story_graph.profiler`
+    :param seed: Seed of the random generator which picks the edges and
+        which is available as ``random`` within the script cells
+    :param graph_variables: Graph variables of the walk, defaults to
+        empty variables which are only kept in memory
+    """
+
+    def __init__(
+        self,
+        graph: Graph,
+        variables: Optional[Dict[str, str]] = None,
+        graph_profile: Optional[GraphProfile] = None,
+        seed: Optional[int] = None,
+        graph_variables: Optional[GraphVariables] = None,
+    ):
+        stream = SimulatedStream()
+        super().__init__(
+            graph,
+            stream,  # type: ignore
+            raise_exceptions=False,
+            run_cleanup_procedure=False,
+            profile=False,
+            lookahead_synthesis=False,
+            seed=seed,
+        )
+        if graph_profile is not None:
+            self.profiler = EngineProfiler(graph.uuid, graph_profile=graph_profile)
+        self.variable_store = SimulatedVariableStore(stream)  # type: ignore
+        self.variable_store.update(variables or {})
+        # never access the variables of the listeners
+        self.graph_variables = graph_variables or GraphVariables(
+            graph.uuid, backend=InMemoryGraphVariableBackend()
+        )
+        self.blocking_time = 0
+        self.step_delay = 0.0
+        self.max_step_delay = 0.0
+        # instructions are not played, so there is nothing to stream
+        self.chunk_chars = 0
+        self.path: List[uuid.UUID] = []
+        self.dead_end: Optional[uuid.UUID] = None
+        self.timeouts: int = 0
+
+    async def wait_for_finished_instruction(
+        self,
+        instruction: StreamInstruction,
+        timeout: float = 300.0,
+        interval: float = 0.2,
+    ) -> None:
+        pass
+
+    async def wait_for_stream_variable(
+        self, name: str, timeout: float = 100.0, update_speed: float = 0.5
+    ) -> str:
+        """A variable which has not been scripted will never be set,
+        so we raise a :class:`~story_graph.engine.ScriptCellTimeout` immediately.
+        """
+        if name in self.variable_store:
+            return str(self.variable_store[name])
+        raise ScriptCellTimeout()
+
+    def handle_cell_exception(self, e: Exception) -> None:
+        """A timeout is expected within a simulation, e.g. on a variable
+        which is only set by a listener, so it is only counted.
+        """
+        if isinstance(e, ScriptCellTimeout):
+            self.timeouts += 1
+            return
+        super().handle_cell_exception(e)
+
+    async def checkpoint(
+        self, node: Optional[Union[Node, NodeSnapshot]], flush: bool = False
+    ) -> None:
+        pass
+
+    async def flush_checkpoint(self, force: bool = True) -> None:
+        pass
+
+    async def execute_node(
+        self, node: Union[Node, NodeSnapshot], blocking_sleep_time: int = 10000
+    ) -> AsyncGenerator[Union[StreamInstruction, Dialog], None]:
+        self.path.append(node.uuid)  # type: ignore
+        async for instruction in super().execute_node(node, blocking_sleep_time):
+            yield instruction
+
+    async def get_next_node(self) -> NodeSnapshot:
+        try:
+            return await super().get_next_node()
+        except GraphDeadEnd as e:
+            self.dead_end = self._current_node.uuid  # type: ignore
+            raise e
+
+
+@dataclass
+class SimulationReport:
+    """Aggregated statistics of all walks of a simulation.
+
+    ``path_lengths`` counts the walks per number of visited nodes
+    and ``dead_ends`` counts the walks per node on which a walk could not
+    continue.
+    Walks which reached ``max_steps`` are counted as ``exhausted_walks``
+    and script cells which timed out as ``timeouts``.
+    """
+
+    graph_uuid: uuid.UUID
+    nodes: Dict[uuid.UUID, str] = field(default_factory=dict)
+    walks: int = 0
+    steps: int = 0
+    exhausted_walks: int = 0
+    timeouts: int = 0
+    duration: float = 0.0
+    node_visits: Counter[uuid.UUID] = field(default_factory=Counter)
+    dead_ends: Counter[uuid.UUID] = field(default_factory=Counter)
+    path_lengths: Counter[int] = field(default_factory=Counter)
+    errors: Counter[str] = field(default_factory=Counter)
+    profile: Optional[GraphProfile] = None
+
+    @property
+    def steps_per_second(self) -> float:
+        return self.steps / self.duration if self.duration else 0.0
+
+    @property
+    def coverage(self) -> float:
+        """Ratio of nodes which have been visited by at least one walk."""
+        return len(self.node_visits) / len(self.nodes) if self.nodes else 0.0
+
+    @property
+    def unvisited_nodes(self) -> List[uuid.UUID]:
+        return [n for n in self.nodes.keys() if n not in self.node_visits]
+
+    @property
+    def mean_path_length(self) -> float:
+        walks = sum(self.path_lengths.values())
+        if not walks:
+            return 0.0
+        return sum(k * v for k, v in self.path_lengths.items()) / walks
+
+    def add_walk(self, engine: SimulationEngine, max_steps: int) -> None:
+        self.walks += 1
+        self.steps += len(engine.path)
+        self.node_visits.update(engine.path)
+        self.path_lengths[len(engine.path)] += 1
+        self.timeouts += engine.timeouts
+        if engine.dead_end:
+            self.dead_ends[engine.dead_end] += 1
+        elif len(engine.path) >= max_steps:
+            self.exhausted_walks += 1
+
+    def merge(self, other: "SimulationReport") -> None:
+        self.nodes.update(other.nodes)
+        self.walks += other.walks
+        self.steps += other.steps
+        self.exhausted_walks += other.exhausted_walks
+        self.timeouts += other.timeouts
+        self.node_visits.update(other.node_visits)
+        self.dead_ends.update(other.dead_ends)
+        self.path_lengths.update(other.path_lengths)
+        self.errors.update(other.errors)
+        if other.profile is not None:
+            if self.profile is None:
+                self.profile = GraphProfile(self.graph_uuid)
+            self.profile.merge(other.profile)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns a JSON serializable representation of the report."""
+        return {
+            "graph_uuid": str(self.graph_uuid),
+            "nodes": {str(k): v for k, v in self.nodes.items()},
+            "walks": self.walks,
+            "steps": self.steps,
+            "exhausted_walks": self.exhausted_walks,
+            "timeouts": self.timeouts,
+            "duration": self.duration,
+            "steps_per_second": self.steps_per_second,
+            "coverage": self.coverage,
+            "mean_path_length": self.mean_path_length,
+            "node_visits": {str(k): v for k, v in self.node_visits.items()},
+            "unvisited_nodes": [str(n) for n in self.unvisited_nodes],
+            "dead_ends": {str(k): v for k, v in self.dead_ends.items()},
+            "path_lengths": dict(sorted(self.path_lengths.items())),
+            "errors": dict(self.errors),
+            "profile": {
+                "by_category": {
+                    k: asdict(v) for k, v in self.profile.by_category().items()
+                },
+                "by_node": {
+                    str(k): asdict(v) for k, v in self.profile.by_node().items()
+                },
+            }
+            if self.profile is not None
+            else None,
+        }
+
+    def summary(self) -> str:
+        lines = [
+            f"Walks: {self.walks} ({self.exhausted_walks} reached max steps)",
+            f"Steps: {self.steps} in {self.duration:.2f}s ({self.steps_per_second:.1f} steps/s)",
+            f"Coverage: {self.coverage:.1%} of {len(self.nodes)} nodes",
+            f"Mean path length: {self.mean_path_length:.1f}",
+        ]
+        if unvisited_nodes := self.unvisited_nodes:
+            lines.append("Unvisited nodes:")
+            lines += [f"  {self.nodes[n]} ({n})" for n in unvisited_nodes]
+        if self.dead_ends:
+            lines.append("Dead ends:")
+            lines += [
+                f"  {self.nodes.get(n, n)} ({n}): {c}"
+                for n, c in self.dead_ends.most_common()
+            ]
+        if self.timeouts:
+            lines.append(f"Script cell timeouts: {self.timeouts}")
+        if self.errors:
+            lines.append("Errors:")
+            lines += [f"  {e}: {c}" for e, c in self.errors.most_common()]
+        lines.append("Path lengths:")
+        lines += [f"  {k}: {v}" for k, v in sorted(self.path_lengths.items())]
+        return "\n".join(lines)
+
+
+async def asimulate_walks(
+    graph: Graph,
+    walks: int,
+    max_steps: int = 100,
+    variables: Optional[Dict[str, List[str]]] = None,
+    seed: Optional[int] = None,
+    profile: bool = False,
+) -> SimulationReport:
+    """Runs the walks one after another within the current process.
+
+    :param variables: Possible values per stream variable
+    :param seed: Seeds the choice of the variables, of the edges and of
+        ``random`` within the script cells of each walk
+    :param profile: Collects a :class:`~story_graph.profiler.GraphProfile` of all walks
+    """
+    rng = random.Random(seed)
+    snapshot = await GraphSnapshotCache.aget(graph)
+    report = SimulationReport(
+        graph_uuid=graph.uuid,
+        nodes={n.uuid: n.name for n in snapshot.nodes.values()},
+        profile=GraphProfile(graph.uuid) if profile else None,
+    )
+    variables = variables or {}
+    # the walks share a copy of the current graph variables
+    graph_variables = GraphVariables(graph.uuid, backend=InMemoryGraphVariableBackend())
+    for key, value in (await GraphVariables(graph.uuid).get_all()).items():
+        await graph_variables.set(key, value)
+    start_time = time.monotonic()
+    for _ in range(walks):
+        engine = SimulationEngine(
+            graph,
+            {k: rng.choice(v) for k, v in variables.items() if v},
+            graph_profile=report.profile,
+            seed=rng.getrandbits(64),
+            graph_variables=graph_variables,
+        )
+        try:
+            async for _instruction in engine.start(max_steps=max_steps):
+                pass
+        except Exception as e:
+            report.errors[f"{type(e).__name__}: {e}"] += 1
+        report.add_walk(engine, max_steps)
+    report.duration = time.monotonic() - start_time
+    return report
+
+
+def _simulate_walks(
+    graph_uuid: uuid.UUID,
+    walks: int,
+    max_steps: int,
+    variables: Optional[Dict[str, List[str]]],
+    seed: Optional[int],
+    profile: bool,
+) -> SimulationReport:
+    graph = Graph.objects.get(uuid=graph_uuid)
+    report = async_to_sync(asimulate_walks)(
+        graph,
+        walks,
+        max_steps=max_steps,
+        variables=variables,
+        seed=seed,
+        profile=profile,
+    )
+    connections.close_all()
+    return report
+
+
+def simulate(
+    graph: Graph,
+    walks: int = 1000,
+    max_steps: int = 100,
+    variables: Optional[Dict[str, List[str]]] = None,
+    processes: Optional[int] = None,
+    seed: Optional[int] = None,
+    profile: bool = False,
+) -> SimulationReport:
+    """Simulates ``walks`` random walks of at most ``max_steps`` nodes on a graph
+    which are spread across a pool of processes.
+
+    :param variables: Possible values per stream variable, of which one is picked
+        at random at the start of each walk, e.g. ``{"name": ["Alice", "Bob"]}``
+    :param processes: Number of processes, defaults to the number of CPUs.
+        Using ``1`` runs all walks within the current process.
+    :param seed: Makes the simulation reproducible for the same number of processes
+    :param profile: Collects a :class:`~story_graph.profiler.GraphProfile` of all walks
+    """
+    start_time = time.monotonic()
+    if processes == 1:
+        report = _simulate_walks(graph.uuid, walks, max_steps, variables, seed, profile)
+        report.duration = time.monotonic() - start_time
+        return report
+
+    chunks = processes or os.cpu_count() or 1
+    # forked processes must not share the database connection of this process
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=chunks, initializer=django.setup) as pool:
+        futures = [
+            pool.submit(
+                _simulate_walks,
+                graph.uuid,
+                walks // chunks + (1 if i < walks % chunks else 0),
+                max_steps,
+                variables,
+                seed + i if seed is not None else None,
+                profile,
+            )
+            for i in range(chunks)
+        ]
+        report = SimulationReport(graph_uuid=graph.uuid)
+        for future in futures:
+            report.merge(future.result())
+    report.duration = time.monotonic() - start_time
+    return report
@@ -0,0 +1,405 @@
+"""
+Snapshot
+========
+
+A compiled and immutable in-memory representation of a
+:class:`~story_graph.models.Graph` which is used by the
+:class:`~story_graph.engine.Engine` to traverse a graph without
+querying the database on each step.
+
+A snapshot is loaded once per graph and shared by all engines running
+this graph via :class:`~GraphSnapshotCache`.
+Any update of the graph which gets send as a
+:class:`~gencaster.distributor.GraphUpdateMessage` or
+:class:`~gencaster.distributor.NodeUpdateMessage` invalidates the snapshot,
+so the next access will load a fresh snapshot.
+This also applies to the snapshots of other processes, e.g. an engine
+worker, as the messages are received via the channel layer.
+"""
+
+import ast
+import asyncio
+import itertools
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from types import CodeType, MappingProxyType
+from typing import Dict, FrozenSet, List, Mapping, Optional, Tuple
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
+
+from gencaster.distributor import GenCasterChannel
+
+from .code_cache import code_cache
+from .models import AudioCell, Edge, Graph, Node, NodeDoor, ScriptCell
+
+log = logging.getLogger(__name__)
+
+# names within a door condition which allow to access any stream variable,
+# see :func:`~story_graph.engine.Engine._get_door_global_vars`
+DYNAMIC_VARIABLE_ACCESS = frozenset(
+    ["self", "get_stream_variables", "wait_for_stream_variable"]
+)
+
+
+@dataclass(frozen=True)
+class ScriptCellSnapshot:
+    uuid: UUID
+    cell_type: str
+    cell_code: str
+    audio_cell: Optional[AudioCell]
+    concurrent_group: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class NodeDoorSnapshot:
+    uuid: UUID
+    name: str
+    code: str
+    is_default: bool
+    # nodes which are connected via an edge to this door
+    next_nodes: Tuple[UUID, ...]
+    # compiled code, ``None`` if the code is invalid
+    condition: Optional[CodeType]
+    # cumulative weights of the edges to ``next_nodes``,
+    # ``None`` if all edges are weighted equally
+    cum_weights: Optional[Tuple[float, ...]] = None
+    # stream variables which are used by the condition,
+    # ``None`` if the condition may access any variable
+    dependencies: Optional[FrozenSet[str]] = frozenset()
+
+    def pick_next_node(self, rng: random.Random) -> UUID:
+        """Picks one of the ``next_nodes`` according to the weights of the edges.
+        Raises an :class:`IndexError` if the door is not connected.
+        """
+        if self.cum_weights is None:
+            return rng.choice(self.next_nodes)
+        return rng.choices(self.next_nodes, cum_weights=self.cum_weights)[0]
+
+    @staticmethod
+    def extract_dependencies(code: str) -> Optional[FrozenSet[str]]:
+        """Returns the keys of the stream variables which are accessed via
+        ``vars["key"]``, ``vars.get("key")`` or ``"key" in vars`` within the condition.
+        Returns ``None`` if the variables are accessed in any other way, e.g.
+        by a key which is not a constant, so any variable could be a dependency.
+        """
+        try:
+            tree = ast.parse(code, mode="eval")
+        except SyntaxError:
+            return frozenset()
+        dependencies = set()
+        # ids of the vars names which are part of a known access
+        handled = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id in DYNAMIC_VARIABLE_ACCESS:
+                return None
+            target: Optional[ast.AST] = None
+            key: Optional[ast.AST] = None
+            if isinstance(node, ast.Subscript):
+                target, key = node.value, node.slice
+            elif (
+                isinstance(node, ast.Call)
+                and isinstance(node.func, ast.Attribute)
+                and node.func.attr == "get"
+                and node.args
+            ):
+                target, key = node.func.value, node.args[0]
+            elif (
+                isinstance(node, ast.Compare)
+                and len(node.ops) == 1
+                and isinstance(node.ops[0], (ast.In, ast.NotIn))
+            ):
+                target, key = node.comparators[0], node.left
+            if not (isinstance(target, ast.Name) and target.id == "vars"):
+                continue
+            if not (isinstance(key, ast.Constant) and isinstance(key.value, str)):
+                return None
+            dependencies.add(key.value)
+            handled.add(id(target))
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id == "vars":
+                if id(node) not in handled:
+                    return None
+        return frozenset(dependencies)
+
+    @staticmethod
+    def accumulate_weights(weights: List[float]) -> Optional[Tuple[float, ...]]:
+        if len(set(weights)) <= 1 or sum(weights) <= 0:
+            return None
+        return tuple(itertools.accumulate(max(w, 0.0) for w in weights))
+
+    def __str__(self) -> str:
+        return self.name
+
+
+@dataclass(frozen=True)
+class NodeSnapshot:
+    uuid: UUID
+    name: str
+    is_entry_node: bool
+    is_blocking_node: bool
+    script_cells: Tuple[ScriptCellSnapshot, ...]
+    # ordered like :class:`~story_graph.models.NodeDoor`, so the default door is last
+    out_doors: Tuple[NodeDoorSnapshot, ...]
+    is_reactive_node: bool = False
+
+    @property
+    def default_out_door(self) -> Optional[NodeDoorSnapshot]:
+        for door in self.out_doors:
+            if door.is_default:
+                return door
+        return None
+
+    @property
+    def door_dependencies(self) -> Optional[FrozenSet[str]]:
+        """The stream variables which are used by the conditions of the
+        out doors, ``None`` if any variable could be used.
+        """
+        dependencies: FrozenSet[str] = frozenset()
+        for door in self.out_doors:
+            if door.is_default:
+                continue
+            if door.dependencies is None:
+                return None
+            dependencies |= door.dependencies
+        return dependencies
+
+    def __str__(self) -> str:
+        return self.name
+
+
+@dataclass(frozen=True)
+class GraphSnapshot:
+    uuid: UUID
+    nodes: Mapping[UUID, NodeSnapshot]
+    entry_node_uuid: Optional[UUID]
+
+    @property
+    def entry_node(self) -> NodeSnapshot:
+        """Raises :class:`~story_graph.models.Node.DoesNotExist` if the graph
+        has no entry node, see :func:`~story_graph.models.Graph.acreate_entry_node`.
+        """
+        if self.entry_node_uuid is None:
+            raise Node.DoesNotExist(f"Graph {self.uuid} has no entry node")
+        return self.nodes[self.entry_node_uuid]
+
+    @staticmethod
+    def _compile_condition(node_door: NodeDoor) -> Optional[CodeType]:
+        try:
+            return code_cache.compile(node_door.code, mode="eval")
+        except SyntaxError as e:
+            log.debug(f"Invalid code on node door {node_door}: {e}")
+            return None
+
+    @classmethod
+    def from_graph(cls, graph_uuid: UUID) -> "GraphSnapshot":
+        """Loads the graph from the database with a fixed number of queries,
+        independent of the size of the graph.
+        """
+        script_cells: Dict[UUID, List[ScriptCellSnapshot]] = {}
+        script_cell: ScriptCell
+        for script_cell in ScriptCell.objects.filter(
+            node__graph_id=graph_uuid
+        ).select_related("audio_cell", "audio_cell__audio_file"):
+            script_cells.setdefault(script_cell.node_id, []).append(  # type: ignore
+                ScriptCellSnapshot(
+                    uuid=script_cell.uuid,
+                    cell_type=script_cell.cell_type,
+                    cell_code=script_cell.cell_code,
+                    audio_cell=script_cell.audio_cell,
+                    concurrent_group=script_cell.concurrent_group,
+                )
+            )
+
+        next_nodes: Dict[UUID, List[UUID]] = {}
+        weights: Dict[UUID, List[float]] = {}
+        for out_node_door_id, in_node_id, weight in (
+            Edge.objects.filter(
+                out_node_door__node__graph_id=graph_uuid,
+                in_node_door__isnull=False,
+            )
+            .order_by("uuid")
+            .values_list("out_node_door_id", "in_node_door__node_id", "weight")
+        ):
+            next_nodes.setdefault(out_node_door_id, []).append(in_node_id)
+            weights.setdefault(out_node_door_id, []).append(weight)
+
+        out_doors: Dict[UUID, List[NodeDoorSnapshot]] = {}
+        node_door: NodeDoor
+        for node_door in NodeDoor.objects.filter(
+            node__graph_id=graph_uuid,
+            door_type=NodeDoor.DoorType.OUTPUT,
+        ):
+            out_doors.setdefault(node_door.node_id, []).append(  # type: ignore
+                NodeDoorSnapshot(
+                    uuid=node_door.uuid,
+                    name=node_door.name,
+                    code=node_door.code,
+                    is_default=node_door.is_default,
+                    next_nodes=tuple(next_nodes.get(node_door.uuid, [])),
+                    condition=cls._compile_condition(node_door),
+                    cum_weights=NodeDoorSnapshot.accumulate_weights(
+                        weights.get(node_door.uuid, [])
+                    ),
+                    dependencies=NodeDoorSnapshot.extract_dependencies(node_door.code),
+                )
+            )
+
+        nodes: Dict[UUID, NodeSnapshot] = {}
+        entry_node_uuid: Optional[UUID] = None
+        node: Node
+        for node in Node.objects.filter(graph_id=graph_uuid):
+            nodes[node.uuid] = NodeSnapshot(
+                uuid=node.uuid,
+                name=node.name,
+                is_entry_node=node.is_entry_node,
+                is_blocking_node=node.is_blocking_node,
+                is_reactive_node=node.is_reactive_node,
+                script_cells=tuple(script_cells.get(node.uuid, [])),
+                out_doors=tuple(out_doors.get(node.uuid, [])),
+            )
+            if node.is_entry_node:
+                entry_node_uuid = node.uuid
+
+        return cls(
+            uuid=graph_uuid,
+            nodes=MappingProxyType(nodes),
+            entry_node_uuid=entry_node_uuid,
+        )
+
+
+class GraphSnapshotCache:
+    """Process wide cache of :class:`~GraphSnapshot` per graph.
+
+    As invalidations arrive via signals from synchronous code which
+    may run in a different thread, the bookkeeping is guarded by a lock.
+
+    Updates which are made within another process arrive via
+    :func:`~gencaster.distributor.GenCasterChannel.subscribe_graph_updates`,
+    which is received by a task within the event loop which accesses the cache.
+    If the channel layer is not available, a snapshot is only kept
+    for ``unwatched_max_age`` seconds.
+    """
+
+    _snapshots: Dict[UUID, GraphSnapshot] = {}
+    _loaded_at: Dict[UUID, float] = {}
+    # allows to invalidate a graph by the UUID of one of its nodes
+    _node_index: Dict[UUID, UUID] = {}
+    # increased on each invalidation so a snapshot which was loaded
+    # during an invalidation will not be stored
+    _generations: Dict[UUID, int] = {}
+    _lock = threading.Lock()
+
+    # receives the updates of other processes
+    _watcher: Optional[asyncio.Task] = None
+    _watcher_joined: Optional[asyncio.Event] = None
+    _watcher_started: float = 0.0
+    # seconds to wait for the subscription of the updates
+    watch_timeout: float = 1.0
+    # seconds after which the subscription gets renewed
+    watch_refresh: float = 60 * 60
+    # seconds after which a snapshot gets reloaded if the updates
+    # of other processes can not be received
+    unwatched_max_age: float = 5.0
+
+    @classmethod
+    async def _watch(cls, joined: asyncio.Event) -> None:
+        try:
+            async with GenCasterChannel.subscribe_graph_updates() as subscription:
+                joined.set()
+                while True:
+                    try:
+                        message = await asyncio.wait_for(
+                            subscription.receive(), cls.watch_refresh
+                        )
+                    except asyncio.TimeoutError:
+                        await subscription.rejoin()
+                        continue
+                    if message["type"] == GenCasterChannel.GRAPH_UPDATE_TYPE:
+                        cls.invalidate(graph_uuid=UUID(message["uuid"]))
+                    else:
+                        cls.invalidate(node_uuid=UUID(message["uuid"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"Can not receive updates of graphs from other processes: {e}")
+        finally:
+            # do not keep waiting for a failed subscription
+            joined.set()
+
+    @classmethod
+    async def _watch_updates(cls) -> bool:
+        """Starts to receive the updates of other processes within the
+        running event loop and returns ``True`` if they are received.
+        """
+        loop = asyncio.get_running_loop()
+        watcher = cls._watcher
+        if (
+            watcher is None
+            or watcher.get_loop() is not loop
+            or (
+                watcher.done()
+                and time.monotonic() - cls._watcher_started > cls.unwatched_max_age
+            )
+        ):
+            joined = asyncio.Event()
+            watcher = loop.create_task(cls._watch(joined))
+            cls._watcher = watcher
+            cls._watcher_joined = joined
+            cls._watcher_started = time.monotonic()
+            try:
+                await asyncio.wait_for(joined.wait(), cls.watch_timeout)
+            except asyncio.TimeoutError:
+                log.warning("Subscription of the updates of graphs timed out")
+        return (
+            not watcher.done()
+            and cls._watcher_joined is not None
+            and cls._watcher_joined.is_set()
+        )
+
+    @classmethod
+    async def aget(cls, graph: Graph) -> GraphSnapshot:
+        watched = await cls._watch_updates()
+        if snapshot := cls._snapshots.get(graph.uuid):
+            loaded_at = cls._loaded_at.get(graph.uuid, 0.0)
+            if watched or time.monotonic() - loaded_at < cls.unwatched_max_age:
+                return snapshot
+            cls.invalidate(graph_uuid=graph.uuid)
+        generation = cls._generations.get(graph.uuid, 0)
+        log.debug(f"Load snapshot of graph {graph.uuid}")
+        snapshot = await sync_to_async(GraphSnapshot.from_graph)(graph.uuid)
+        with cls._lock:
+            if cls._generations.get(graph.uuid, 0) == generation:
+                cls._snapshots[graph.uuid] = snapshot
+                cls._loaded_at[graph.uuid] = time.monotonic()
+                for node_uuid in snapshot.nodes.keys():
+                    cls._node_index[node_uuid] = graph.uuid
+        return snapshot
+
+    @classmethod
+    def invalidate(
+        cls,
+        graph_uuid: Optional[UUID] = None,
+        node_uuid: Optional[UUID] = None,
+    ) -> None:
+        with cls._lock:
+            if graph_uuid is None and node_uuid is not None:
+                graph_uuid = cls._node_index.get(node_uuid)
+            if graph_uuid is None:
+                return
+            cls._generations[graph_uuid] = cls._generations.get(graph_uuid, 0) + 1
+            cls._loaded_at.pop(graph_uuid, None)
+            if snapshot := cls._snapshots.pop(graph_uuid, None):
+                log.debug(f"Invalidated snapshot of graph {graph_uuid}")
+                for n in snapshot.nodes.keys():
+                    cls._node_index.pop(n, None)
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._snapshots.clear()
+            cls._loaded_at.clear()
+            cls._node_index.clear()
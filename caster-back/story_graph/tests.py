@@ -1,20 +1,44 @@
 import asyncio
+import gc
+import json
 import random
+import threading
+import time
+import uuid
 from datetime import datetime
-from typing import Dict, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
 from unittest import mock
 
+import requests
 from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.admin import AdminSite
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.utils import IntegrityError
-from django.test import TransactionTestCase
+from django.test import TestCase, TransactionTestCase
 from mistletoe import Document
 from mixer.backend.django import mixer
 
-from stream.models import StreamVariable
+from gencaster.distributor import GenCasterChannel, MissingChannelLayer
+from stream.frontend_types import Button, Dialog, Text
+from stream.models import Stream, StreamInstruction, StreamVariable, TextToSpeech
+from stream.tts import FakeTextToSpeechBackend, TextToSpeechService
 
+from .admin import GraphAdmin
+from .broadcast import SharedEngine
+from .code_cache import CodeCache
 from .engine import Engine, GraphDeadEnd, InvalidPythonCode, ScriptCellTimeout
-from .markdown_parser import GencasterRenderer
+from .graph_variables import GraphVariables, InMemoryGraphVariableBackend
+from .http_client import AsyncHttpClient, HttpResponse
+from .markdown_parser import (
+    GencasterRenderer,
+    TemplateSlot,
+    compile_markdown,
+    is_static_markdown,
+    md_to_ssml,
+)
 from .models import (
     AudioCell,
     CellType,
@@ -25,6 +49,20 @@ from .models import (
     NodeDoorMissing,
     ScriptCell,
 )
+from .pacing import HotLoopPacer
+from .parking import ParkedStreams
+from .prewarm import prewarm_graph
+from .profiler import DOOR_EVALUATION, EngineProfiler, GraphProfile
+from .sandbox import SandboxError, SandboxTimeout, ScriptCellSandbox, can_run_in_sandbox
+from .simulator import SimulatedStreamPoint, SimulationEngine, asimulate_walks, simulate
+from .snapshot import (
+    GraphSnapshot,
+    GraphSnapshotCache,
+    NodeDoorSnapshot,
+    ScriptCellSnapshot,
+)
+from .variable_store import StreamVariableStore
+from .worker import EngineWorker, relay_engine
 
 
 class GraphTestCase(TransactionTestCase):
@@ -211,9 +249,79 @@ class GencasterMarkdownTestCase(TransactionTestCase):
     def test_female(self):
         self.assertTrue("de-DE-Neural2-C" in self.gm_md("{female}`foo`"))
 
+    def test_is_static(self):
+        self.assertTrue(is_static_markdown("Hello {male}`foo` {break}`100ms`"))
+        self.assertFalse(is_static_markdown("Hello {var}`foo|bar`"))
+        self.assertFalse(is_static_markdown("two plus two is {python}`2+2`"))
+
     def test_male(self):
         self.assertTrue("de-DE-Neural2-B" in self.gm_md("{male}`foo`"))
 
+    def test_compile_markdown(self):
+        template = compile_markdown(
+            "# Hello {var}`name|you`\n\n{male}`how` are {python}`2+2`"
+        )
+        self.assertEqual(
+            template.slots,
+            (TemplateSlot("var", "name|you"), TemplateSlot("python", "2+2")),
+        )
+        self.assertEqual(
+            template.fragments,
+            (
+                "<speak>Hello ",
+                '\n<voice name="de-DE-Neural2-B">how</voice> are ',
+                "</speak>",
+            ),
+        )
+        self.assertFalse(template.is_static)
+        self.assertTrue(template.executes_python)
+        self.assertEqual(
+            template.render({"name": "world"}),
+            self.SPEAK.format(
+                'Hello world\n<voice name="de-DE-Neural2-B">how</voice> are 4'
+            ),
+        )
+
+    def test_compile_markdown_cached(self):
+        # a unique text avoids a template of a previous test
+        prefix = f"Hello {uuid.uuid4()} "
+        with mock.patch(
+            "story_graph.markdown_parser.Document", wraps=Document
+        ) as document:
+            for name in ["a", "b"]:
+                self.assertEqual(
+                    md_to_ssml(prefix + "{var}`name`", {"name": name}),
+                    self.SPEAK.format(prefix + name),
+                )
+        document.assert_called_once()
+
+    def test_compile_static_markdown(self):
+        template = compile_markdown("Hello {break}`100ms` world")
+        self.assertTrue(template.is_static)
+        self.assertEqual(
+            template.render(), self.SPEAK.format('Hello <break time="100ms"/> world')
+        )
+
+    def test_md_to_ssml_equals_renderer(self):
+        text = "# {var}`a|b`\n\n**{var}`x`** {female}`foo` {python}`self.stream_variables['x']`\n\n- {python}`2+`"
+        self.assertEqual(md_to_ssml(text, {"x": "y"}), self.gm_md(text, {"x": "y"}))
+
+    def test_python_exec_sets_var(self):
+        text = "{python_exec}`self.stream_variables['a']='X'` hi {var}`a|none`"
+        for stream_variables in [None, {"b": "c"}]:
+            self.assertEqual(
+                md_to_ssml(text, stream_variables), self.SPEAK.format(" hi X")
+            )
+        self.assertEqual(md_to_ssml(text), self.gm_md(text))
+
+    def test_graph_var(self):
+        with GencasterRenderer(graph_variables={"votes": "3"}) as renderer:
+            ssml_text = renderer.render(
+                Document("{graph_var}`votes` and {graph_var}`missing|none`")
+            )
+        self.assertEqual(self.SPEAK.format("3 and none"), ssml_text)
+        self.assertFalse(is_static_markdown("{graph_var}`votes`"))
+
     def test_break(self):
         self.assertEqual(
             self.SPEAK.format('foo<break time="100ms"/>bar'),
@@ -327,6 +435,36 @@ class AudioCellTestCase(TransactionTestCase):
         self.assertTrue(str(audio_cell.audio_file) in str(audio_cell))
 
 
+class CodeCacheTestCase(TestCase):
+    def test_hit_and_miss(self):
+        cache = CodeCache()
+        code = cache.compile("a = 2")
+        self.assertIs(cache.compile("a = 2"), code)
+        cache.compile("2+2", mode="eval")
+        info = cache.info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.size, 2)
+
+    def test_lru_eviction(self):
+        cache = CodeCache(max_size=2)
+        code_a = cache.compile("a = 1")
+        cache.compile("b = 1")
+        # access a so b is the least recently used
+        cache.compile("a = 1")
+        cache.compile("c = 1")
+        self.assertEqual(cache.info().size, 2)
+        self.assertIs(cache.compile("a = 1"), code_a)
+        cache.compile("b = 1")
+        self.assertEqual(cache.info().misses, 4)
+
+    def test_syntax_error_not_cached(self):
+        cache = CodeCache()
+        with self.assertRaises(SyntaxError):
+            cache.compile("2+")
+        self.assertEqual(cache.info().size, 0)
+
+
 class EngineTestCase(TransactionTestCase):
     def setup_graph_without_start(self):
         from stream.tests import StreamTestCase
@@ -353,8 +491,14 @@ class EngineTestCase(TransactionTestCase):
         await sync_to_async(entry_node.save)()
         engine = Engine(self.graph, self.stream)
 
-        with self.assertRaises(asyncio.TimeoutError):
+        # the engine returns and leaves the waiting to the parked stream
+        with self.assertRaises(StopAsyncIteration):
             await asyncio.wait_for(engine.start().__aiter__().__anext__(), 0.5)
+        parked = ParkedStreams.get(self.stream.uuid)
+        self.assertEqual(parked.node_uuid, entry_node.uuid)  # type: ignore
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(ParkedStreams.wait(self.stream.uuid), 0.2)
+        self.assertIsNone(ParkedStreams.get(self.stream.uuid))
 
     async def test_non_blocking_exhausting(self):
         await sync_to_async(self.setup_graph_without_start)()
@@ -372,6 +516,183 @@ class EngineTestCase(TransactionTestCase):
         with self.assertRaises(StopAsyncIteration):
             await asyncio.wait_for(engine.start().__aiter__().__anext__(), 4.5)
 
+    async def setup_cycle(self, cell_code: str) -> None:
+        await sync_to_async(self.setup_graph_without_start)()
+        self.script_cell.cell_code = cell_code
+        await sync_to_async(self.script_cell.save)()
+        entry_node = await self.graph.acreate_entry_node()
+        await Edge.objects.acreate(
+            out_node_door=await entry_node.aget_default_out_door(),
+            in_node_door=await self.node.aget_default_in_door(),
+        )
+        await Edge.objects.acreate(
+            out_node_door=await self.node.aget_default_out_door(),
+            in_node_door=await entry_node.aget_default_in_door(),
+        )
+        self.node.is_blocking_node = False
+        await sync_to_async(self.node.save)()
+
+    async def run_cycle(self) -> mock.MagicMock:
+        engine = Engine(self.graph, self.stream, run_cleanup_procedure=False)
+        engine.step_delay = 0.0
+        engine.max_step_delay = 0.01
+        with mock.patch.object(
+            engine.variable_store,
+            "wait_for_change",
+            wraps=engine.variable_store.wait_for_change,
+        ) as wait_for_change:
+            async for _ in engine.start(max_steps=10):
+                pass
+        return wait_for_change
+
+    async def test_cycle_without_progress(self):
+        await self.setup_cycle("2+2")
+        wait_for_change = await self.run_cycle()
+        # the first visit of both nodes is not delayed
+        self.assertEqual(wait_for_change.call_count, 8)
+        wait_for_change.assert_called_with(0.01)
+
+    async def test_cycle_with_progress(self):
+        await self.setup_cycle("vars['i'] = int(vars.get('i', 0)) + 1")
+        wait_for_change = await self.run_cycle()
+        wait_for_change.assert_not_called()
+        self.assertEqual(
+            (await StreamVariable.objects.aget(stream=self.stream, key="i")).value,
+            "5",
+        )
+
+    def setup_concurrent_cells(self, cells: List[Dict]) -> None:
+        from stream.tests import StreamTestCase
+
+        self.graph = GraphTestCase.get_graph()
+        self.stream = StreamTestCase.get_stream()
+        self.node = async_to_sync(self.graph.acreate_entry_node)()
+        for cell_order, cell in enumerate(cells):
+            ScriptCellTestCase.get_script_cell(
+                node=self.node,
+                cell_type=CellType.PYTHON,
+                cell_order=cell_order,
+                **cell,
+            )
+
+    async def test_concurrent_cells(self):
+        await sync_to_async(self.setup_concurrent_cells)(
+            [
+                {"cell_code": "await asyncio.sleep(0.3)", "concurrent_group": 1},
+                {
+                    "cell_code": "await asyncio.sleep(0.1)\nyield Dialog(title='b', content=[], buttons=[])",
+                    "concurrent_group": 1,
+                },
+                {
+                    "cell_code": "await asyncio.sleep(0.3)\nyield Dialog(title='c', content=[], buttons=[])",
+                    "concurrent_group": 1,
+                },
+                {"cell_code": "yield Dialog(title='d', content=[], buttons=[])"},
+            ]
+        )
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        start = time.monotonic()
+        dialogs = [d.title async for d in engine.execute_node(self.node)]  # type: ignore
+        self.assertEqual(dialogs, ["b", "c", "d"])
+        # the group takes as long as its longest cell
+        self.assertLess(time.monotonic() - start, 0.55)
+
+    async def test_concurrent_cells_exception(self):
+        await sync_to_async(self.setup_concurrent_cells)(
+            [
+                {"cell_code": "1 / 0", "concurrent_group": 1},
+                {"cell_code": "vars['done'] = 'true'", "concurrent_group": 1},
+            ]
+        )
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        with self.assertRaises(ZeroDivisionError):
+            async for _ in engine.execute_node(self.node):
+                pass
+        self.assertEqual((await engine.get_stream_variables())["done"], "true")
+
+    def test_group_script_cells(self):
+        cells = [
+            ScriptCellSnapshot(
+                uuid=uuid.uuid4(),
+                cell_type=CellType.PYTHON,
+                cell_code="",
+                audio_cell=None,
+                concurrent_group=group,
+            )
+            for group in [None, 1, 1, None, None, 2, 1, 1]
+        ]
+        self.assertEqual(
+            [len(group) for group in Engine.group_script_cells(cells)],
+            [1, 2, 1, 1, 1, 2],
+        )
+
+    async def test_checkpoint_debounce(self):
+        await sync_to_async(self.setup_graph_without_start)()
+        entry_node = await self.graph.acreate_entry_node()
+        engine = Engine(self.graph, self.stream, run_cleanup_procedure=False)
+        engine.checkpoint_interval = 3600
+
+        async def stored_checkpoint():
+            stream = await Stream.objects.aget(uuid=self.stream.uuid)
+            return stream.checkpoint_node_id  # type: ignore
+
+        await engine.checkpoint(entry_node)
+        self.assertEqual(await stored_checkpoint(), entry_node.uuid)
+
+        await engine.checkpoint(self.node)
+        self.assertEqual(await stored_checkpoint(), entry_node.uuid)
+
+        await engine.flush_checkpoint()
+        self.assertEqual(await stored_checkpoint(), self.node.uuid)
+
+        await engine.checkpoint(None, flush=True)
+        self.assertIsNone(await stored_checkpoint())
+
+    async def test_resume_from_checkpoint(self):
+        await sync_to_async(self.setup_graph_without_start)()
+        entry_node = await self.graph.acreate_entry_node()
+        await Edge.objects.acreate(
+            out_node_door=await entry_node.aget_default_out_door(),
+            in_node_door=await self.node.aget_default_in_door(),
+        )
+        self.node.is_blocking_node = False
+        await sync_to_async(self.node.save)()
+
+        engine = Engine(self.graph, self.stream, run_cleanup_procedure=False)
+        engine.step_delay = 0.0
+        with mock.patch.object(
+            engine, "checkpoint", wraps=engine.checkpoint
+        ) as checkpoint:
+            async for _ in engine.start():
+                pass
+        self.assertEqual(
+            [c.args[0] and c.args[0].uuid for c in checkpoint.call_args_list],
+            [entry_node.uuid, self.node.uuid, None],
+        )
+
+        await Stream.objects.filter(uuid=self.stream.uuid).aupdate(
+            checkpoint_node=self.node
+        )
+        await sync_to_async(self.stream.refresh_from_db)()
+        engine = Engine(
+            self.graph, self.stream, run_cleanup_procedure=True, resume=True
+        )
+        engine.step_delay = 0.0
+        with mock.patch.object(engine, "cleanup_sc_procedure") as cleanup:
+            with mock.patch.object(
+                engine, "execute_node", wraps=engine.execute_node
+            ) as execute_node:
+                async for _ in engine.start():
+                    pass
+        cleanup.assert_not_called()
+        self.assertEqual(
+            [c.args[0].uuid for c in execute_node.call_args_list], [self.node.uuid]
+        )
+
     def setup_with_script_cell(
         self,
         cell_code: str,
@@ -546,6 +867,32 @@ vars['foo'] = 42"""
         )
         await asyncio.wait_for(job, timeout=0.5)
 
+    async def test_wait_for_stream_variable_push(self):
+        await sync_to_async(self.setup_with_script_cell)("")
+        engine = Engine(self.graph, self.stream, raise_exceptions=True)
+        # a polling interval this long would exceed the timeout of the job
+        job = asyncio.gather(
+            self.helper_create_delayed_stream_variable("unrelated", "true", 0.05),
+            self.helper_create_delayed_stream_variable("start", "true", 0.1),
+            engine.wait_for_stream_variable("start", timeout=1.0, update_speed=10.0),
+        )
+        await asyncio.wait_for(job, timeout=0.5)
+
+    @mock.patch(
+        "gencaster.distributor.GenCasterChannel.subscribe_stream_variable_updates",
+        side_effect=MissingChannelLayer(),
+    )
+    async def test_wait_for_stream_variable_polling(self, _):
+        await sync_to_async(self.setup_with_script_cell)("")
+        engine = Engine(self.graph, self.stream, raise_exceptions=True)
+        job = asyncio.gather(
+            self.helper_create_delayed_stream_variable("start", "true", 0.1),
+            engine.wait_for_stream_variable("start", timeout=1.0, update_speed=0.1),
+        )
+        await asyncio.wait_for(job, timeout=0.5)
+        with self.assertRaises(ScriptCellTimeout):
+            await engine.wait_for_stream_variable("foo", timeout=0.1)
+
     async def test_yield_dialog(self):
         # if this fails please update the docs for the editor as well!
         from stream.frontend_types import Dialog
@@ -568,8 +915,8 @@ vars['foo'] = 42"""
         self.assertEqual(len(dialog.buttons), 1)
         self.assertEqual(dialog.buttons[0].text, "OK")
 
-    @mock.patch("stream.models.StreamPoint.speak_on_stream")
-    async def test_execute_markdown_code(self, speak_mock: mock.MagicMock):
+    @mock.patch("stream.models.StreamPoint.aspeak_on_stream")
+    async def test_execute_markdown_code(self, speak_mock: mock.AsyncMock):
         await sync_to_async(self.setup_with_script_cell)(
             "Hello world",
             None,
@@ -586,6 +933,93 @@ vars['foo'] = 42"""
             assert patch.called
         speak_mock.assert_called_once_with("<speak>Hello world</speak>")
 
+    @mock.patch("stream.models.StreamPoint.play_audio_file")
+    @mock.patch("stream.models.TextToSpeech.acreate_from_text")
+    async def test_execute_markdown_code_chunks(
+        self, tts_mock: mock.AsyncMock, play_mock: mock.MagicMock
+    ):
+        async def synthesize(ssml_text: str) -> mock.MagicMock:
+            # the first chunk takes the longest
+            if "first" in ssml_text:
+                await asyncio.sleep(0.1)
+            return mock.MagicMock(audio_file=ssml_text)
+
+        tts_mock.side_effect = synthesize
+        await sync_to_async(self.setup_with_script_cell)(
+            "The first sentence. The second one! And a third?",
+            None,
+            cell_type=CellType.MARKDOWN,
+        )
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        engine.chunk_chars = 10
+        events: List[str] = []
+        play_mock.side_effect = lambda audio_file, **kwargs: audio_file
+
+        async def wait_for_finished_instruction(instruction):
+            events.append(f"wait {instruction}")
+
+        with mock.patch.object(
+            engine, "wait_for_finished_instruction", wait_for_finished_instruction
+        ):
+            instructions = []
+            async for instruction in engine.execute_markdown_code(
+                self.script_cell.cell_code
+            ):
+                events.append(f"play {instruction}")
+                instructions.append(instruction)
+        self.assertEqual(len(instructions), 3)
+        # the next chunk gets queued before the previous one has finished
+        self.assertEqual(
+            [event.split(" ")[0] for event in events],
+            ["play", "play", "wait", "play", "wait", "wait"],
+        )
+        self.assertTrue(all(c.kwargs["queue"] for c in play_mock.call_args_list))
+        self.assertEqual(
+            [c.args[0] for c in play_mock.call_args_list],
+            [
+                "<speak>The first sentence. </speak>",
+                "<speak>The second one! </speak>",
+                "<speak>And a third?</speak>",
+            ],
+        )
+        self.assertEqual(tts_mock.call_count, 3)
+
+    @mock.patch("stream.models.TextToSpeech.create_from_text")
+    async def test_synthesize_successors(self, tts_mock: mock.MagicMock):
+        await sync_to_async(self.setup_with_script_cell)(
+            "Hello world",
+            None,
+            cell_type=CellType.MARKDOWN,
+        )
+        entry_node: Node = await Node.objects.aget(graph=self.graph)
+        next_node = await Node.objects.acreate(graph=self.graph)
+        for cell_order, cell_code in enumerate(["Bye {var}`name`", "Bye world"]):
+            await ScriptCell.objects.acreate(
+                node=next_node,
+                cell_type=CellType.MARKDOWN,
+                cell_code=cell_code,
+                cell_order=cell_order,
+            )
+        await Edge.objects.acreate(
+            out_node_door=await entry_node.aget_default_out_door(),
+            in_node_door=await next_node.aget_default_in_door(),
+        )
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        engine.synthesize_successors(
+            await GraphSnapshotCache.aget(self.graph), entry_node.uuid
+        )
+        # a second lookahead does not request the same text again
+        engine.synthesize_successors(
+            await GraphSnapshotCache.aget(self.graph), entry_node.uuid
+        )
+        await asyncio.gather(*engine._synthesis_tasks.values())
+        tts_mock.assert_called_once_with("<speak>Bye world</speak>")
+        self.assertEqual(len(engine._synthesis_tasks), 0)
+
     @mock.patch("stream.models.StreamPoint.send_raw_instruction")
     async def text_execute_sc_code(self, sc_instruction_mock: mock.MagicMock):
         # @todo this yields no coverage although the tests makes it obvious
@@ -691,6 +1125,70 @@ vars['foo'] = 42"""
 
         self.assertEqual((await StreamInstruction.objects.afirst()).state, StreamInstruction.InstructionState.FINISHED)  # type: ignore
 
+    async def test_wait_for_failed_instruction(self):
+        from stream.models import StreamInstruction
+
+        async def set_instruction_failed_with_delay(
+            stream_instruction: StreamInstruction, delay: float
+        ):
+            await asyncio.sleep(delay)
+            stream_instruction.state = StreamInstruction.InstructionState.FAILURE
+            await stream_instruction.asave()
+
+        await sync_to_async(self.setup_with_script_cell)(
+            cell_code="2+2",
+            cell_type=CellType.SUPERCOLLIDER,
+        )
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        instruction = StreamInstruction(
+            stream_point=self.stream.stream_point,
+            state=StreamInstruction.InstructionState.SENT,
+            instruction_text="",
+        )
+        await instruction.asave()
+
+        job = asyncio.gather(
+            set_instruction_failed_with_delay(instruction, 0.1),
+            engine.wait_for_finished_instruction(
+                instruction=instruction,
+                timeout=10.0,
+            ),
+        )
+        await asyncio.wait_for(job, timeout=0.5)
+        self.assertEqual(instruction.state, StreamInstruction.InstructionState.FAILURE)
+
+    @mock.patch(
+        "gencaster.distributor.GenCasterChannel.subscribe_stream_instruction_updates",
+        side_effect=MissingChannelLayer(),
+    )
+    async def test_wait_for_finished_instruction_polling(self, _):
+        from stream.models import StreamInstruction
+
+        await sync_to_async(self.setup_with_script_cell)(
+            cell_code="2+2",
+            cell_type=CellType.SUPERCOLLIDER,
+        )
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        instruction = StreamInstruction(
+            stream_point=self.stream.stream_point,
+            state=StreamInstruction.InstructionState.FINISHED,
+            instruction_text="",
+        )
+        await instruction.asave()
+
+        await asyncio.wait_for(
+            engine.wait_for_finished_instruction(
+                instruction=instruction,
+                timeout=1.0,
+                interval=0.1,
+            ),
+            timeout=0.5,
+        )
+
     async def test_evaluate_python_code(self):
         await sync_to_async(self.setup_with_script_cell)(
             cell_code="2+2",
@@ -862,6 +1360,108 @@ vars['foo'] = 42"""
         next_node = await engine.get_next_node()
         self.assertEqual(next_node.uuid, node_c.uuid)
 
+    async def setup_reactive_node(self, is_reactive_node: bool) -> Node:
+        await sync_to_async(self.setup_with_script_cell)("2+2")
+        node_a: Node = await Node.objects.afirst()  # type: ignore
+        node_a.is_reactive_node = is_reactive_node
+        await node_a.asave()
+        node_b = await Node.objects.acreate(graph=self.graph)
+        node_c = await Node.objects.acreate(graph=self.graph)
+        await Edge.objects.acreate(
+            out_node_door=await node_a.aget_default_out_door(),
+            in_node_door=await node_b.aget_default_in_door(),
+        )
+        custom_node_door = await NodeDoor.objects.acreate(
+            door_type=NodeDoor.DoorType.OUTPUT,
+            node=node_a,
+            name="go",
+            is_default=False,
+            code='vars.get("go") == "yes"',
+        )
+        await Edge.objects.acreate(
+            out_node_door=custom_node_door,
+            in_node_door=await node_c.aget_default_in_door(),
+        )
+        return node_c
+
+    async def test_get_next_node_reactive(self):
+        node_c = await self.setup_reactive_node(is_reactive_node=True)
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        engine._current_node = await Node.objects.afirst()  # type: ignore
+        with mock.patch.object(
+            engine, "_get_door_global_vars", wraps=engine._get_door_global_vars
+        ) as door_globals:
+            next_node, *_ = await asyncio.wait_for(
+                asyncio.gather(
+                    engine.get_next_node(),
+                    self.helper_create_delayed_stream_variable("unrelated", "1", 0.05),
+                    self.helper_create_delayed_stream_variable("go", "yes", 0.15),
+                ),
+                1.0,
+            )
+        self.assertEqual(next_node.uuid, node_c.uuid)
+        # the unrelated variable does not trigger an evaluation
+        self.assertEqual(door_globals.call_count, 2)
+
+    async def test_get_next_node_reactive_timeout(self):
+        await self.setup_reactive_node(is_reactive_node=True)
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        engine.blocking_time = 0.1  # type: ignore
+        engine._current_node = await Node.objects.afirst()  # type: ignore
+        next_node = await asyncio.wait_for(engine.get_next_node(), 1.0)
+        self.assertEqual(next_node.uuid, (await Node.objects.all()[1:2].aget()).uuid)
+
+    async def test_get_next_node_not_reactive(self):
+        await self.setup_reactive_node(is_reactive_node=False)
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        engine._current_node = await Node.objects.afirst()  # type: ignore
+        with mock.patch.object(engine, "wait_for_door_dependencies") as wait:
+            await asyncio.wait_for(engine.get_next_node(), 1.0)
+        wait.assert_not_called()
+
+    async def test_get_next_node_single_variable_fetch(self):
+        await sync_to_async(self.setup_with_script_cell)(
+            "2+2",
+            None,
+            cell_type=CellType.PYTHON,
+        )
+        engine = Engine(
+            self.graph, self.stream, raise_exceptions=True, run_cleanup_procedure=False
+        )
+        node_a: Node = await Node.objects.afirst()  # type: ignore
+        node_b = await Node.objects.acreate(
+            graph=self.graph,
+        )
+        for i, code in enumerate(
+            ['vars.get("foo")=="bar"', "foo+bar", "'foo'", "1==1"]
+        ):
+            node_door = await NodeDoor.objects.acreate(
+                door_type=NodeDoor.DoorType.OUTPUT,
+                node=node_a,
+                name=f"door_{i}",
+                order=i,
+                is_default=False,
+                code=code,
+            )
+        await Edge.objects.acreate(
+            out_node_door=node_door,
+            in_node_door=await node_b.aget_default_in_door(),
+        )
+
+        engine._current_node = node_a
+        with mock.patch.object(
+            engine, "get_stream_variables", return_value={"foo": "baz"}
+        ) as get_stream_variables:
+            next_node = await engine.get_next_node()
+        self.assertEqual(next_node.uuid, node_b.uuid)
+        get_stream_variables.assert_called_once()
+
     async def test_run_into_dead_end(self):
         await sync_to_async(self.setup_with_script_cell)(
             "2+2",
@@ -876,3 +1476,1138 @@ vars['foo'] = 42"""
 
         with self.assertRaises(GraphDeadEnd):
             await engine.get_next_node()
+
+
+class GraphSnapshotTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        self.graph = GraphTestCase.get_graph()
+        self.node_a = async_to_sync(self.graph.acreate_entry_node)()
+        self.node_b = NodeTestCase.get_node(graph=self.graph)
+        Edge.objects.create(
+            out_node_door=self.node_a.get_default_out_door(),
+            in_node_door=self.node_b.get_default_in_door(),
+        )
+        for cell_order in [2, 1]:
+            ScriptCellTestCase.get_script_cell(
+                node=self.node_a,
+                cell_order=cell_order,
+                cell_type=CellType.PYTHON,
+                cell_code=f"{cell_order}",
+            )
+
+    def test_from_graph(self):
+        snapshot = GraphSnapshot.from_graph(self.graph.uuid)
+        self.assertEqual(snapshot.entry_node.uuid, self.node_a.uuid)
+        self.assertEqual(len(snapshot.nodes), 2)
+        self.assertEqual(
+            [c.cell_code for c in snapshot.entry_node.script_cells], ["1", "2"]
+        )
+        default_door = snapshot.entry_node.default_out_door
+        self.assertIsNotNone(default_door)
+        self.assertEqual(default_door.next_nodes, (self.node_b.uuid,))  # type: ignore
+        self.assertEqual(
+            snapshot.nodes[self.node_b.uuid].default_out_door.next_nodes, ()  # type: ignore
+        )
+
+    def test_door_dependencies(self):
+        for code, dependencies in [
+            ('vars["foo"] == "bar"', ["foo"]),
+            ('vars.get("foo") == "bar" or "baz" not in vars', ["foo", "baz"]),
+            ("1 == 1", []),
+            ("invalid code ==", []),
+        ]:
+            self.assertEqual(
+                NodeDoorSnapshot.extract_dependencies(code),
+                frozenset(dependencies),  # type: ignore
+            )
+        for code in [
+            "vars[key] == 1",
+            "len(vars) > 2",
+            "vars.keys()",
+            "'a' in get_stream_variables()",
+        ]:
+            self.assertIsNone(NodeDoorSnapshot.extract_dependencies(code))
+
+    def test_weighted_edges(self):
+        node_c = NodeTestCase.get_node(graph=self.graph)
+        node_d = NodeTestCase.get_node(graph=self.graph)
+        out_door = self.node_a.get_default_out_door()
+        Edge.objects.filter(out_node_door=out_door).update(weight=0.0)
+        for node, weight in [(node_c, 1.0), (node_d, 3.0)]:
+            Edge.objects.create(
+                out_node_door=out_door,
+                in_node_door=node.get_default_in_door(),
+                weight=weight,
+            )
+        door = GraphSnapshot.from_graph(self.graph.uuid).entry_node.default_out_door
+        self.assertEqual(door.cum_weights[-1], 4.0)  # type: ignore
+
+        rng = random.Random(42)
+        picks = [door.pick_next_node(rng) for _ in range(1000)]  # type: ignore
+        self.assertNotIn(self.node_b.uuid, picks)
+        self.assertGreater(picks.count(node_d.uuid), 2 * picks.count(node_c.uuid))
+        # the same seed picks the same path
+        rng = random.Random(42)
+        self.assertEqual(picks, [door.pick_next_node(rng) for _ in range(1000)])  # type: ignore
+
+    def test_uniform_edges(self):
+        self.assertIsNone(NodeDoorSnapshot.accumulate_weights([1.0, 1.0]))
+        self.assertIsNone(NodeDoorSnapshot.accumulate_weights([0.0, 0.0]))
+        self.assertEqual(NodeDoorSnapshot.accumulate_weights([0.0, 2.0]), (0.0, 2.0))
+
+    def test_no_queries_when_cached(self):
+        snapshot = async_to_sync(GraphSnapshotCache.aget)(self.graph)
+        with self.assertNumQueries(0):
+            self.assertIs(async_to_sync(GraphSnapshotCache.aget)(self.graph), snapshot)
+
+    def test_invalidate_on_update(self):
+        snapshot = async_to_sync(GraphSnapshotCache.aget)(self.graph)
+        ScriptCellTestCase.get_script_cell(
+            node=self.node_b,
+            cell_type=CellType.PYTHON,
+            cell_code="3",
+        )
+        new_snapshot = async_to_sync(GraphSnapshotCache.aget)(self.graph)
+        self.assertIsNot(new_snapshot, snapshot)
+        self.assertEqual(
+            [c.cell_code for c in new_snapshot.nodes[self.node_b.uuid].script_cells],
+            ["3"],
+        )
+
+    async def test_invalidate_from_other_process(self):
+        snapshot = await GraphSnapshotCache.aget(self.graph)
+        # the update of another process only arrives via the channel layer
+        await GenCasterChannel.send_node_update(self.node_b.uuid)
+        await asyncio.sleep(0.05)
+        self.assertIsNot(await GraphSnapshotCache.aget(self.graph), snapshot)
+
+    async def test_unwatched_max_age(self):
+        with mock.patch.object(
+            GenCasterChannel,
+            "subscribe_graph_updates",
+            side_effect=MissingChannelLayer(),
+        ), mock.patch.object(GraphSnapshotCache, "_watcher", None):
+            snapshot = await GraphSnapshotCache.aget(self.graph)
+            self.assertIs(await GraphSnapshotCache.aget(self.graph), snapshot)
+            with mock.patch.object(GraphSnapshotCache, "unwatched_max_age", 0.0):
+                self.assertIsNot(await GraphSnapshotCache.aget(self.graph), snapshot)
+
+
+class StreamVariableStoreTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        from stream.tests import StreamTestCase
+
+        self.stream = StreamTestCase.get_stream()
+        StreamVariable.objects.create(stream=self.stream, key="foo", value="1")
+
+    async def test_flush_only_dirty(self):
+        store = StreamVariableStore(self.stream)
+        await store.aload()
+        self.assertEqual(store["foo"], "1")
+        store["foo"] = "1"
+        store["bar"] = 2
+        store["baz"] = "3"
+        # one bulk upsert for all changed variables
+        with mock.patch.object(
+            StreamVariable.objects,
+            "abulk_create",
+            wraps=StreamVariable.objects.abulk_create,
+        ) as bulk_create:
+            await store.aflush()
+            self.assertEqual(store["bar"], "2")
+            await store.aflush()
+        bulk_create.assert_called_once()
+        self.assertEqual(len(bulk_create.call_args.args[0]), 2)
+        await store.aclose()
+
+        v = {}
+        async for stream_variable in StreamVariable.objects.filter(stream=self.stream):
+            v[stream_variable.key] = stream_variable.value
+        self.assertEqual(v, {"foo": "1", "bar": "2", "baz": "3"})
+
+    async def test_wait_for_change(self):
+        store = StreamVariableStore(self.stream)
+        await store.aload()
+        self.assertFalse(await store.wait_for_change(0.05))
+
+        async def update():
+            await asyncio.sleep(0.05)
+            await GenCasterChannel.send_stream_variable_update(
+                self.stream.uuid, "foo", "2"
+            )
+
+        task = asyncio.ensure_future(update())
+        self.assertTrue(await asyncio.wait_for(store.wait_for_change(10.0), 1.0))
+        self.assertEqual(store["foo"], "2")
+        await task
+        await store.aclose()
+
+    async def test_external_update(self):
+        store = StreamVariableStore(self.stream)
+        await store.aload()
+        store["bar"] = "local"
+        await StreamVariable.objects.aupdate_or_create(
+            stream=self.stream, key="foo", defaults={"value": "2"}
+        )
+        await StreamVariable.objects.acreate(
+            stream=self.stream, key="bar", value="remote"
+        )
+        await asyncio.sleep(0.05)
+        # an unflushed local change is not overwritten
+        self.assertEqual(await store.aget_all(), {"foo": "2", "bar": "local"})
+        await store.aflush()
+        await store.aclose()
+        self.assertEqual(
+            (await StreamVariable.objects.aget(stream=self.stream, key="bar")).value,
+            "local",
+        )
+
+    async def test_no_channel_layer(self):
+        store = StreamVariableStore(self.stream)
+        with mock.patch(
+            "gencaster.distributor.GenCasterChannel.subscribe_stream_variable_updates",
+            side_effect=MissingChannelLayer(),
+        ):
+            await store.aload()
+            await StreamVariable.objects.acreate(
+                stream=self.stream, key="bar", value="baz"
+            )
+            self.assertEqual(await store.aget_all(), {"foo": "1", "bar": "baz"})
+            store["foo"] = "2"
+            await store.aflush()
+        self.assertEqual(
+            (await StreamVariable.objects.aget(stream=self.stream, key="foo")).value,
+            "2",
+        )
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server: "StubServer" = self.server  # type: ignore
+        with server.lock:
+            server.requests += 1
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(server.delay)
+        body = json.dumps({"path": self.path, "count": server.requests}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.path.startswith("/trickle"):
+            # each byte arrives within the timeout of a socket operation
+            for i in range(len(body)):
+                self.wfile.write(body[i : i + 1])
+                self.wfile.flush()
+                time.sleep(0.05)
+        else:
+            self.wfile.write(body)
+        with server.lock:
+            server.running -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    def __init__(self, delay: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.running = 0
+        self.max_running = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def handle_error(self, request, client_address):
+        # e.g. a client which has timed out
+        pass
+
+
+class AsyncHttpClientTestCase(TransactionTestCase):
+    def start_server(self, delay: float = 0.0) -> StubServer:
+        server = StubServer(delay)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def get_client(self, **kwargs) -> AsyncHttpClient:
+        client = AsyncHttpClient(**kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    async def test_get(self):
+        server = self.start_server()
+        client = self.get_client()
+        response = await client.get(f"{server.url}/foo", params={"a": "b"})
+        self.assertTrue(response.ok)
+        self.assertEqual(response.json(), {"path": "/foo?a=b", "count": 1})
+
+    async def test_cache(self):
+        server = self.start_server()
+        client = self.get_client(cache_ttl=0.2)
+        for _ in range(3):
+            await client.get(f"{server.url}/foo")
+        self.assertEqual(server.requests, 1)
+        self.assertEqual((client.hits, client.misses), (2, 1))
+        await client.get(f"{server.url}/foo", ttl=0)
+        self.assertEqual(server.requests, 2)
+        await asyncio.sleep(0.3)
+        response = await client.get(f"{server.url}/foo")
+        self.assertEqual(response.json()["count"], 3)
+
+    async def test_per_host_limit(self):
+        server = self.start_server(delay=0.1)
+        client = self.get_client(max_connections_per_host=2, cache_ttl=0)
+        await asyncio.gather(*[client.get(f"{server.url}/{i}") for i in range(6)])
+        self.assertEqual(server.requests, 6)
+        self.assertEqual(server.max_running, 2)
+
+    async def test_timeout(self):
+        server = self.start_server(delay=0.5)
+        client = self.get_client()
+        with self.assertRaises(Exception):
+            await client.get(f"{server.url}/foo", timeout=0.1)
+
+    def test_timeout_of_trickling_response(self):
+        server = self.start_server()
+        client = self.get_client()
+        start = time.monotonic()
+        with self.assertRaises(requests.Timeout):
+            client._request("GET", f"{server.url}/trickle", timeout=0.2)
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    async def test_cache_key_with_lists(self):
+        server = self.start_server()
+        client = self.get_client()
+        for _ in range(2):
+            response = await client.get(f"{server.url}/foo", params={"a": ["b", "c"]})
+        self.assertEqual(response.json()["path"], "/foo?a=b&a=c")
+        self.assertEqual(server.requests, 1)
+
+    async def test_timeout_keeps_host_slot(self):
+        client = self.get_client(max_connections_per_host=1, cache_ttl=0)
+        running: List[str] = []
+        max_running: List[int] = []
+
+        def request(method: str, url: str, timeout: float, **kwargs) -> HttpResponse:
+            running.append(url)
+            max_running.append(len(running))
+            # outlives the timeout of the client
+            time.sleep(1.3 if url.endswith("slow") else 0.0)
+            running.remove(url)
+            return HttpResponse(url=url, status_code=200, content=b"")
+
+        with mock.patch.object(client, "_request", request):
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.get("http://localhost/slow", timeout=0.0)
+            await client.get("http://localhost/fast")
+        self.assertEqual(max(max_running), 1)
+
+    async def test_deprecated_requests(self):
+        from stream.tests import StreamTestCase
+
+        graph = await sync_to_async(GraphTestCase.get_graph)()
+        stream = await sync_to_async(StreamTestCase.get_stream)()
+        engine = Engine(graph, stream, raise_exceptions=True, sandbox=False)
+        with mock.patch("story_graph.http_client.log") as log:
+            async for _ in engine.execute_python_cell(
+                "vars['codes'] = requests.codes.ok"
+            ):
+                pass
+        self.assertEqual((await engine.get_stream_variables())["codes"], "200")
+        self.assertIn("use http instead", log.warning.call_args.args[0])
+
+    async def test_script_cell(self):
+        from stream.tests import StreamTestCase
+
+        server = self.start_server()
+        graph = await sync_to_async(GraphTestCase.get_graph)()
+        stream = await sync_to_async(StreamTestCase.get_stream)()
+        engine = Engine(graph, stream, raise_exceptions=True, sandbox=False)
+        async for _ in engine.execute_python_cell(
+            f"response = await http.get('{server.url}/foo', ttl=0)\n"
+            "vars['path'] = response.json()['path']"
+        ):
+            pass
+        self.assertEqual((await engine.get_stream_variables())["path"], "/foo")
+
+
+class ScriptCellSandboxTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        from stream.tests import StreamTestCase
+
+        self.graph = GraphTestCase.get_graph()
+        self.stream = StreamTestCase.get_stream()
+        self.sandbox = ScriptCellSandbox(
+            processes=1, cpu_time=0.5, timeout=2.0, memory=256
+        )
+
+    def tearDown(self) -> None:
+        self.sandbox.shutdown()
+
+    def get_engine(self) -> Engine:
+        engine = Engine(self.graph, self.stream, raise_exceptions=True, sandbox=False)
+        engine.sandbox = self.sandbox
+        return engine
+
+    async def execute(self, engine: Engine, cell_code: str) -> None:
+        async for _ in engine.execute_python_cell(cell_code):
+            pass
+
+    def test_can_run_in_sandbox(self):
+        self.assertTrue(can_run_in_sandbox("vars['a'] = int(vars['b']) + 1"))
+        self.assertTrue(can_run_in_sandbox("while True:\n    pass"))
+        self.assertFalse(can_run_in_sandbox("await asyncio.sleep(1)"))
+        self.assertFalse(can_run_in_sandbox("yield Dialog(title='Hello')"))
+        self.assertFalse(can_run_in_sandbox("self.blocking_time = 2"))
+        self.assertFalse(can_run_in_sandbox("if True"))
+
+    async def test_variables(self):
+        await StreamVariable.objects.acreate(stream=self.stream, key="a", value="2")
+        engine = self.get_engine()
+        await self.execute(engine, "vars['b'] = int(vars['a']) * 21")
+        self.assertEqual(
+            (await StreamVariable.objects.aget(stream=self.stream, key="b")).value,
+            "42",
+        )
+        self.assertEqual(await engine.get_stream_variables(), {"a": "2", "b": "42"})
+
+    async def test_cpu_timeout(self):
+        engine = self.get_engine()
+        with self.assertRaises(ScriptCellTimeout):
+            await asyncio.wait_for(self.execute(engine, "while True:\n    pass"), 5.0)
+        # the process is still usable afterwards
+        await self.execute(engine, "vars['foo'] = 'bar'")
+        self.assertEqual((await engine.get_stream_variables())["foo"], "bar")
+
+    async def test_memory_limit(self):
+        engine = self.get_engine()
+        with self.assertRaises(MemoryError):
+            await self.execute(engine, "x = [0] * 10**9")
+        await self.execute(engine, "vars['foo'] = 'bar'")
+        self.assertEqual((await engine.get_stream_variables())["foo"], "bar")
+
+    async def test_queue_time(self):
+        self.sandbox.timeout = 1.0
+        # the last cell waits longer than its timeout for the process
+        results = await asyncio.gather(
+            *[self.sandbox.run("time.sleep(0.7)", {}) for _ in range(3)]
+        )
+        self.assertEqual(results, [{}, {}, {}])
+
+    async def test_kill_only_stuck_process(self):
+        sandbox = ScriptCellSandbox(processes=2, cpu_time=0.5, timeout=1.0)
+        self.addCleanup(sandbox.shutdown)
+        stuck_cell = sandbox.run(
+            "while True:\n try:\n  while True:\n   pass\n except:\n  pass",
+            {},
+        )
+
+        async def other_cell():
+            # still runs when the stuck cell gets killed
+            await asyncio.sleep(1.6)
+            return await sandbox.run("time.sleep(0.9)\nvars['a'] = '1'", {})
+
+        results = await asyncio.gather(stuck_cell, other_cell(), return_exceptions=True)
+        self.assertIsInstance(results[0], SandboxTimeout)
+        self.assertEqual(results[1], {"a": "1"})
+        # the killed process gets replaced
+        self.assertEqual(await sandbox.run("vars['b'] = '2'", {}), {"b": "2"})
+
+    async def test_process_died(self):
+        cell = asyncio.create_task(self.sandbox.run("time.sleep(1.5)", {}))
+        await asyncio.sleep(0.3)
+        # e.g. killed because of its hard limits
+        for process in self.sandbox._pool._pool:  # type: ignore
+            process.kill()
+        with self.assertRaises(SandboxError):
+            await cell
+        self.assertEqual(await self.sandbox.run("vars['a'] = '1'", {}), {"a": "1"})
+
+
+class HotLoopPacerTestCase(TestCase):
+    def test_backoff(self):
+        pacer = HotLoopPacer(step_delay=0.1, max_delay=1.0, min_backoff=0.2)
+        a, b = uuid.uuid4(), uuid.uuid4()
+        self.assertEqual(pacer.step(a, False), 0.1)
+        self.assertEqual(pacer.step(b, False), 0.1)
+        self.assertFalse(pacer.is_backing_off)
+        self.assertEqual(
+            [pacer.step(x, False) for x in [a, b, a, b]], [0.2, 0.4, 0.8, 1.0]
+        )
+        self.assertTrue(pacer.is_backing_off)
+        self.assertEqual(pacer.step(a, True), 0.1)
+        self.assertFalse(pacer.is_backing_off)
+        self.assertEqual(pacer.step(a, False), 0.1)
+
+    def test_disabled(self):
+        pacer = HotLoopPacer(step_delay=0.0, max_delay=0.0)
+        a = uuid.uuid4()
+        self.assertEqual([pacer.step(a, False) for _ in range(3)], [0.0] * 3)
+
+
+class GraphVariablesTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        self.graph_variables = GraphVariables(
+            uuid.uuid4(), backend=InMemoryGraphVariableBackend()
+        )
+
+    async def test_set_get(self):
+        self.assertIsNone(await self.graph_variables.get("foo"))
+        self.assertEqual(await self.graph_variables.get("foo", "bar"), "bar")
+        await self.graph_variables.set("foo", 42)
+        self.assertEqual(await self.graph_variables.get("foo"), "42")
+        self.assertEqual(await self.graph_variables.get_all(), {"foo": "42"})
+        await self.graph_variables.delete("foo")
+        self.assertEqual(await self.graph_variables.get_all(), {})
+
+    async def test_graphs_are_separated(self):
+        await self.graph_variables.set("foo", "bar")
+        other = GraphVariables(uuid.uuid4(), backend=self.graph_variables.backend)
+        self.assertIsNone(await other.get("foo"))
+
+    async def test_increment(self):
+        self.assertEqual(await self.graph_variables.increment("votes"), 1)
+        self.assertEqual(await self.graph_variables.increment("votes", 2), 3)
+        self.assertEqual(await self.graph_variables.increment("votes", 0.5), 3.5)
+
+    async def test_concurrent_increment(self):
+        await asyncio.gather(
+            *[self.graph_variables.increment("votes") for _ in range(100)]
+        )
+        self.assertEqual(await self.graph_variables.get("votes"), "100")
+
+    async def test_compare_and_set(self):
+        self.assertTrue(await self.graph_variables.compare_and_set("leader", None, "a"))
+        self.assertFalse(
+            await self.graph_variables.compare_and_set("leader", None, "b")
+        )
+        self.assertFalse(await self.graph_variables.compare_and_set("leader", "b", "c"))
+        self.assertTrue(await self.graph_variables.compare_and_set("leader", "a", "c"))
+        self.assertEqual(await self.graph_variables.get("leader"), "c")
+
+    async def test_script_cell(self):
+        from stream.tests import StreamTestCase
+
+        graph = await sync_to_async(GraphTestCase.get_graph)()
+        engines = [
+            Engine(
+                graph,
+                await sync_to_async(StreamTestCase.get_stream)(),
+                raise_exceptions=True,
+            )
+            for _ in range(2)
+        ]
+        for engine in engines:
+            async for _ in engine.execute_python_cell(
+                "vars['votes'] = f\"{await graph_vars.increment('votes')}\""
+            ):
+                pass
+        self.assertEqual(
+            [(await engine.get_stream_variables())["votes"] for engine in engines],
+            ["1", "2"],
+        )
+
+    async def test_node_door(self):
+        await sync_to_async(EngineTestCase.setup_with_script_cell)(self, "2+2")  # type: ignore
+        node_a: Node = await Node.objects.afirst()  # type: ignore
+        node_b = await Node.objects.acreate(graph=self.graph)  # type: ignore
+        custom_node_door = await NodeDoor.objects.acreate(
+            door_type=NodeDoor.DoorType.OUTPUT,
+            node=node_a,
+            name="majority",
+            is_default=False,
+            code='int(graph_vars.get("votes", 0)) > 2',
+        )
+        await Edge.objects.acreate(
+            out_node_door=custom_node_door,
+            in_node_door=await node_b.aget_default_in_door(),
+        )
+        engine = Engine(
+            self.graph,  # type: ignore
+            self.stream,  # type: ignore
+            raise_exceptions=True,
+            run_cleanup_procedure=False,
+        )
+        engine._current_node = node_a
+        with self.assertRaises(GraphDeadEnd):
+            await engine.get_next_node()
+        await engine.graph_variables.set("votes", 3)
+        engine._current_node = node_a
+        self.assertEqual((await engine.get_next_node()).uuid, node_b.uuid)
+
+
+class ParkedStreamsTestCase(TestCase):
+    def tearDown(self) -> None:
+        ParkedStreams.clear()
+
+    def park(self):
+        return ParkedStreams.park(
+            stream_uuid=uuid.uuid4(),
+            graph_uuid=uuid.uuid4(),
+            node_uuid=uuid.uuid4(),
+        )
+
+    async def test_release(self):
+        parked = self.park()
+        waiter = asyncio.create_task(ParkedStreams.wait(parked.stream_uuid))
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        self.assertTrue(ParkedStreams.release(parked.stream_uuid))
+        await asyncio.wait_for(waiter, 0.5)
+        self.assertFalse(ParkedStreams.release(parked.stream_uuid))
+
+    async def test_no_expiry(self):
+        parked = self.park()
+        # the stream stays parked until the listener disconnects
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(ParkedStreams.wait(parked.stream_uuid), 0.1)
+        self.assertEqual(ParkedStreams.all(), [])
+
+    async def test_disconnect(self):
+        parked = self.park()
+        waiter = asyncio.create_task(ParkedStreams.wait(parked.stream_uuid))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertIsNone(ParkedStreams.get(parked.stream_uuid))
+
+    async def test_shared(self):
+        parked = self.park()
+        waiters = [
+            asyncio.create_task(ParkedStreams.wait(parked.stream_uuid))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.01)
+        # a disconnect of one listener keeps the stream parked for the others
+        waiters[0].cancel()
+        await asyncio.sleep(0.01)
+        self.assertIsNotNone(ParkedStreams.get(parked.stream_uuid))
+        ParkedStreams.release(parked.stream_uuid)
+        await asyncio.wait_for(waiters[1], 0.5)
+
+    async def test_not_parked(self):
+        await asyncio.wait_for(ParkedStreams.wait(uuid.uuid4()), 0.1)
+
+
+class SharedEngineTestCase(TestCase):
+    def setUp(self) -> None:
+        self.stream_uuid = uuid.uuid4()
+        self.starts = 0
+        self.stopped = False
+        self.events: asyncio.Queue = asyncio.Queue()
+
+    def tearDown(self) -> None:
+        ParkedStreams.clear()
+
+    async def start(self):
+        self.starts += 1
+        try:
+            while (event := await self.events.get()) is not None:
+                yield event
+        finally:
+            self.stopped = True
+
+    async def test_fan_out(self):
+        first = SharedEngine.subscribe(self.stream_uuid, self.start)
+        second = SharedEngine.subscribe(self.stream_uuid, self.start)
+        first_event = asyncio.ensure_future(first.__anext__())
+        second_event = asyncio.ensure_future(second.__anext__())
+        await asyncio.sleep(0.01)
+        await self.events.put("a")
+        self.assertEqual(await first_event, "a")
+        self.assertEqual(await second_event, "a")
+
+        # a late listener receives the latest event
+        third = SharedEngine.subscribe(self.stream_uuid, self.start)
+        self.assertEqual(await third.__anext__(), "a")
+        self.assertEqual(SharedEngine.get(self.stream_uuid).num_subscribers, 3)  # type: ignore
+
+        await self.events.put(None)
+        for subscription in (first, second, third):
+            with self.assertRaises(StopAsyncIteration):
+                await subscription.__anext__()
+        self.assertEqual(self.starts, 1)
+        self.assertIsNone(SharedEngine.get(self.stream_uuid))
+
+    async def test_late_listener_current_state(self):
+        instruction: StreamInstruction = await sync_to_async(mixer.blend)(
+            StreamInstruction, state=StreamInstruction.InstructionState.SENT
+        )  # type: ignore
+        first = SharedEngine.subscribe(self.stream_uuid, self.start)
+        await self.events.put(instruction)
+        self.assertEqual(await first.__anext__(), instruction)
+
+        # a running instruction is replayed
+        second = SharedEngine.subscribe(self.stream_uuid, self.start)
+        self.assertEqual(await second.__anext__(), instruction)
+
+        # a finished instruction is not
+        await StreamInstruction.objects.filter(uuid=instruction.uuid).aupdate(
+            state=StreamInstruction.InstructionState.FINISHED
+        )
+        third = SharedEngine.subscribe(self.stream_uuid, self.start)
+        third_event = asyncio.ensure_future(third.__anext__())
+        await asyncio.sleep(0.01)
+        self.assertFalse(third_event.done())
+
+        # neither is a dialog
+        dialog = Dialog(title="Hello", content=[], buttons=[])
+        await self.events.put(dialog)
+        self.assertEqual(await third_event, dialog)
+        fourth = SharedEngine.subscribe(self.stream_uuid, self.start)
+        await self.events.put("b")
+        self.assertEqual(await fourth.__anext__(), "b")
+
+        await self.events.put(None)
+        for subscription in (first, second, third, fourth):
+            await subscription.aclose()
+
+    async def test_stop_without_listeners(self):
+        first = SharedEngine.subscribe(self.stream_uuid, self.start)
+        second = SharedEngine.subscribe(self.stream_uuid, self.start)
+        await self.events.put("a")
+        await first.__anext__()
+        await second.__anext__()
+        await first.aclose()
+        await asyncio.sleep(0.01)
+        self.assertFalse(self.stopped)
+        await second.aclose()
+        await asyncio.sleep(0.01)
+        self.assertTrue(self.stopped)
+        self.assertIsNone(SharedEngine.get(self.stream_uuid))
+
+    async def test_parked(self):
+        ParkedStreams.park(
+            stream_uuid=self.stream_uuid,
+            graph_uuid=uuid.uuid4(),
+            node_uuid=uuid.uuid4(),
+        )
+        events = [e async for e in SharedEngine.subscribe(self.stream_uuid, self.start)]
+        self.assertEqual(events, [])
+        self.assertEqual(self.starts, 0)
+
+
+class SimulatorTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        self.graph = GraphTestCase.get_graph()
+        self.entry_node = async_to_sync(self.graph.acreate_entry_node)()
+        ScriptCellTestCase.get_script_cell(
+            node=self.entry_node,
+            cell_type=CellType.MARKDOWN,
+            cell_code="Hello {var}`name`",
+        )
+        self.node_alice = NodeTestCase.get_node(graph=self.graph, is_entry_node=False)
+        self.node_other = NodeTestCase.get_node(graph=self.graph, is_entry_node=False)
+        self.node_unreachable = NodeTestCase.get_node(
+            graph=self.graph, is_entry_node=False
+        )
+        alice_door = NodeDoor.objects.create(
+            door_type=NodeDoor.DoorType.OUTPUT,
+            node=self.entry_node,
+            name="alice",
+            order=1,
+            is_default=False,
+            code="vars.get('name') == 'Alice'",
+        )
+        Edge.objects.create(
+            out_node_door=alice_door,
+            in_node_door=self.node_alice.get_default_in_door(),
+        )
+        Edge.objects.create(
+            out_node_door=self.entry_node.get_default_out_door(),
+            in_node_door=self.node_other.get_default_in_door(),
+        )
+
+    def test_simulate(self):
+        report = simulate(
+            self.graph,
+            walks=20,
+            variables={"name": ["Alice", "Bob"]},
+            processes=1,
+            seed=42,
+        )
+        self.assertEqual(report.walks, 20)
+        self.assertEqual(report.steps, 40)
+        self.assertEqual(report.path_lengths, {2: 20})
+        self.assertEqual(report.node_visits[self.entry_node.uuid], 20)
+        self.assertEqual(
+            report.node_visits[self.node_alice.uuid]
+            + report.node_visits[self.node_other.uuid],
+            20,
+        )
+        self.assertEqual(sum(report.dead_ends.values()), 20)
+        self.assertEqual(report.coverage, 0.75)
+        self.assertEqual(report.unvisited_nodes, [self.node_unreachable.uuid])
+        self.assertEqual(len(report.errors), 0)
+        self.assertIn("Coverage: 75.0% of 4 nodes", report.summary())
+        self.assertEqual(
+            report.to_dict()["dead_ends"],
+            {str(k): v for k, v in report.dead_ends.items()},
+        )
+
+    async def test_simulation_engine(self):
+        engine = SimulationEngine(self.graph, {"name": "Alice"})
+        instructions = [i async for i in engine.start(max_steps=10)]
+        self.assertEqual(engine.path, [self.entry_node.uuid, self.node_alice.uuid])
+        self.assertEqual(engine.dead_end, self.node_alice.uuid)
+        self.assertEqual(len(instructions), 1)
+        self.assertEqual(
+            instructions[0].instruction_text, "<speak>Hello Alice</speak>"  # type: ignore
+        )
+        self.assertFalse(await StreamVariable.objects.aexists())
+
+    async def test_graph_variables(self):
+        await ScriptCell.objects.acreate(
+            node=self.node_other,
+            cell_type=CellType.PYTHON,
+            cell_code="await graph_vars.increment('votes')",
+        )
+        live_variables = GraphVariables(self.graph.uuid)
+        await live_variables.set("votes", 10)
+        report = await asimulate_walks(
+            self.graph, walks=5, variables={"name": ["Bob"]}, seed=42
+        )
+        self.assertEqual(len(report.errors), 0)
+        # the simulation works on a copy of the variables of the listeners
+        self.assertEqual(await live_variables.get("votes"), "10")
+        await live_variables.delete("votes")
+
+    async def test_seed(self):
+        await ScriptCell.objects.acreate(
+            node=self.node_other,
+            cell_type=CellType.PYTHON,
+            cell_code="vars['pick'] = random.randint(0, 1000000)",
+        )
+        engines = []
+        for _ in range(2):
+            engine = SimulationEngine(self.graph, {"name": "Bob"}, seed=42)
+            async for _instruction in engine.start(max_steps=10):
+                pass
+            engines.append(engine)
+        self.assertEqual(
+            engines[0].variable_store["pick"], engines[1].variable_store["pick"]
+        )
+
+        # the global generator of the caller is not touched
+        state = random.getstate()
+        await asimulate_walks(self.graph, walks=3, seed=42)
+        self.assertEqual(random.getstate(), state)
+
+    async def test_timeouts(self):
+        await ScriptCell.objects.acreate(
+            node=self.node_other,
+            cell_type=CellType.PYTHON,
+            cell_code="await wait_for_stream_variable('answer')",
+        )
+        with mock.patch("story_graph.engine.log") as log:
+            report = await asimulate_walks(
+                self.graph, walks=3, variables={"name": ["Bob"]}, seed=42
+            )
+        log.error.assert_not_called()
+        self.assertEqual(report.timeouts, 3)
+        self.assertEqual(len(report.errors), 0)
+        self.assertIn("Script cell timeouts: 3", report.summary())
+
+    def test_command_unknown_graph(self):
+        for graph_uuid in [str(uuid.uuid4()), "not-a-uuid"]:
+            with self.assertRaises(CommandError):
+                call_command("simulate_graph", graph_uuid)
+
+    def test_play_queued_audio_file(self):
+        stream_point = SimulatedStreamPoint()
+        stream_point.play_audio_file("foo.flac", queue=True)
+        self.assertEqual(stream_point.instructions, 1)
+
+
+class ProfilerTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        from stream.tests import StreamTestCase
+
+        self.graph = GraphTestCase.get_graph()
+        self.stream = StreamTestCase.get_stream()
+        self.entry_node = async_to_sync(self.graph.acreate_entry_node)()
+        GraphProfile.clear()
+
+    def tearDown(self) -> None:
+        GraphProfile.clear()
+
+    async def test_profile_node(self):
+        await sync_to_async(ScriptCellTestCase.get_script_cell)(
+            node=self.entry_node,
+            cell_type=CellType.PYTHON,
+            cell_code="vars['foo'] = 'bar'\nawait wait_for_stream_variable('missing', timeout=0.1)",
+        )
+        engine = Engine(
+            self.graph,
+            self.stream,
+            run_cleanup_procedure=False,
+            profile=True,
+            lookahead_synthesis=False,
+        )
+        engine.profiler.slow_cell_threshold = 10.0  # type: ignore
+        async for _ in engine.execute_node(self.entry_node):
+            pass
+        engine._current_node = self.entry_node
+        with self.assertRaises(GraphDeadEnd):
+            await engine.get_next_node()
+        await engine.variable_store.aclose()
+
+        profile = GraphProfile.get(self.graph.uuid)
+        stats = profile.stats[(self.entry_node.uuid, CellType.PYTHON)]
+        self.assertEqual(stats.count, 1)
+        self.assertGreaterEqual(stats.wait_time, 0.1)
+        self.assertGreaterEqual(stats.wall_time, stats.wait_time)
+        # reading and writing the variables
+        self.assertGreaterEqual(stats.queries, 2)
+        self.assertEqual(sum(stats.histogram), 1)
+        self.assertEqual(
+            profile.stats[(self.entry_node.uuid, DOOR_EVALUATION)].count, 1
+        )
+        self.assertEqual(profile.by_node()[self.entry_node.uuid].count, 2)
+
+    async def test_slow_cell(self):
+        await sync_to_async(ScriptCellTestCase.get_script_cell)(
+            node=self.entry_node,
+            cell_type=CellType.PYTHON,
+            cell_code="time.sleep(0.05)",
+        )
+        engine = Engine(
+            self.graph,
+            self.stream,
+            run_cleanup_procedure=False,
+            profile=True,
+            lookahead_synthesis=False,
+        )
+        engine.profiler.slow_cell_threshold = 0.01  # type: ignore
+        with mock.patch("story_graph.profiler.log") as log_mock:
+            async for _ in engine.execute_node(self.entry_node):
+                pass
+        log_mock.warning.assert_called_once()
+        extra = log_mock.warning.call_args.kwargs["extra"]
+        self.assertIs(extra["stream"], self.stream)
+        self.assertTrue(extra["to_db"])
+
+    async def test_no_profile(self):
+        engine = Engine(self.graph, self.stream, run_cleanup_procedure=False)
+        self.assertIsNone(engine.profiler)
+
+    def test_query_counter(self):
+        from django.db import connection
+
+        from .profiler import _count_queries
+
+        # profilers of other tests which have not been closed
+        gc.collect()
+        connection.ensure_connection()
+        self.assertNotIn(_count_queries, connection.execute_wrappers)
+        profiler = EngineProfiler(self.graph.uuid)
+        self.assertIn(_count_queries, connection.execute_wrappers)
+        profiler.close()
+        self.assertNotIn(_count_queries, connection.execute_wrappers)
+
+
+class EngineWorkerTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        from stream.tests import StreamTestCase
+
+        self.graph = GraphTestCase.get_graph()
+        self.stream = StreamTestCase.get_stream()
+        self.instruction: StreamInstruction = mixer.blend(StreamInstruction, stream_point=self.stream.stream_point)  # type: ignore
+        self.stopped = False
+
+    async def start_engine(self, *args, **kwargs):
+        try:
+            yield self.instruction
+            yield Dialog(
+                title="Hello", content=[Text(text="World")], buttons=[Button.ok()]
+            )
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            self.stopped = True
+            raise
+
+    def start_worker(self) -> asyncio.Task:
+        from channels.layers import get_channel_layer
+        from channels.worker import Worker
+
+        worker = Worker(
+            EngineWorker.as_asgi(),
+            channels=[GenCasterChannel.ENGINE_WORKER_CHANNEL],
+            channel_layer=get_channel_layer(),
+        )
+        return asyncio.create_task(worker.handle())
+
+    async def test_relay(self):
+        worker = self.start_worker()
+        with mock.patch("story_graph.worker.Engine.start", self.start_engine):
+            events = relay_engine(self.graph, self.stream, timeout=1.0)
+            instruction: StreamInstruction = await events.__anext__()  # type: ignore
+            self.assertEqual(instruction.uuid, self.instruction.uuid)
+            dialog: Dialog = await events.__anext__()  # type: ignore
+            self.assertEqual(dialog.title, "Hello")
+            self.assertEqual(dialog.content[0].text, "World")  # type: ignore
+            self.assertEqual(dialog.buttons[0].button_type, Button.ok().button_type)
+            # closing the subscription stops the engine on the worker
+            await events.aclose()
+            await asyncio.sleep(0.1)
+        worker.cancel()
+        self.assertTrue(self.stopped)
+
+    async def test_relay_cleanup_procedure(self):
+        engines: List[Engine] = []
+
+        async def start_engine(engine: Engine, *args, **kwargs):
+            engines.append(engine)
+            yield self.instruction
+
+        # the worker fetches the stream after the listener has been counted
+        await Stream.objects.filter(uuid=self.stream.uuid).aupdate(num_listeners=1)
+        worker = self.start_worker()
+        with mock.patch("story_graph.worker.Engine.start", start_engine):
+            async for _ in relay_engine(
+                self.graph, self.stream, timeout=1.0, run_cleanup_procedure=True
+            ):
+                pass
+        worker.cancel()
+        self.assertTrue(engines[0].run_cleanup_procedure)
+
+    async def test_relay_parked(self):
+        async def park_engine(*args, **kwargs):
+            yield self.instruction
+            ParkedStreams.park(
+                stream_uuid=self.stream.uuid,
+                graph_uuid=self.graph.uuid,
+                node_uuid=self.graph.uuid,
+            )
+
+        worker = self.start_worker()
+        with mock.patch("story_graph.worker.Engine.start", park_engine):
+            instructions = [
+                i async for i in relay_engine(self.graph, self.stream, timeout=1.0)
+            ]
+        worker.cancel()
+        self.assertEqual(len(instructions), 1)
+        # the stream is parked on the side of the subscription
+        parked = ParkedStreams.pop(self.stream.uuid)
+        self.assertEqual(parked.node_uuid, self.graph.uuid)  # type: ignore
+
+    async def test_no_worker(self):
+        with mock.patch("story_graph.worker.Engine.start", self.start_engine):
+            events = relay_engine(self.graph, self.stream, timeout=0.05)
+            instruction: StreamInstruction = await events.__anext__()  # type: ignore
+            await events.aclose()
+        self.assertEqual(instruction.uuid, self.instruction.uuid)
+        # the outdated request is ignored by a worker which starts later
+        worker = self.start_worker()
+        await asyncio.sleep(0.1)
+        worker.cancel()
+        self.assertFalse(self.stopped)
+
+
+class PrewarmTestCase(TransactionTestCase):
+    def setUp(self) -> None:
+        self.backend = FakeTextToSpeechBackend()
+        self.service = TextToSpeechService(self.backend)
+        patcher = mock.patch("stream.tts._service", self.service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.graph = GraphTestCase.get_graph()
+        node = NodeTestCase.get_node(graph=self.graph)
+        other_node = NodeTestCase.get_node(graph=self.graph)
+        for cell_node, cell_code in [
+            (node, "Hello world"),
+            (other_node, "Hello world"),
+            (node, "Good bye"),
+            (node, "Hello {var}`name`"),
+            (other_node, "{python}`1+2`"),
+        ]:
+            ScriptCellTestCase.get_script_cell(
+                node=cell_node,
+                cell_type=CellType.MARKDOWN,
+                cell_code=cell_code,
+            )
+        ScriptCellTestCase.get_script_cell(
+            node=node,
+            cell_type=CellType.PYTHON,
+            cell_code="print('not a text')",
+        )
+
+    def test_prewarm(self):
+        report = prewarm_graph(self.graph)
+        self.assertEqual(report.cells, 5)
+        self.assertEqual(report.dynamic_cells, 2)
+        self.assertEqual(report.texts, 2)
+        self.assertEqual(report.misses, 2)
+        self.assertEqual(report.hits, 0)
+        self.assertEqual(report.failures, 0)
+        self.assertEqual(len(self.backend.requests), 2)
+        self.assertEqual(TextToSpeech.objects.count(), 2)
+        self.assertEqual(len(report.synthesis_times), 2)
+
+    def test_prewarm_hits(self):
+        prewarm_graph(self.graph)
+        report = prewarm_graph(self.graph)
+        self.assertEqual(report.hits, 2)
+        self.assertEqual(report.misses, 0)
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def test_prewarm_chunks(self):
+        with self.settings(TTS_CHUNK_CHARS=10):
+            ScriptCellTestCase.get_script_cell(
+                node=NodeTestCase.get_node(graph=self.graph),
+                cell_type=CellType.MARKDOWN,
+                cell_code="The first sentence. The second sentence.",
+            )
+            report = prewarm_graph(self.graph)
+        self.assertEqual(report.texts, 4)
+
+    def test_prewarm_retry(self):
+        synthesize = self.backend.synthesize
+        calls: List[str] = []
+
+        def flaky_synthesize(ssml_text: str, voice_name: str) -> bytes:
+            calls.append(ssml_text)
+            if calls.count(ssml_text) == 1:
+                raise ConnectionError("Unavailable")
+            return synthesize(ssml_text, voice_name)
+
+        with mock.patch.object(self.backend, "synthesize", flaky_synthesize):
+            report = prewarm_graph(self.graph, retry_delay=0.0)
+        self.assertEqual(report.retries, 2)
+        self.assertEqual(report.failures, 0)
+        self.assertEqual(TextToSpeech.objects.count(), 2)
+
+    def test_prewarm_failure(self):
+        with mock.patch.object(
+            self.backend, "synthesize", side_effect=ConnectionError("Unavailable")
+        ):
+            report = prewarm_graph(self.graph, retries=2, retry_delay=0.0)
+        self.assertEqual(report.failures, 2)
+        self.assertEqual(report.retries, 4)
+        self.assertEqual(report.errors["ConnectionError: Unavailable"], 2)
+        self.assertIn("Failures: 2", report.summary())
+        self.assertEqual(TextToSpeech.objects.count(), 0)
+
+    def test_prewarm_command_unknown_graph(self):
+        for graph_uuid in [str(uuid.uuid4()), "not-a-uuid"]:
+            with self.assertRaises(CommandError):
+                call_command("prewarm_graph", graph_uuid)
+
+    def test_prewarm_admin_action(self):
+        graph_admin = GraphAdmin(Graph, AdminSite())
+        request = mock.MagicMock()
+        with mock.patch(
+            "story_graph.admin.prewarm_graphs_in_background"
+        ) as prewarm, mock.patch.object(graph_admin, "message_user") as message_user:
+            graph_admin.prewarm_text_to_speech(request, Graph.objects.all())
+        prewarm.assert_called_once_with([self.graph])
+        self.assertIn("Queued", message_user.call_args.args[1])
+        self.assertEqual(len(self.backend.requests), 0)
@@ -71,6 +71,7 @@ class NodeUpdate:
 class EdgeInput:
     node_door_in_uuid: uuid.UUID
     node_door_out_uuid: uuid.UUID
+    weight: float = 1.0
 
 
 @strawberry.django.filters.filter(models.Graph, lookups=True)
@@ -190,6 +191,7 @@ class Edge:
     uuid: auto
     in_node_door: NodeDoor
     out_node_door: NodeDoor
+    weight: auto
 
 
 @strawberry.django.type(models.AudioCell)
@@ -207,6 +209,7 @@ class ScriptCell:
     cell_type: CellType  # type: ignore
     cell_code: auto
     cell_order: auto
+    concurrent_group: auto
     audio_cell: Optional[AudioCell]
 
 
@@ -228,6 +231,7 @@ class ScriptCellInputCreate:
     cell_type: CellType  # type: ignore
     cell_code: auto
     cell_order: auto = strawberry.django.field(default=None)
+    concurrent_group: auto = strawberry.django.field(default=None)
     audio_cell: Optional[AudioCellInput]
 
 
@@ -237,4 +241,42 @@ class ScriptCellInputUpdate:
     cell_type: Optional[CellType]  # type: ignore
     cell_code: Optional[str]
     cell_order: Optional[int]
+    concurrent_group: Optional[int]
     audio_cell: Optional[AudioCellInput]
+
+
+@strawberry.type
+class EngineProfileStats:
+    """Execution times of a category (a cell type or ``door_evaluation``)
+    on a node, see :mod:`~story_graph.profiler`.
+    The histogram counts the executions per bucket, whose upper bounds
+    are listed in ``histogram_buckets``, the last bucket is unbounded.
+    """
+
+    node_uuid: uuid.UUID
+    category: str
+    count: int
+    wall_time: float
+    mean_wall_time: float
+    max_wall_time: float
+    wait_time: float
+    queries: int
+    histogram: List[int]
+    histogram_buckets: List[float]
+
+
+@strawberry.type
+class GraphVariable:
+    """A variable which is shared by all streams of a graph,
+    see :mod:`~story_graph.graph_variables`.
+    """
+
+    key: str
+    value: str
+
+
+@strawberry.input
+class GraphVariableInput:
+    graph_uuid: uuid.UUID
+    key: str
+    value: str
@@ -0,0 +1,218 @@
+"""
+Variable store
+==============
+
+An engine local mirror of the :class:`~stream.models.StreamVariable` of a
+:class:`~stream.models.Stream`.
+
+The store is loaded once from the database and is afterwards kept up to date
+by listening to the changes of the variables which are published via
+:class:`~gencaster.distributor.GenCasterChannel`.
+Writes of the :class:`~story_graph.engine.Engine` are tracked as dirty keys
+and are written back via a single bulk upsert on :func:`~StreamVariableStore.aflush`.
+
+Every change of a variable increases :attr:`~StreamVariableStore.version`,
+which allows the engine to detect if a node made any progress,
+see :mod:`~story_graph.pacing`.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, Iterator, MutableMapping, Optional, Set
+
+from gencaster.distributor import (
+    ChannelSubscription,
+    GenCasterChannel,
+    MissingChannelLayer,
+)
+from stream.models import Stream, StreamVariable
+
+log = logging.getLogger(__name__)
+
+# seconds between reading the variables if no channel layer is available
+POLL_INTERVAL = 0.5
+
+
+class StreamVariableStore(MutableMapping[str, Any]):
+    """A write-through mapping of the variables of a stream which is exposed as
+    ``vars`` within a script cell.
+
+    Values which are set are kept as is until they are flushed, so they
+    can be used within the same script cell, e.g. for calculations.
+    Upon flushing they are converted to a string as this is how they are
+    stored in the database.
+
+    If no channel layer is available to listen for changes, the variables
+    are re-read from the database on each call of :func:`~StreamVariableStore.aload`.
+    """
+
+    def __init__(self, stream: Stream) -> None:
+        self.stream = stream
+        self._values: Dict[str, Any] = {}
+        self._dirty: Set[str] = set()
+        self._loaded: bool = False
+        self._subscription: Optional[ChannelSubscription] = None
+        self._listener: Optional[asyncio.Task] = None
+        self.version: int = 0
+        # version of the last change per variable
+        self._key_versions: Dict[str, int] = {}
+        self._changed = asyncio.Event()
+
+    def _mark_changed(self, key: str) -> None:
+        self.version += 1
+        self._key_versions[key] = self.version
+        self._changed.set()
+
+    def _has_changed(self, version: int, keys: Optional[Iterable[str]]) -> bool:
+        if keys is None:
+            return self.version != version
+        return any(self._key_versions.get(key, 0) > version for key in keys)
+
+    async def wait_for_change(
+        self,
+        timeout: float,
+        keys: Optional[Iterable[str]] = None,
+        since: Optional[int] = None,
+    ) -> bool:
+        """Waits up to ``timeout`` seconds for a change of a variable
+        and returns ``True`` if a variable has changed.
+
+        :param keys: Only consider changes of these variables,
+            defaults to any variable
+        :param since: Also consider changes since this :attr:`version`,
+            defaults to the current version
+        """
+        loop = asyncio.get_running_loop()
+        version = self.version if since is None else since
+        deadline = loop.time() + timeout
+        while not self._has_changed(version, keys):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait(),
+                    # without a channel layer we need to poll the database
+                    remaining if self._loaded else min(remaining, POLL_INTERVAL),
+                )
+            except asyncio.TimeoutError:
+                if not self._loaded:
+                    await self._read_from_db()
+        return True
+
+    async def _read_from_db(self) -> None:
+        values: Dict[str, Any] = {}
+        stream_variable: StreamVariable
+        async for stream_variable in self.stream.variables.all():
+            values[stream_variable.key] = stream_variable.value
+        # do not overwrite values which have not been flushed yet
+        for key in self._dirty:
+            values[key] = self._values[key]
+        for key in values.keys() | self._values.keys():
+            if values.get(key) != self._values.get(key):
+                self._mark_changed(key)
+        self._values = values
+
+    async def aload(self) -> None:
+        """Makes sure the store reflects the state of the database.
+        Only the first call reads from the database as long as we can
+        listen to changes.
+        """
+        if self._loaded:
+            return
+        if self._subscription is None:
+            try:
+                # subscribe before reading so we do not miss any change
+                self._subscription = (
+                    await GenCasterChannel.subscribe_stream_variable_updates(
+                        self.stream.uuid
+                    ).__aenter__()
+                )
+            except MissingChannelLayer:
+                log.warning(
+                    f"No channel layer available - stream variables of {self.stream.uuid} will be polled"
+                )
+                await self._read_from_db()
+                return
+            self._listener = asyncio.create_task(self._listen(self._subscription))
+        await self._read_from_db()
+        self._loaded = True
+
+    async def _listen(self, subscription: ChannelSubscription) -> None:
+        async for message in subscription:
+            if message["key"] in self._dirty:
+                continue
+            if self._values.get(message["key"]) == message["value"]:
+                continue
+            self._values[message["key"]] = message["value"]
+            self._mark_changed(message["key"])
+
+    async def aget_all(self) -> Dict[str, str]:
+        """Returns a copy of all variables."""
+        await self.aload()
+        return dict(self._values)
+
+    async def aflush(self) -> None:
+        """Writes all changed variables within a single query to the database
+        and notifies anyone who waits for a variable.
+        """
+        if not self._dirty:
+            return
+        updates = {key: str(self._values[key]) for key in self._dirty}
+        self._dirty.clear()
+        for key, value in updates.items():
+            log.debug(f"New stream variable: {key} -> {value}")
+            self._values[key] = value
+        # a bulk upsert does not trigger the post_save signal
+        await StreamVariable.objects.abulk_create(
+            [
+                StreamVariable(stream=self.stream, key=key, value=value)
+                for key, value in updates.items()
+            ],
+            update_conflicts=True,
+            unique_fields=["stream", "key"],
+            update_fields=["value", "modified_date"],
+        )
+        try:
+            for key, value in updates.items():
+                await GenCasterChannel.send_stream_variable_update(
+                    self.stream.uuid, key, value
+                )
+        except MissingChannelLayer:
+            pass
+
+    async def aclose(self) -> None:
+        """Stops listening to changes."""
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        if self._subscription:
+            await self._subscription.__aexit__()
+            self._subscription = None
+        self._loaded = False
+
+    def __getitem__(self, key: str) -> Any:
+        return self._values[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in self._values and self._values[key] == value:
+            return
+        self._values[key] = value
+        self._dirty.add(key)
+        self._mark_changed(key)
+
+    def __delitem__(self, key: str) -> None:
+        # deleting is not persisted
+        del self._values[key]
+        self._dirty.discard(key)
+        self._mark_changed(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __repr__(self) -> str:
+        return repr(self._values)
@@ -0,0 +1,215 @@
+"""
+Worker
+======
+
+Allows to run the :class:`~story_graph.engine.Engine` of each stream within a
+pool of dedicated worker processes instead of the ASGI process which serves
+the websocket connections of the listeners.
+
+If ``ENGINE_WORKERS`` is enabled, the ``stream_info`` subscription requests
+an engine via the named channel ``engine-worker`` of the channel layer and
+only relays the :class:`~stream.models.StreamInstruction` and
+:class:`~stream.frontend_types.Dialog` events of the engine to the listener,
+see :func:`~relay_engine`.
+A pool of workers is started by running
+
+.. code-block:: shell
+
+    python manage.py runworker engine-worker
+
+in as many processes as needed - the channel layer hands each request
+to exactly one of them.
+If no worker acknowledges a request within ``ENGINE_WORKER_START_TIMEOUT``
+seconds the engine will be run within the ASGI process as before.
+
+A stream which halts on a blocking node gets parked within the ASGI process,
+see :mod:`~story_graph.parking`, so the worker does not keep the engine.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from functools import partial
+from typing import Any, AsyncGenerator, Dict, Optional, Union
+
+from channels.consumer import AsyncConsumer
+from django.conf import settings
+
+from gencaster.db_logging import LogContext, LogKeyEnum
+from gencaster.distributor import (
+    EngineEventMessage,
+    GenCasterChannel,
+    engine_control_group,
+)
+from stream.frontend_types import Dialog
+from stream.models import Stream, StreamInstruction
+
+from .engine import Engine
+from .models import Graph
+from .parking import ParkedStreams
+
+log = logging.getLogger(__name__)
+
+
+class EngineWorker(AsyncConsumer):
+    """Consumer of the ``engine-worker`` channel which runs an engine
+    for each requested session of a stream.
+
+    Each engine joins the control group of its session, so it can be
+    stopped by :func:`~gencaster.distributor.GenCasterChannel.send_engine_stop`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.engines: Dict[str, asyncio.Task] = {}
+
+    async def engine_start(self, message: Dict[str, Any]) -> None:
+        session: str = message["session"]
+        if (expires := message.get("expires")) and expires < time.time():
+            log.debug(f"Ignore outdated engine request for stream {message['uuid']}")
+            return
+        if session in self.engines:
+            log.warning(f"Engine session {session} is already running")
+            return
+        await self.channel_layer.group_add(
+            engine_control_group(session), self.channel_name
+        )
+        task = asyncio.create_task(
+            self.run_engine(
+                graph_uuid=message["graph_uuid"],
+                stream_uuid=message["uuid"],
+                session=session,
+                resume=message.get("resume", False),
+                run_cleanup_procedure=message.get("run_cleanup_procedure"),
+            )
+        )
+        self.engines[session] = task
+        task.add_done_callback(partial(self.engines.pop, session))
+
+    async def engine_stop(self, message: Dict[str, Any]) -> None:
+        if task := self.engines.get(message["uuid"]):
+            log.info(f"Stop engine session {message['uuid']}")
+            task.cancel()
+
+    async def run_engine(
+        self,
+        graph_uuid: str,
+        stream_uuid: str,
+        session: str,
+        resume: bool = False,
+        run_cleanup_procedure: Optional[bool] = None,
+    ) -> None:
+        async def send_event(event: str, **kwargs) -> None:
+            await GenCasterChannel.send_engine_event(
+                EngineEventMessage(uuid=session, event=event, **kwargs)
+            )
+
+        try:
+            graph = await Graph.objects.aget(uuid=graph_uuid)
+            stream = await Stream.objects.select_related("stream_point").aget(
+                uuid=stream_uuid
+            )
+            with LogContext(LogKeyEnum.STREAM, stream):
+                engine = Engine(
+                    graph=graph,
+                    stream=stream,
+                    resume=resume,
+                    run_cleanup_procedure=run_cleanup_procedure,
+                )
+                await send_event("started")
+                async for instruction in engine.start(max_steps=int(10e10)):
+                    if isinstance(instruction, Dialog):
+                        await send_event("dialog", dialog=instruction.to_dict())
+                    else:
+                        await send_event(
+                            "instruction", instruction_uuid=str(instruction.uuid)  # type: ignore
+                        )
+            if parked := ParkedStreams.pop(stream.uuid):
+                # the subscription waits on the parked stream, so the
+                # worker does not need to keep anything
+                await send_event("parked", node_uuid=str(parked.node_uuid))
+            else:
+                await send_event("dead_end")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(f"Engine of stream {stream_uuid} failed: {e}")
+            await send_event("failure")
+        finally:
+            await self.channel_layer.group_discard(
+                engine_control_group(session), self.channel_name
+            )
+
+
+async def relay_engine(
+    graph: Graph,
+    stream: Stream,
+    resume: bool = False,
+    timeout: Optional[float] = None,
+    run_cleanup_procedure: Optional[bool] = None,
+) -> AsyncGenerator[Union[StreamInstruction, Dialog], None]:
+    """Requests an engine from an :class:`~EngineWorker` and yields its
+    events like :func:`~story_graph.engine.Engine.start`.
+    The engine gets stopped once the generator is closed, e.g. because
+    the listener disconnected.
+
+    :param resume: Continue from the checkpoint of the stream,
+        see :class:`~story_graph.engine.Engine`
+    :param timeout: Seconds to wait for a worker, defaults to
+        ``ENGINE_WORKER_START_TIMEOUT``
+    :param run_cleanup_procedure: See :class:`~story_graph.engine.Engine`,
+        which needs to be passed as the worker can not derive it from
+        the number of listeners anymore
+    """
+    if timeout is None:
+        timeout = settings.ENGINE_WORKER_START_TIMEOUT
+    session = uuid.uuid4()
+
+    async with GenCasterChannel.subscribe_engine_events(session) as events:
+        await GenCasterChannel.send_engine_start(
+            graph.uuid,
+            stream.uuid,
+            session=session,
+            resume=resume,
+            expires=time.time() + timeout,
+            run_cleanup_procedure=run_cleanup_procedure,
+        )
+        messages = events.__aiter__()
+        try:
+            message = await asyncio.wait_for(messages.__anext__(), timeout)
+        except asyncio.TimeoutError:
+            log.error(
+                f"No engine worker available for stream {stream.uuid} - run engine locally"
+            )
+            engine = Engine(
+                graph=graph,
+                stream=stream,
+                resume=resume,
+                run_cleanup_procedure=run_cleanup_procedure,
+            )
+            async for instruction in engine.start(max_steps=int(10e10)):
+                yield instruction  # type: ignore
+            return
+
+        try:
+            while True:
+                event = message["event"]
+                if event == "instruction":
+                    yield await StreamInstruction.objects.aget(
+                        uuid=message["instruction_uuid"]
+                    )
+                elif event == "dialog":
+                    yield Dialog.from_dict(message["dialog"])
+                elif event == "parked":
+                    ParkedStreams.park(
+                        stream_uuid=stream.uuid,
+                        graph_uuid=graph.uuid,
+                        node_uuid=uuid.UUID(message["node_uuid"]),
+                    )
+                    return
+                elif event in ("dead_end", "failure"):
+                    return
+                message = await messages.__anext__()
+        finally:
+            await GenCasterChannel.send_engine_stop(session)
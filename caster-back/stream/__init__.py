@@ -32,4 +32,16 @@ Exceptions
 .. automodule:: stream.exceptions
     :members:
 
+SSML
+----
+
+.. automodule:: stream.ssml
+    :members:
+
+Text to speech
+--------------
+
+.. automodule:: stream.tts
+    :members:
+
 """
@@ -151,6 +151,7 @@ class TextToSpeechAdmin(admin.ModelAdmin):
         "modified_date",
         "text",
         "voice_name",
+        "text_hash",
     ]
 
     list_filter = [
@@ -8,9 +8,9 @@ as they are also available within the :class:`~stream.engine.Engine`.
 The stream subscription makes it possible to yield the
 """
 
-from dataclasses import field
+from dataclasses import asdict, field
 from enum import Enum
-from typing import List
+from typing import Any, Dict, List
 
 import strawberry
 import strawberry.django
@@ -164,3 +164,54 @@ class Dialog:
             content=[Checkbox.gps()],
             buttons=[],
         )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serializes the dialog into plain types so it can be send via
+        the channel layer, see :func:`~Dialog.from_dict`.
+        """
+        content: List[Dict[str, Any]] = []
+        for c in self.content:
+            content.append({"__typename": type(c).__name__, **asdict(c)})  # type: ignore
+            if isinstance(c, Checkbox):
+                content[-1]["callback_actions"] = [a.value for a in c.callback_actions]  # type: ignore
+        return {
+            "title": self.title,
+            "content": content,
+            "buttons": [
+                {
+                    **asdict(button),
+                    "button_type": button.button_type.value,
+                    "callback_actions": [a.value for a in button.callback_actions],
+                }
+                for button in self.buttons
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Dialog":
+        content_types = {t.__name__: t for t in (Text, Input, Checkbox)}
+        content = []
+        for c in data["content"]:
+            c = dict(c)
+            content_type = content_types[c.pop("__typename")]
+            if content_type is Checkbox:
+                c["callback_actions"] = [
+                    CallbackAction(a) for a in c["callback_actions"]
+                ]
+            content.append(content_type(**c))
+        return cls(
+            title=data["title"],
+            content=content,
+            buttons=[
+                Button(
+                    **{
+                        **b,
+                        "button_type": ButtonType(b["button_type"]),
+                        "callback_actions": [
+                            CallbackAction(a) for a in b["callback_actions"]
+                        ],
+                    }
+                )
+                for b in data["buttons"]
+            ],
+        )
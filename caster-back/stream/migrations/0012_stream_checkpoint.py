@@ -0,0 +1,58 @@
+# Generated by Django 4.2.4 on 2026-10-18 09:08
+
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "story_graph",
+            "0016_nodedoor_remove_edge_unique_edge_remove_edge_in_node_and_more",
+        ),
+        ("stream", "0011_streamlog"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stream",
+            name="checkpoint_node",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="Node which is currently executed on the stream, a reconnecting listener resumes from this node",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="story_graph.node",
+                verbose_name="Checkpoint node",
+            ),
+        ),
+        # past streams do not get a token, so they can not be reconnected to
+        migrations.AddField(
+            model_name="stream",
+            name="reconnect_token",
+            field=models.UUIDField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="Allows a listener who lost the connection to re-attach to this stream",
+                null=True,
+                verbose_name="Reconnect token",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="stream",
+            name="reconnect_token",
+            field=models.UUIDField(
+                blank=True,
+                db_index=True,
+                default=uuid.uuid4,
+                editable=False,
+                help_text="Allows a listener who lost the connection to re-attach to this stream",
+                null=True,
+                verbose_name="Reconnect token",
+            ),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:12
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def populate_text_hash(apps, schema_editor):
+    """Sets the hash of all texts and merges texts which only differ by their
+    whitespace into their latest row, as the hash and voice become unique.
+    The audio of a merged row is kept and its description notes the merge.
+    """
+    TextToSpeech = apps.get_model("stream", "TextToSpeech")
+    AudioFile = apps.get_model("stream", "AudioFile")
+    kept = {}
+    merged = 0
+    for row in TextToSpeech.objects.order_by("-created_date"):
+        row.text_hash = hashlib.sha256(" ".join(row.text.split()).encode()).hexdigest()
+        key = (row.text_hash, row.voice_name)
+        if (latest := kept.get(key)) is None:
+            kept[key] = row
+            row.save(update_fields=["text_hash"])
+            continue
+        # the audio file does not depend on the text to speech row
+        if row.audio_file_id != latest.audio_file_id:
+            audio_file = AudioFile.objects.get(uuid=row.audio_file_id)
+            audio_file.description = (
+                f"{audio_file.description}\n\n" if audio_file.description else ""
+            ) + (
+                f"Audio of text to speech {row.uuid} which has been merged "
+                f"into {latest.uuid} as both share the same text"
+            )
+            audio_file.save(update_fields=["description"])
+        row.delete()
+        merged += 1
+    if merged:
+        print(
+            f"\n  Merged {merged} duplicated text to speech rows into their latest "
+            "row - their audio files have been kept and are marked in their description"
+        )
+
+
+def clear_text_hash(apps, schema_editor):
+    """Merged rows are not restored, but their audio files still exist."""
+    TextToSpeech = apps.get_model("stream", "TextToSpeech")
+    TextToSpeech.objects.update(text_hash="")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stream", "0012_stream_checkpoint"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="texttospeech",
+            name="text_hash",
+            field=models.CharField(
+                default="",
+                editable=False,
+                help_text="Allows to look up a text without comparing the whole text",
+                max_length=64,
+                verbose_name="Hash of the normalized text",
+            ),
+        ),
+        migrations.RunPython(populate_text_hash, reverse_code=clear_text_hash),
+        migrations.AddConstraint(
+            model_name="texttospeech",
+            constraint=models.UniqueConstraint(
+                fields=("text_hash", "voice_name"), name="unique_text_hash_voice_name"
+            ),
+        ),
+    ]
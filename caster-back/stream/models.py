@@ -1,19 +1,20 @@
+import hashlib
 import io
 import logging
 import uuid
 from datetime import timedelta
 from typing import Optional
+from uuid import uuid4
 
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 from django.conf import settings
 from django.contrib import admin
 from django.core.files import File
 from django.db import models
-from django.db.models import signals
+from django.db.models import F, signals
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext as _
-from google.cloud import texttospeech
 from pythonosc.udp_client import SimpleUDPClient
 
 import story_graph.models
@@ -138,11 +139,28 @@ class StreamPoint(models.Model):
             playback_type=story_graph.models.AudioCell.PlaybackChoices.SYNC_PLAYBACK,
         )
 
+    async def aspeak_on_stream(self, ssml_text: str) -> "StreamInstruction":
+        """Async variant of :func:`~StreamPoint.speak_on_stream` which does not
+        block a thread while the text gets synthesized.
+        """
+        tts = await TextToSpeech.acreate_from_text(ssml_text)
+        return await sync_to_async(self.play_audio_file)(
+            tts.audio_file,
+            playback_type=story_graph.models.AudioCell.PlaybackChoices.SYNC_PLAYBACK,
+        )
+
     def play_audio_file(
         self,
         audio_file: "AudioFile",
         playback_type: story_graph.models.AudioCell.PlaybackChoices = story_graph.models.AudioCell.PlaybackChoices.ASYNC_PLAYBACK,
+        queue: bool = False,
     ) -> "StreamInstruction":
+        """Plays an audio file on SuperCollider.
+
+        :param queue: Only for ``SYNC_PLAYBACK``, starts the playback once all
+            previously queued audio files have finished playing, so the next
+            audio file can be send ahead without a gap
+        """
         sc_audio_file_path = f"/data/{audio_file.file.name}"
 
         manual_finish = False
@@ -163,8 +181,9 @@ class StreamPoint(models.Model):
             instruction = StreamInstruction.objects.create(
                 stream_point=self, instruction_text=""
             )
+            play_method = "queuePlayBuffer" if queue else "syncPlayBuffer"
             instruction.instruction_text = (
-                f'{{g.syncPlayBuffer("{sc_audio_file_path}", "{instruction.uuid}")}}'
+                f'{{g.{play_method}("{sc_audio_file_path}", "{instruction.uuid}")}}'
             )
             instruction.save()
         else:
@@ -253,6 +272,36 @@ class StreamManager(models.Manager):
 
         return stream
 
+    async def aget_reconnect_stream(
+        self, graph: "story_graph.models.Graph", reconnect_token: uuid.UUID
+    ) -> "Stream":
+        """
+        Returns the stream of a listener who has lost its connection, so
+        the :class:`~story_graph.engine.Engine` can resume from the checkpoint
+        of the stream.
+
+        Raises :class:`~Stream.DoesNotExist` if the stream has not been active
+        within the last ``STREAM_RECONNECT_SEC`` seconds or if its stream point
+        is offline or has already been assigned to another stream.
+        """
+        stream: Stream = await self.select_related("stream_point").aget(  # type: ignore
+            graph=graph,
+            reconnect_token=reconnect_token,
+            modified_date__gt=timezone.now()
+            - timedelta(seconds=settings.STREAM_RECONNECT_SEC),
+        )
+        if not stream.stream_point.is_online():
+            raise Stream.DoesNotExist(f"Stream point of {stream.uuid} is offline")
+        if (
+            await self.filter(stream_point=stream.stream_point, num_listeners__gt=0)
+            .exclude(uuid=stream.uuid)
+            .aexists()
+        ):
+            raise Stream.DoesNotExist(
+                f"Stream point of {stream.uuid} is used by another stream"
+            )
+        return stream
+
     def disconnect_all_streams(self):
         stream: Stream
         for stream in Stream.objects.filter(num_listeners__gt=0):
@@ -302,21 +351,50 @@ class Stream(models.Model):
         blank=True,
     )
 
+    reconnect_token = models.UUIDField(
+        null=True,
+        blank=True,
+        editable=False,
+        default=uuid4,
+        db_index=True,
+        verbose_name=_("Reconnect token"),
+        help_text=_(
+            "Allows a listener who lost the connection to re-attach to this stream"
+        ),
+    )
+
+    checkpoint_node = models.ForeignKey(
+        "story_graph.Node",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+        verbose_name=_("Checkpoint node"),
+        help_text=_(
+            "Node which is currently executed on the stream, "
+            "a reconnecting listener resumes from this node"
+        ),
+    )
+
+    async def _add_num_listeners(self, delta: int) -> None:
+        # counted within the database as several subscriptions can hold
+        # their own copy of the stream, e.g. after a reconnect,
+        # and the copy must not overwrite e.g. the checkpoint
+        await Stream.objects.filter(uuid=self.uuid).aupdate(
+            num_listeners=F("num_listeners") + delta,
+            modified_date=timezone.now(),
+        )
+        await self.arefresh_from_db(fields=["num_listeners", "modified_date"])
+        # an update does not trigger the post_save signal
+        await GenCasterChannel.send_streams_update(str(self.uuid))
+
     async def increment_num_listeners(self):
         log.debug("Increment number of listeners")
-        self.num_listeners = self.num_listeners + 1
-        await self.asave()
-        # await Stream.objects.filter(uuid=self.uuid).aupdate(
-        #     num_listeners=F("num_listeners") + 1
-        # )
+        await self._add_num_listeners(1)
 
     async def decrement_num_listeners(self):
         log.debug("Decrement number of listeners")
-        self.num_listeners = self.num_listeners - 1
-        await self.asave()
-        # await Stream.objects.filter(uuid=self.uuid).aupdate(
-        #     num_listeners=F("num_listeners") - 1
-        # )
+        await self._add_num_listeners(-1)
 
     def disconnect(self):
         log.info(f"Disconnect stream {self.uuid}")
@@ -413,6 +491,20 @@ class StreamVariable(models.Model):
         return f"{self.stream}: {self.key} -> {self.value}"
 
 
+@receiver(
+    signals.post_save,
+    sender=StreamVariable,
+    dispatch_uid="update_stream_variable_ws",
+)
+def update_stream_variable_ws(sender, instance: StreamVariable, **kwargs):
+    """Notifies anyone waiting on a variable of the stream, see
+    :func:`~story_graph.engine.Engine.wait_for_stream_variable`.
+    """
+    async_to_sync(GenCasterChannel.send_stream_variable_update)(
+        instance.stream_id, instance.key, instance.value  # type: ignore
+    )
+
+
 class StreamInstruction(models.Model):
     """Instruction for a :class:`StreamPoint`, most likely to be
     created from a :class:`~story_graph.models.ScriptCell`.
@@ -495,6 +587,26 @@ class StreamInstruction(models.Model):
         return f"{self.uuid} ({self.state})"
 
 
+@receiver(
+    signals.post_save,
+    sender=StreamInstruction,
+    dispatch_uid="update_stream_instruction_ws",
+)
+def update_stream_instruction_ws(
+    sender, instance: StreamInstruction, created: bool, **kwargs
+):
+    """Publishes the state of an instruction so an
+    :class:`~story_graph.engine.Engine` waiting for the instruction does
+    not need to poll the database, see
+    :func:`~story_graph.engine.Engine.wait_for_finished_instruction`.
+    """
+    if created:
+        return
+    async_to_sync(GenCasterChannel.send_stream_instruction_update)(
+        instance.uuid, instance.state
+    )
+
+
 class AudioFile(models.Model):
     """Represents a local audio file on the server.
     As SuperCollider and Django are running on the same server we
@@ -621,6 +733,26 @@ class TextToSpeech(models.Model):
         default=VoiceNameChoices.DE_NEURAL2_C__FEMALE,
     )
 
+    text_hash = models.CharField(
+        max_length=64,
+        verbose_name=_("Hash of the normalized text"),
+        help_text=_("Allows to look up a text without comparing the whole text"),
+        editable=False,
+        default="",
+    )
+
+    @staticmethod
+    def get_text_hash(ssml_text: str) -> str:
+        """SHA-256 of the text with normalized whitespace, so texts which only
+        differ by their whitespace share the same audio.
+        """
+        normalized_text = " ".join(ssml_text.split())
+        return hashlib.sha256(normalized_text.encode()).hexdigest()
+
+    def save(self, *args, **kwargs) -> None:
+        self.text_hash = self.get_text_hash(self.text)
+        super().save(*args, **kwargs)
+
     @classmethod
     def create_from_text(
         cls,
@@ -629,59 +761,49 @@ class TextToSpeech(models.Model):
         force_new: bool = False,
     ) -> "TextToSpeech":
         """
-        Creates a new instance for a given text by calling the Google Cloud.
+        Creates a new instance for a given text by calling the Google Cloud,
+        or the backend which is configured in :mod:`~stream.tts`.
         We will not call the API if we find the exact same text in our database,
         in which case we will return the object from the database.
         This caching behavior can be controlled via ``force_new``.
 
-        .. seealso::
-
-            Copied from
-            `google examples <https://cloud.google.com/text-to-speech/docs/libraries#client-libraries-install-python>`_
-
+        Identical requests which run at the same time are only synthesized once,
+        see :class:`~stream.tts.TextToSpeechService`.
 
         :param ssml_text: SSML text to convert to audio
         :param voice_name: Voice name to use
         :param force_new: If new we will not search for existing objects
             with the same text.
         """
-        if not force_new:
-            if existing_text := cls.objects.filter(
-                text=ssml_text,
-                voice_name=voice_name,
-            ).first():
-                return existing_text
-
-        client = texttospeech.TextToSpeechClient()
-
-        log.info(f"Request text to speech for {ssml_text[0:100]}")
-        response = client.synthesize_speech(
-            input=texttospeech.SynthesisInput(
-                ssml=ssml_text,
-            ),
-            voice=texttospeech.VoiceSelectionParams(
-                language_code="de-de",
-                name=voice_name,
-            ),
-            audio_config=texttospeech.AudioConfig(
-                audio_encoding=texttospeech.AudioEncoding.LINEAR16,
-            ),
-        )
-        log.debug(f"Received text to speech for {ssml_text[0:100]}")
+        from .tts import get_text_to_speech_service
 
-        audio_file = AudioFile.from_file(
-            file_content=io.BytesIO(response.audio_content)  # type: ignore
+        return get_text_to_speech_service().synthesize_sync(
+            ssml_text, voice_name, force_new
         )
-        log.info(f"Saved audio of text {ssml_text[0:100]} to {audio_file.file.name}")
-        return cls.objects.create(
-            audio_file=audio_file,
-            text=ssml_text,
-            voice_name=voice_name,
+
+    @classmethod
+    async def acreate_from_text(
+        cls,
+        ssml_text: str,
+        voice_name: str = VoiceNameChoices.DE_NEURAL2_C__FEMALE,
+        force_new: bool = False,
+    ) -> "TextToSpeech":
+        """Async variant of :func:`~TextToSpeech.create_from_text`."""
+        from .tts import get_text_to_speech_service
+
+        return await get_text_to_speech_service().synthesize(
+            ssml_text, voice_name, force_new
         )
 
     class Meta:
         verbose_name = "Text to speech job"
         verbose_name_plural = "Text to speech jobs"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["text_hash", "voice_name"],
+                name="unique_text_hash_voice_name",
+            )
+        ]
 
     def __str__(self) -> str:
         return f"{self.text[0:100]}"
@@ -0,0 +1,107 @@
+"""
+SSML chunks
+===========
+
+A :class:`~stream.models.TextToSpeech` of a long text takes multiple seconds
+until the audio is available, so long narrations are split into chunks at
+sentence ends and breaks, see :func:`~split_ssml`.
+The chunks can be synthesized concurrently and the first chunk can be played
+while the remaining chunks are still being synthesized.
+As every chunk is a valid SSML document on its own it gets cached as its own
+:class:`~stream.models.TextToSpeech`, so sentences which are shared across
+multiple cells only need to be synthesized once.
+
+Chunks are at least ``TTS_CHUNK_CHARS`` characters long, except for the last
+one - a text which is shorter will not be split.
+"""
+
+import re
+from typing import List, Tuple
+
+TAG = re.compile(r"(<[^>]+>)")
+TAG_NAME = re.compile(r"</?\s*([\w:-]+)")
+# whitespace after the end of a sentence
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+
+def _closing_tags(open_tags: List[Tuple[str, str]]) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(open_tags))
+
+
+def _opening_tags(open_tags: List[Tuple[str, str]]) -> str:
+    return "".join(tag for _, tag in open_tags)
+
+
+def split_ssml(ssml_text: str, chunk_chars: int) -> List[str]:
+    """Splits a SSML text into multiple SSML texts at sentence ends and
+    ``<break/>`` tags.
+    Tags which are still open at a split are closed at the end of the chunk
+    and re-opened at the start of the next one, so e.g. a change of the voice
+    is kept.
+
+    :param ssml_text: SSML text which is wrapped in ``<speak>``
+    :param chunk_chars: Minimum number of characters of a chunk,
+        ``0`` disables splitting
+    """
+    if chunk_chars <= 0 or len(ssml_text) <= chunk_chars:
+        return [ssml_text]
+    content = ssml_text.strip()
+    if not (content.startswith("<speak>") and content.endswith("</speak>")):
+        return [ssml_text]
+    content = content[len("<speak>") : -len("</speak>")]
+
+    chunks: List[str] = []
+    # name and opening tag of the tags which are currently open
+    open_tags: List[Tuple[str, str]] = []
+    prefix = ""
+    parts: List[str] = []
+    length = 0
+    has_audio = False
+
+    def split() -> None:
+        nonlocal prefix, parts, length, has_audio
+        if length < chunk_chars:
+            return
+        if has_audio:
+            chunks.append(
+                f"<speak>{prefix}{''.join(parts)}{_closing_tags(open_tags)}</speak>"
+            )
+        prefix = _opening_tags(open_tags)
+        parts = []
+        length = 0
+        has_audio = False
+
+    def add(part: str, audible: bool) -> None:
+        nonlocal length, has_audio
+        parts.append(part)
+        length += len(part)
+        has_audio = has_audio or audible
+
+    for part in TAG.split(content):
+        if not part:
+            continue
+        if not TAG.fullmatch(part):
+            start = 0
+            for match in SENTENCE_END.finditer(part):
+                add(part[start : match.end()], True)
+                split()
+                start = match.end()
+            add(part[start:], bool(part[start:].strip()))
+            continue
+        name_match = TAG_NAME.match(part)
+        name = name_match.group(1) if name_match else ""
+        if part.endswith("/>"):
+            add(part, True)
+            if name == "break":
+                split()
+        elif part.startswith("</"):
+            add(part, False)
+            if open_tags:
+                open_tags.pop()
+        else:
+            add(part, False)
+            open_tags.append((name, part))
+
+    if has_audio:
+        chunks.append(f"<speak>{prefix}{''.join(parts)}</speak>")
+    return chunks if chunks else [ssml_text]
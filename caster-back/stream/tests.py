@@ -1,11 +1,15 @@
+import asyncio
 import io
 import logging
+import threading
+import uuid
 from datetime import timedelta
 from typing import List
 from unittest import mock
 
 from asgiref.sync import sync_to_async
-from django.test import TestCase
+from django.db.utils import IntegrityError
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
 from mixer.backend.django import mixer
 
@@ -13,7 +17,15 @@ from story_graph.models import Graph
 from story_graph.tests import GraphTestCase
 
 from .exceptions import NoStreamAvailableException
+from .frontend_types import Button, Checkbox, Dialog, Input, Text
 from .models import AudioFile, Stream, StreamInstruction, StreamPoint, TextToSpeech
+from .ssml import split_ssml
+from .tts import (
+    FakeTextToSpeechBackend,
+    GoogleTextToSpeechBackend,
+    TextToSpeechBackend,
+    TextToSpeechService,
+)
 
 logging.disable(logging.CRITICAL)
 
@@ -176,6 +188,33 @@ class StreamTestCase(TestCase):
         self.assertEqual(await Stream.objects.filter(num_listeners__lt=1).acount(), 1)
         self.assertEqual(await Stream.objects.acount(), 1)
 
+    async def test_reconnect_stream(self):
+        graph = await sync_to_async(GraphTestCase.get_graph)()
+        await sync_to_async(StreamPointTestCase.get_stream_point)()
+        stream = await Stream.objects.aget_free_stream(graph=graph)
+        self.assertIsNotNone(stream.reconnect_token)
+
+        reconnected = await Stream.objects.aget_reconnect_stream(
+            graph, stream.reconnect_token  # type: ignore
+        )
+        self.assertEqual(reconnected, stream)
+
+        with self.assertRaises(Stream.DoesNotExist):
+            await Stream.objects.aget_reconnect_stream(graph, uuid.uuid4())
+
+        # the stream point has been assigned to another listener meanwhile
+        other_stream = await Stream.objects.aget_free_stream(graph=graph)
+        await other_stream.increment_num_listeners()
+        with self.assertRaises(Stream.DoesNotExist):
+            await Stream.objects.aget_reconnect_stream(graph, stream.reconnect_token)  # type: ignore
+        await other_stream.decrement_num_listeners()
+
+        await Stream.objects.filter(uuid=stream.uuid).aupdate(
+            modified_date=timezone.now() - timedelta(seconds=5000)
+        )
+        with self.assertRaises(Stream.DoesNotExist):
+            await Stream.objects.aget_reconnect_stream(graph, stream.reconnect_token)  # type: ignore
+
     def test_make_all_offline(self):
         for _ in range(2):
             stream = self.get_stream(num_listeners=1)
@@ -218,6 +257,19 @@ class StreamInstructionTestCase(TestCase):
         self.assertTrue(str(stream_instruction.uuid) in str(stream_instruction))
 
 
+class DialogTestCase(TestCase):
+    def test_dict_round_trip(self):
+        dialog = Dialog(
+            title="Hello",
+            content=[Text(text="foo"), Input(key="name"), Checkbox.gps()],
+            buttons=[Button.ok(), Button.cancel()],
+        )
+        data = dialog.to_dict()
+        # only plain types so it can be send via the channel layer
+        self.assertEqual(data["buttons"][0]["button_type"], "primary")
+        self.assertEqual(Dialog.from_dict(data), dialog)
+
+
 class AudioFileTestCase(TestCase):
     @staticmethod
     def get_audio_file(**kwargs) -> AudioFile:
@@ -247,15 +299,209 @@ class TextToSpeechTestCase(TestCase):
         new = TextToSpeech.create_from_text(ssml_text="hello world")
         self.assertEqual(existing, new)
 
-    @mock.patch("stream.models.texttospeech")
+    @mock.patch("stream.tts.texttospeech")
     def test_mock_call(self, tts):
         tts.TextToSpeechClient.return_value.synthesize_speech.return_value.audio_content = (
             b"hello_world"
         )
-        t = TextToSpeech.create_from_text("foo")
+        service = TextToSpeechService(GoogleTextToSpeechBackend())
+        with mock.patch("stream.tts._service", service):
+            t = TextToSpeech.create_from_text("foo")
         self.assertEqual(t.audio_file.file.read(), b"hello_world")
         self.assertEqual(TextToSpeech.objects.all().count(), 1)
 
     def test_str(self):
         t = self.get_text_to_speech(text="Hello world")
         self.assertTrue("Hello world" in str(t))
+
+
+class BlockingTextToSpeechBackend(FakeTextToSpeechBackend):
+    """Blocks the synthesis until it gets released."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.release = threading.Event()
+
+    def synthesize(self, ssml_text: str, voice_name: str) -> bytes:
+        self.release.wait(5.0)
+        return super().synthesize(ssml_text, voice_name)
+
+
+class TextToSpeechServiceTestCase(TransactionTestCase):
+    async def test_synthesize(self):
+        backend = FakeTextToSpeechBackend()
+        service = TextToSpeechService(backend)
+        tts = await service.synthesize("<speak>Hello</speak>")
+        self.assertEqual(tts.text, "<speak>Hello</speak>")
+        self.assertEqual(
+            backend.requests, [("<speak>Hello</speak>", "de-DE-Neural2-C")]
+        )
+        # existing texts are taken from the database
+        self.assertEqual((await service.synthesize("<speak>Hello</speak>")).pk, tts.pk)
+        self.assertEqual(service.syntheses, 1)
+        self.assertEqual(
+            (await service.synthesize("<speak>Hello</speak>", force_new=True)).text,
+            tts.text,
+        )
+        self.assertEqual(service.syntheses, 2)
+
+    async def test_coalesce(self):
+        backend = BlockingTextToSpeechBackend()
+        service = TextToSpeechService(backend)
+        tasks = [
+            asyncio.create_task(service.synthesize("<speak>Hello</speak>"))
+            for _ in range(10)
+        ]
+        await asyncio.sleep(0.1)
+        # a cancelled caller does not cancel the shared synthesis
+        tasks[0].cancel()
+        backend.release.set()
+        results = await asyncio.gather(*tasks[1:])
+        self.assertEqual(len(backend.requests), 1)
+        self.assertEqual(len({tts.pk for tts in results}), 1)
+        self.assertEqual(service.syntheses, 1)
+        self.assertEqual(service.coalesced, 9)
+        self.assertEqual(await TextToSpeech.objects.acount(), 1)
+
+    async def test_coalesce_across_loops(self):
+        backend = BlockingTextToSpeechBackend()
+        service = TextToSpeechService(backend)
+
+        def synthesize_and_close_loop():
+            # the loop of the first caller gets closed while synthesizing
+            async def synthesize():
+                task = asyncio.create_task(service.synthesize("<speak>Hello</speak>"))
+                await asyncio.sleep(0.1)
+                task.cancel()
+
+            asyncio.run(synthesize())
+
+        await sync_to_async(synthesize_and_close_loop, thread_sensitive=False)()
+        waiter = asyncio.create_task(service.synthesize("<speak>Hello</speak>"))
+        await asyncio.sleep(0.1)
+        backend.release.set()
+        tts = await asyncio.wait_for(waiter, 5.0)
+        self.assertEqual(tts.text, "<speak>Hello</speak>")
+        self.assertEqual(service.coalesced, 1)
+        self.assertEqual(len(backend.requests), 1)
+
+    async def test_voices_are_not_coalesced(self):
+        backend = BlockingTextToSpeechBackend()
+        backend.release.set()
+        service = TextToSpeechService(backend)
+        await asyncio.gather(
+            service.synthesize("<speak>Hello</speak>", "de-DE-Neural2-B"),
+            service.synthesize("<speak>Hello</speak>", "de-DE-Neural2-C"),
+        )
+        self.assertEqual(len(backend.requests), 2)
+
+    async def test_failure(self):
+        backend = mock.MagicMock(spec=TextToSpeechBackend)
+        backend.synthesize.side_effect = ValueError("quota exceeded")
+        service = TextToSpeechService(backend)
+        with self.assertRaises(ValueError):
+            await service.synthesize("<speak>Hello</speak>")
+        # a failed synthesis is not kept in flight
+        with self.assertRaises(ValueError):
+            await service.synthesize("<speak>Hello</speak>")
+        self.assertEqual(backend.synthesize.call_count, 2)
+
+
+class TextToSpeechCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        self.backend = FakeTextToSpeechBackend()
+        self.service = TextToSpeechService(self.backend)
+
+    def test_text_hash(self):
+        self.assertEqual(
+            TextToSpeech.get_text_hash("<speak>Hello  world</speak>"),
+            TextToSpeech.get_text_hash(" <speak>Hello\nworld</speak>\n"),
+        )
+        self.assertNotEqual(
+            TextToSpeech.get_text_hash("<speak>Hello world</speak>"),
+            TextToSpeech.get_text_hash("<speak>Hello World</speak>"),
+        )
+
+    def test_unique_text_hash(self):
+        TextToSpeechTestCase.get_text_to_speech(
+            text="<speak>Hello</speak>", voice_name="de-DE-Neural2-C"
+        )
+        with self.assertRaises(IntegrityError):
+            TextToSpeechTestCase.get_text_to_speech(
+                text="<speak>Hello</speak>\n", voice_name="de-DE-Neural2-C"
+            )
+
+    def test_normalized_lookup(self):
+        tts = self.service.synthesize_sync("<speak>Hello world</speak>")
+        self.service.clear_cache()
+        self.assertEqual(
+            self.service.synthesize_sync("<speak>Hello\n  world</speak>").pk, tts.pk
+        )
+        self.assertEqual(len(self.backend.requests), 1)
+
+    def test_memory_cache(self):
+        tts = self.service.synthesize_sync("<speak>Hello world</speak>")
+        with self.assertNumQueries(0):
+            cached = self.service.synthesize_sync("<speak>Hello world</speak>")
+            self.assertEqual(cached.audio_file.file.name, tts.audio_file.file.name)
+        self.assertEqual(self.service.hits, 1)
+
+    def test_memory_cache_size(self):
+        self.service.cache_size = 1
+        self.service.synthesize_sync("<speak>Hello</speak>")
+        self.service.synthesize_sync("<speak>World</speak>")
+        with self.assertNumQueries(1):
+            self.service.synthesize_sync("<speak>Hello</speak>")
+
+    def test_force_new(self):
+        tts = self.service.synthesize_sync("<speak>Hello</speak>")
+        new_tts = self.service.synthesize_sync("<speak>Hello</speak>", force_new=True)
+        self.assertEqual(new_tts.pk, tts.pk)
+        self.assertNotEqual(new_tts.audio_file.pk, tts.audio_file.pk)
+        self.assertEqual(TextToSpeech.objects.count(), 1)
+        self.assertEqual(
+            self.service.synthesize_sync("<speak>Hello</speak>").audio_file.pk,
+            new_tts.audio_file.pk,
+        )
+
+    def test_evict_on_delete(self):
+        with mock.patch("stream.tts._service", self.service):
+            tts = self.service.synthesize_sync("<speak>Hello</speak>")
+            tts.delete()
+            self.service.synthesize_sync("<speak>Hello</speak>")
+        self.assertEqual(len(self.backend.requests), 2)
+
+
+class SplitSSMLTestCase(TestCase):
+    TEXT = (
+        "<speak>Hello world. How are you? "
+        '<voice name="de-DE-Neural2-B">Fine. Thanks!</voice>'
+        ' Bye<break time="1s"/>and again.</speak>'
+    )
+
+    def test_short_text(self):
+        self.assertEqual(split_ssml(self.TEXT, len(self.TEXT)), [self.TEXT])
+        self.assertEqual(split_ssml(self.TEXT, 0), [self.TEXT])
+
+    def test_split(self):
+        self.assertEqual(
+            split_ssml(self.TEXT, 10),
+            [
+                "<speak>Hello world. </speak>",
+                "<speak>How are you? </speak>",
+                '<speak><voice name="de-DE-Neural2-B">Fine. </voice></speak>',
+                '<speak><voice name="de-DE-Neural2-B">Thanks!</voice> Bye<break time="1s"/></speak>',
+                "<speak>and again.</speak>",
+            ],
+        )
+
+    def test_min_chunk_size(self):
+        chunks = split_ssml(self.TEXT, 40)
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(
+            chunks[0],
+            '<speak>Hello world. How are you? <voice name="de-DE-Neural2-B">Fine. </voice></speak>',
+        )
+
+    def test_no_speak(self):
+        self.assertEqual(split_ssml("Hello. World.", 2), ["Hello. World."])
@@ -0,0 +1,335 @@
+"""
+Text to speech service
+======================
+
+Converts SSML into a :class:`~stream.models.TextToSpeech` via an exchangeable
+backend which is configured via the ``TEXT_TO_SPEECH`` setting:
+
+* :class:`~GoogleTextToSpeechBackend` uses the
+  `Google Cloud Text-to-Speech API <https://cloud.google.com/text-to-speech>`_.
+* :class:`~FakeTextToSpeechBackend` creates silent audio without any network
+  access and is used for tests.
+
+Each text is looked up via a hash of its normalized content, which is
+indexed together with the voice, and the most recently used texts are kept
+in memory, so a repeated text does not even need to access the database.
+
+When multiple listeners arrive at the same markdown cell at the same time,
+each of them would miss the database lookup and request the same audio.
+Therefore identical requests, meaning the same SSML and voice, are coalesced
+by the :class:`~TextToSpeechService` into a single synthesis whose result
+is shared by all waiting callers, no matter if they are async or sync.
+"""
+
+import asyncio
+import io
+import logging
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import QuerySet, signals
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from google.cloud import texttospeech
+
+from .models import AudioFile, TextToSpeech
+
+log = logging.getLogger(__name__)
+
+
+class TextToSpeechBackend:
+    """Converts SSML to audio. Gets called from multiple threads."""
+
+    def synthesize(self, ssml_text: str, voice_name: str) -> bytes:
+        """Returns the audio of the SSML as WAV file."""
+        raise NotImplementedError()
+
+
+class GoogleTextToSpeechBackend(TextToSpeechBackend):
+    """Re-uses a single client, and therefore its connection, for all requests.
+
+    .. seealso::
+
+        Copied from
+        `google examples <https://cloud.google.com/text-to-speech/docs/libraries#client-libraries-install-python>`_
+    """
+
+    def __init__(self) -> None:
+        self._client: Optional[texttospeech.TextToSpeechClient] = None
+        self._lock = threading.Lock()
+
+    def _get_client(self) -> texttospeech.TextToSpeechClient:
+        with self._lock:
+            if self._client is None:
+                self._client = texttospeech.TextToSpeechClient()
+            return self._client
+
+    def synthesize(self, ssml_text: str, voice_name: str) -> bytes:
+        response = self._get_client().synthesize_speech(
+            input=texttospeech.SynthesisInput(
+                ssml=ssml_text,
+            ),
+            voice=texttospeech.VoiceSelectionParams(
+                language_code="de-de",
+                name=voice_name,
+            ),
+            audio_config=texttospeech.AudioConfig(
+                audio_encoding=texttospeech.AudioEncoding.LINEAR16,
+            ),
+        )
+        return response.audio_content  # type: ignore
+
+
+class FakeTextToSpeechBackend(TextToSpeechBackend):
+    """Returns a silent WAV file and keeps track of the requests.
+
+    :param duration: Seconds of silence
+    """
+
+    SAMPLE_RATE = 24000
+
+    def __init__(self, duration: float = 0.1) -> None:
+        self.duration = duration
+        self.requests: List[Tuple[str, str]] = []
+
+    def synthesize(self, ssml_text: str, voice_name: str) -> bytes:
+        self.requests.append((ssml_text, voice_name))
+        data = b"\x00\x00" * int(self.SAMPLE_RATE * self.duration)
+        header = struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF",
+            36 + len(data),
+            b"WAVE",
+            b"fmt ",
+            16,
+            1,  # PCM
+            1,  # mono
+            self.SAMPLE_RATE,
+            self.SAMPLE_RATE * 2,
+            2,
+            16,
+            b"data",
+            len(data),
+        )
+        return header + data
+
+
+class _Synthesis:
+    """A synthesis which is in flight and shared by all callers of a text."""
+
+    def __init__(self) -> None:
+        self.audio: "Future[bytes]" = Future()
+        self.audio.set_running_or_notify_cancel()
+        self._lock = threading.Lock()
+        self._text_to_speech: Optional[TextToSpeech] = None
+
+
+class TextToSpeechService:
+    """Creates a :class:`~stream.models.TextToSpeech` if it does not exist
+    yet, whereby identical requests which are in flight at the same time
+    result in a single synthesis.
+
+    The first caller of a text starts the synthesis, which runs within an
+    executor independent of the event loop and the cancellation of the
+    caller, and all callers share its audio via a future.
+    The first caller who receives the audio stores it.
+    Texts are identified by their
+    :func:`~stream.models.TextToSpeech.get_text_hash` and the voice, and the
+    most recently used ones are kept in memory, so a cache hit does not need
+    to access the database.
+
+    :param backend: Converts the SSML to audio
+    :param max_workers: Number of async syntheses which run at the same time
+    :param cache_size: Number of texts which are kept in memory
+    """
+
+    def __init__(
+        self,
+        backend: TextToSpeechBackend,
+        max_workers: int = 8,
+        cache_size: int = 1024,
+    ) -> None:
+        self.backend = backend
+        self.cache_size = cache_size
+        self.syntheses: int = 0
+        self.coalesced: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="text-to-speech"
+        )
+        self._in_flight: Dict[Tuple[str, str], _Synthesis] = {}
+        self._cache: "OrderedDict[Tuple[str, str], TextToSpeech]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(ssml_text: str, voice_name: str) -> Tuple[str, str]:
+        return (TextToSpeech.get_text_hash(ssml_text), voice_name)
+
+    @staticmethod
+    def _lookup(key: Tuple[str, str]) -> "QuerySet[TextToSpeech]":
+        return TextToSpeech.objects.select_related("audio_file").filter(
+            text_hash=key[0],
+            voice_name=key[1],
+        )
+
+    def _get_cached(self, key: Tuple[str, str]) -> Optional[TextToSpeech]:
+        with self._lock:
+            if (text_to_speech := self._cache.get(key)) is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return text_to_speech
+
+    def _set_cached(self, key: Tuple[str, str], text_to_speech: TextToSpeech) -> None:
+        with self._lock:
+            self._cache[key] = text_to_speech
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def evict(self, text_hash: str, voice_name: str) -> None:
+        """Removes a text from the memory cache, e.g. after it was deleted."""
+        with self._lock:
+            self._cache.pop((text_hash, voice_name), None)
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def _store(
+        self, key: Tuple[str, str], ssml_text: str, audio_content: bytes
+    ) -> TextToSpeech:
+        log.debug(f"Received text to speech for {ssml_text[0:100]}")
+        audio_file = AudioFile.from_file(file_content=io.BytesIO(audio_content))
+        log.info(f"Saved audio of text {ssml_text[0:100]} to {audio_file.file.name}")
+        # a forced synthesis replaces the audio of an existing text
+        text_to_speech, _ = TextToSpeech.objects.update_or_create(
+            text_hash=key[0],
+            voice_name=key[1],
+            defaults={"audio_file": audio_file, "text": ssml_text},
+        )
+        self._set_cached(key, text_to_speech)
+        return text_to_speech
+
+    def _join(self, key: Tuple[str, str], force_new: bool) -> Tuple[_Synthesis, bool]:
+        """Returns the synthesis of the text and if the caller needs to
+        start it.
+        """
+        with self._lock:
+            if not force_new and (synthesis := self._in_flight.get(key)) is not None:
+                self.coalesced += 1
+                return synthesis, False
+            self.syntheses += 1
+            synthesis = _Synthesis()
+            self._in_flight[key] = synthesis
+            return synthesis, True
+
+    def _leave(self, key: Tuple[str, str], synthesis: _Synthesis) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is synthesis:
+                del self._in_flight[key]
+
+    def _synthesize_audio(
+        self, key: Tuple[str, str], ssml_text: str, synthesis: _Synthesis
+    ) -> None:
+        try:
+            log.info(f"Request text to speech for {ssml_text[0:100]}")
+            synthesis.audio.set_result(self.backend.synthesize(ssml_text, key[1]))
+        except Exception as e:
+            synthesis.audio.set_exception(e)
+            self._leave(key, synthesis)
+
+    def _store_once(
+        self, key: Tuple[str, str], ssml_text: str, synthesis: _Synthesis
+    ) -> TextToSpeech:
+        """Stores the audio of a synthesis, whereby the first of its callers
+        who arrives here creates the :class:`~stream.models.TextToSpeech`.
+        """
+        audio_content = synthesis.audio.result()
+        with synthesis._lock:
+            if synthesis._text_to_speech is None:
+                synthesis._text_to_speech = self._store(key, ssml_text, audio_content)
+                self._leave(key, synthesis)
+            return synthesis._text_to_speech
+
+    async def synthesize(
+        self,
+        ssml_text: str,
+        voice_name: str = TextToSpeech.VoiceNameChoices.DE_NEURAL2_C__FEMALE,
+        force_new: bool = False,
+    ) -> TextToSpeech:
+        """Returns the :class:`~stream.models.TextToSpeech` of the text,
+        see :func:`~stream.models.TextToSpeech.create_from_text`.
+        """
+        key = self._key(ssml_text, voice_name)
+        if not force_new:
+            if text_to_speech := self._get_cached(key):
+                return text_to_speech
+            if text_to_speech := await self._lookup(key).afirst():
+                self._set_cached(key, text_to_speech)
+                return text_to_speech
+        synthesis, is_first = self._join(key, force_new)
+        if is_first:
+            # the synthesis neither depends on the event loop nor on the
+            # cancellation of its first caller, as other callers may wait on it
+            self._executor.submit(self._synthesize_audio, key, ssml_text, synthesis)
+        # a cancelled caller only stops waiting for the shared synthesis
+        await asyncio.shield(asyncio.wrap_future(synthesis.audio))
+        return await sync_to_async(self._store_once)(key, ssml_text, synthesis)
+
+    def synthesize_sync(
+        self,
+        ssml_text: str,
+        voice_name: str = TextToSpeech.VoiceNameChoices.DE_NEURAL2_C__FEMALE,
+        force_new: bool = False,
+    ) -> TextToSpeech:
+        """Blocking variant of :func:`~TextToSpeechService.synthesize`."""
+        key = self._key(ssml_text, voice_name)
+        if not force_new:
+            if text_to_speech := self._get_cached(key):
+                return text_to_speech
+            if text_to_speech := self._lookup(key).first():
+                self._set_cached(key, text_to_speech)
+                return text_to_speech
+        synthesis, is_first = self._join(key, force_new)
+        if is_first:
+            self._synthesize_audio(key, ssml_text, synthesis)
+        return self._store_once(key, ssml_text, synthesis)
+
+
+_service: Optional[TextToSpeechService] = None
+_service_lock = threading.Lock()
+
+
+def get_text_to_speech_service() -> TextToSpeechService:
+    """Returns the service of this process whose backend is configured
+    via the ``TEXT_TO_SPEECH`` setting.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            config: Dict[str, Any] = settings.TEXT_TO_SPEECH
+            _service = TextToSpeechService(
+                backend=import_string(config["BACKEND"])(**config.get("CONFIG", {})),
+                max_workers=config.get("MAX_WORKERS", 8),
+                cache_size=config.get("CACHE_SIZE", 1024),
+            )
+        return _service
+
+
+@receiver(
+    signals.post_delete,
+    sender=TextToSpeech,
+    dispatch_uid="evict_text_to_speech",
+)
+def evict_text_to_speech(sender, instance: TextToSpeech, **kwargs) -> None:
+    """Avoids that a deleted audio is still served from memory."""
+    if _service is not None:
+        _service.evict(instance.text_hash, instance.voice_name)
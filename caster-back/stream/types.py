@@ -100,6 +100,12 @@ class StreamInfo:
     stream: Stream
     stream_instruction: Optional[StreamInstruction]
 
+    @strawberry.field
+    def reconnect_token(self) -> Optional[UUID]:
+        """Allows to resume the stream by passing the token to the
+        ``streamInfo`` subscription after the connection got lost."""
+        return self.stream.reconnect_token  # type: ignore
+
 
 # part of story_graph.types but here due to circular import issue
 @strawberry.type
@@ -312,6 +312,8 @@ GenCasterServer {
 	var <>environment; // shall this be a proxy space?
 	var <>server;
 	var <beacon;
+	var playbackQueue;
+	var queuePlaying = false;
 
 	// basically a constructor which allows us to set
 	// the necessary values directly or via env variables
@@ -367,6 +369,7 @@ GenCasterServer {
 		environment = this.serverInfo;
 		environment[\oscBackendClient] = oscBackendClient;
 		environment[\this] = this;
+		playbackQueue = List();
 		this.loadSynthDefs;
 		beacon = SkipJack(
 			updateFunc: {
@@ -386,6 +389,12 @@ GenCasterServer {
 		// add a callback to the CmdPeriod request which
 		// resurrects the instruction receiver
 		CmdPeriod.add({this.instructionReceiver.value}.defer(0.01));
+		// the synths of the queue get freed without a callback
+		CmdPeriod.add({
+			playbackQueue.do({|entry| entry[\buffer].free});
+			playbackQueue.clear;
+			queuePlaying = false;
+		});
 	}
 
 	loadSynthDefs {
@@ -427,6 +436,37 @@ GenCasterServer {
 		});
 	}
 
+	queuePlayBuffer {|bufferPath, uuid|
+		// like syncPlayBuffer, but the buffer starts once all previously
+		// queued buffers have finished playing, so the backend can send
+		// the next buffer ahead without a gap between both
+		var entry = (uuid: uuid, path: bufferPath, buffer: nil);
+		playbackQueue.add(entry);
+		Buffer.read(Server.default, bufferPath, action: {|buffer|
+			entry[\buffer] = buffer;
+			this.playQueue;
+		});
+	}
+
+	playQueue {
+		var entry;
+		if(queuePlaying or: {playbackQueue.isEmpty} or: {playbackQueue.first[\buffer].isNil}, {
+			^this;
+		});
+		entry = playbackQueue.removeAt(0);
+		queuePlaying = true;
+		Synth(\gencasterBufferPlayback, [\buffer, entry[\buffer]]).onFree({
+			entry[\buffer].free;
+			queuePlaying = false;
+			this.sendAck(
+				status: GenCasterStatus.finished,
+				uuid: entry[\uuid],
+				message: (return_value: "Buffer % finished playing".format(entry[\path]); ),
+			);
+			this.playQueue;
+		});
+	}
+
 	num {
 		synthPort%16;
 	}